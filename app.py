@@ -1,13 +1,17 @@
 # This Python file uses the following encoding: utf-8
+import time
+START_TIME = time.perf_counter()
+
 import sys
 from pathlib import Path
 from PySide6.QtWidgets import QApplication, QMainWindow
 from PySide6.QtQml import QQmlApplicationEngine, qmlRegisterType
-from PySide6.QtCore import QObject, Property, Signal
+from PySide6.QtCore import QObject, Property, Signal, QTimer
 from backend_test import Backend
 from controller.controller import Controller
+from controller.model_loader import models
 from controller.plotter import Plotter
-    
+
 backend = Backend()
 controller = Controller()
 
@@ -28,4 +32,13 @@ if __name__ == "__main__":
 
     if not engine.rootObjects():
         sys.exit(-1)
-    sys.exit(app.exec())
\ No newline at end of file
+
+    # Reports the time to the first frame of the window and then starts loading the classifier in the background
+    window = engine.rootObjects()[0]
+    def onFirstFrame():
+        window.frameSwapped.disconnect(onFirstFrame)
+        print(f"Time to first window: {time.perf_counter() - START_TIME:.2f} s")
+        # started from the event loop, so that the first frame is not delayed
+        QTimer.singleShot(0, models.start_classifier_warmup)
+    window.frameSwapped.connect(onFirstFrame)
+    sys.exit(app.exec())
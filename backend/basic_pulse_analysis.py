@@ -1,7 +1,10 @@
-from typing import List
+from typing import List, Optional, Tuple, Union
 
 import numpy as np
 
+from backend.instrumentation import current_stage, instrumented
+from backend.pulse_batch import PulseBatch
+
 
 class BasicPulseAnalyzer:
     """
@@ -26,16 +29,20 @@ class BasicPulseAnalyzer:
         """
         return np.nanmean(pulse)
 
-    def batch_calculate_pulse_mean(self, pulses: List[np.ndarray]) -> List[float]:
+    def batch_calculate_pulse_mean(self, pulses: Union[PulseBatch, List[np.ndarray]]) -> List[float]:
         """
         Batch version of mean value calculations.
 
         Args:
-            pulses (List[numpy array]): List of one-dimensional vectors corresponding to individual pulses.
+            pulses (PulseBatch or List[numpy array]): The pulses (e.g. as returned by PulseSegmenter.split_pulses)
+                or a list of one-dimensional vectors corresponding to individual pulses.
 
         Returns:
-            List[float]: List of mean values calculated for individual pulses.
+            List[float] or numpy array: Mean values calculated for individual pulses (an array for a PulseBatch,
+                calculated for all pulses at once).
         """
+        if isinstance(pulses, PulseBatch):
+            return self._batch_means(self._float64_batch(pulses))
         means = [self.calculate_pulse_mean(pulse) for pulse in pulses]
         return means
 
@@ -54,16 +61,20 @@ class BasicPulseAnalyzer:
         else:
             return np.nan
 
-    def batch_calculate_pulse_amplitude(self, pulses: List[np.ndarray]) -> List[float]:
+    def batch_calculate_pulse_amplitude(self, pulses: Union[PulseBatch, List[np.ndarray]]) -> List[float]:
         """
         Batch version of pulse amplitude calculations.
 
         Args:
-            pulses (List[numpy array]): List of one-dimensional vectors corresponding to individual pulses.
+            pulses (PulseBatch or List[numpy array]): The pulses (e.g. as returned by PulseSegmenter.split_pulses)
+                or a list of one-dimensional vectors corresponding to individual pulses.
 
         Returns:
-            List[float]: List of pulse amplitudes calculated for individual pulses.
+            List[float] or numpy array: Pulse amplitudes calculated for individual pulses (an array for
+                a PulseBatch, calculated for all pulses at once).
         """
+        if isinstance(pulses, PulseBatch):
+            return self._batch_amplitudes(self._float64_batch(pulses))
         amplitudes = [self.calculate_pulse_amplitude(pulse) for pulse in pulses]
         return amplitudes
 
@@ -86,16 +97,135 @@ class BasicPulseAnalyzer:
         else:
             return np.nan
 
-    def batch_calculate_pulse_slope(self, pulses: List[np.ndarray], times: List[np.ndarray]) -> List[float]:
+    def batch_calculate_pulse_slope(self, pulses: Union[PulseBatch, List[np.ndarray]],
+                                    times: Union[PulseBatch, List[np.ndarray]]) -> List[float]:
         """
         Batch version of pulse slope calculations.
 
         Args:
-            pulses (List[numpy array]): List of one-dimensional vectors corresponding to individual pulses.
+            pulses (PulseBatch or List[numpy array]): The pulses (e.g. as returned by PulseSegmenter.split_pulses)
+                or a list of one-dimensional vectors corresponding to individual pulses.
+            times (PulseBatch or List[numpy array]): The time vectors corresponding to the pulses.
 
         Returns:
-            List[float]: List of pulse slopes calculated for individual pulses.
+            List[float] or numpy array: Pulse slopes calculated for individual pulses (an array if both pulses and
+                times are PulseBatch objects, calculated for all pulses at once).
         """
+        if isinstance(pulses, PulseBatch) and isinstance(times, PulseBatch):
+            first = int(pulses.offsets[0]) if len(pulses.offsets) else 0
+            return self._batch_slopes(self._float64_batch(pulses), times.values[first:])
         slopes = [self.calculate_pulse_slope(pulse, time) for pulse, time in zip(pulses, times)]
         return slopes
 
+    @staticmethod
+    def _float64_batch(pulses: PulseBatch) -> PulseBatch:
+        """
+        Returns a batch of the same pulses with only the part of the buffer holding them, converted to float64
+        (the offsets start at 0).
+        """
+        if len(pulses.offsets) == 0:
+            return PulseBatch(np.zeros(0), pulses.offsets)
+        first, last = int(pulses.offsets[0]), int(pulses.offsets[-1])
+        return PulseBatch(np.asarray(pulses.values[first:last], dtype=np.float64), pulses.offsets - first)
+
+    @instrumented("BasicPulseAnalyzer.batch_calculate_pulse_metrics")
+    def batch_calculate_pulse_metrics(self, signal: np.ndarray, time: Optional[np.ndarray],
+                                      pulse_onsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Vectorized batch version of mean value, pulse amplitude and pulse slope calculations.
+
+        This function takes the whole signal and the pulse onsets returned by PulseSegmenter.split_pulses
+        (pulse i spans signal[pulse_onsets[i]:pulse_onsets[i + 1]]) and calculates all three metrics for all pulses
+        using segment reductions, without creating any per-pulse objects. The results (including NaN values for
+        pulses containing NaN, flat or empty pulses) are the same as for calculate_pulse_mean,
+        calculate_pulse_amplitude and calculate_pulse_slope, up to floating-point summation order.
+
+        Args:
+            signal (numpy array): The one-dimensional signal vector.
+            time (numpy array): The one-dimensional time vector corresponding to the signal (None - slopes are not
+                calculated and are NaN).
+            pulse_onsets (numpy array): The indices of pulse onset points in the signal vector, including the first
+                and the last boundary.
+
+        Returns:
+            means (numpy array): Mean values calculated for individual pulses.
+            amplitudes (numpy array): Pulse amplitudes calculated for individual pulses.
+            slopes (numpy array): Pulse slopes calculated for individual pulses.
+        """
+        pulse_onsets = np.asarray(pulse_onsets, dtype=np.int64)
+        n_pulses = max(len(pulse_onsets) - 1, 0)
+        current_stage().count(pulses=n_pulses)
+        end = int(pulse_onsets[-1]) if len(pulse_onsets) else 0
+        pulses = PulseBatch(np.asarray(signal[:end], dtype=np.float64), pulse_onsets)
+
+        means = self._batch_means(pulses)
+        amplitudes = self._batch_amplitudes(pulses)
+        slopes = self._batch_slopes(pulses, time) if time is not None else np.full(n_pulses, np.nan)
+        return means, amplitudes, slopes
+
+    @staticmethod
+    def _batch_means(pulses: PulseBatch) -> np.ndarray:
+        """
+        Calculates the mean values of a float64 PulseBatch, ignoring NaN samples as calculate_pulse_mean does
+        (NaN for empty pulses and pulses containing only NaN).
+        """
+        nan_counts = pulses.reduce(np.add, transform=np.isnan, empty_value=0, dtype=np.int64)
+        counts = pulses.lengths - nan_counts
+        sums = pulses.reduce(np.add, transform=lambda values: np.where(np.isnan(values), 0.0, values))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, sums / counts, np.nan)
+
+    @staticmethod
+    def _batch_amplitudes(pulses: PulseBatch) -> np.ndarray:
+        """
+        Calculates the amplitudes of a float64 PulseBatch as calculate_pulse_amplitude does (NaN for empty, flat
+        and all-NaN pulses).
+        """
+        nan_max = pulses.reduce(np.fmax)
+        nan_min = pulses.reduce(np.fmin)
+        return np.where(nan_max != nan_min, nan_max - nan_min, np.nan)
+
+    @staticmethod
+    def _batch_slopes(pulses: PulseBatch, time: np.ndarray) -> np.ndarray:
+        """
+        Calculates the slopes of a float64 PulseBatch as calculate_pulse_slope does (NaN for empty pulses); time is
+        indexed like the buffer of the batch.
+        """
+        slopes = np.full(len(pulses), np.nan)
+        lengths = pulses.lengths
+        non_empty = lengths > 0
+        if not np.any(non_empty):
+            return slopes
+        values = pulses.values
+        starts = pulses.starts[non_empty]
+        lengths = lengths[non_empty]
+
+        # argmax of each pulse is the first sample equal to the pulse maximum; pulses containing NaN have a NaN
+        # slope, as in calculate_pulse_slope
+        pulse_max = pulses.reduce(np.maximum)[non_empty]
+        hits = np.flatnonzero(values[starts[0]:pulses.offsets[-1]] == np.repeat(pulse_max, lengths)) + starts[0]
+        first_hits = np.searchsorted(hits, starts)
+        max_positions = hits[np.minimum(first_hits, len(hits) - 1)] if len(hits) else starts
+        has_max = (first_hits < len(hits)) & (max_positions < starts + lengths)
+        max_positions = np.where(has_max, max_positions, starts)
+        d_t = time[max_positions] - time[starts]
+        d_pulse = values[max_positions] - values[starts]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slopes[non_empty] = np.where(has_max & (d_t != 0), d_pulse / d_t, np.nan)
+        return slopes
+
+        # argmax of each pulse is the first sample equal to the pulse maximum; pulses containing NaN have a NaN
+        # slope, as in calculate_pulse_slope
+        pulse_max = pulses.reduce(np.maximum)[non_empty]
+        hits = np.flatnonzero(values[starts[0]:] == np.repeat(pulse_max, lengths)) + starts[0]
+        first_hits = np.searchsorted(hits, starts)
+        max_positions = hits[np.minimum(first_hits, len(hits) - 1)] if len(hits) else starts
+        has_max = (first_hits < len(hits)) & (max_positions < starts + lengths)
+        max_positions = np.where(has_max, max_positions, starts)
+        d_t = time[max_positions] - time[starts]
+        d_pulse = values[max_positions] - values[starts]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slopes[non_empty] = np.where(has_max & (d_t != 0), d_pulse / d_t, np.nan)
+
+        return means, amplitudes, slopes
+
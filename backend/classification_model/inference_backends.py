@@ -0,0 +1,95 @@
+import copy
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+INFERENCE_BACKENDS = ("eager", "torchscript", "onnx")
+
+
+def load_inference_backend(name: str, model: nn.Module, device: torch.device, input_size: int,
+                           onnx_path: Path = None, weights_path: Path = None):
+    """
+    Prepares the ResNet model for inference with the selected backend.
+
+    The available backends are:
+        eager - the model is run as it is (PyTorch eager mode),
+        torchscript - the model is traced and frozen with TorchScript,
+        onnx - the model is exported to ONNX (once, next to the model weights) and run with ONNX Runtime on the CPU.
+
+    Args:
+        name (str): The name of the backend.
+        model (torch Module): The ResNet model in evaluation mode with loaded weights.
+        device (torch device): The device on which the model is run.
+        input_size (int): The number of samples in a preprocessed pulse.
+        onnx_path (Path): The path of the exported ONNX model (required by the onnx backend).
+        weights_path (Path): The path of the model weights; the ONNX model is exported again if it is older.
+
+    Returns:
+        callable: Function which takes a float tensor of shape (batch, 1, input_size) and returns the model outputs
+            as a tensor of shape (batch, number of classes).
+    """
+    if name == "eager":
+        return model
+
+    if name == "torchscript":
+        example = torch.zeros((1, 1, input_size), dtype=torch.float, device=device)
+        with torch.inference_mode(False), torch.no_grad():
+            traced = torch.jit.trace(model, example)
+            return torch.jit.freeze(traced)
+
+    if name == "onnx":
+        if onnx_path is None:
+            raise ValueError("The onnx backend requires the path of the exported model")
+        return _OnnxRuntimeModel(model, input_size, Path(onnx_path), weights_path)
+
+    raise ValueError(f"Unknown inference backend '{name}', expected one of: {', '.join(INFERENCE_BACKENDS)}")
+
+
+class _OnnxRuntimeModel:
+    """
+    Wrapper which runs the ONNX export of the model with ONNX Runtime and has the same interface as the model.
+    """
+
+    def __init__(self, model: nn.Module, input_size: int, onnx_path: Path, weights_path: Path = None) -> None:
+        try:
+            import onnxruntime
+        except ImportError as exc:
+            raise ImportError("The onnx backend requires the onnxruntime package") from exc
+
+        outdated = weights_path is not None and os.path.exists(onnx_path) \
+            and os.path.getmtime(onnx_path) < os.path.getmtime(weights_path)
+        if not os.path.exists(onnx_path) or outdated:
+            export_onnx(model, input_size, onnx_path)
+
+        self.session = onnxruntime.InferenceSession(str(onnx_path), providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, tensors: torch.Tensor) -> torch.Tensor:
+        inputs = np.ascontiguousarray(tensors.cpu().numpy(), dtype=np.float32)
+        outputs = self.session.run(None, {self.input_name: inputs})[0]
+        return torch.from_numpy(outputs)
+
+
+def export_onnx(model: nn.Module, input_size: int, onnx_path: Path) -> None:
+    """
+    Exports the model to ONNX with a dynamic batch dimension.
+
+    The model is written to a temporary file first and then moved to onnx_path, so an interrupted export never
+    leaves a broken model behind.
+
+    Args:
+        model (torch Module): The ResNet model in evaluation mode with loaded weights.
+        input_size (int): The number of samples in a preprocessed pulse.
+        onnx_path (Path): The path of the exported ONNX model.
+    """
+    example = torch.zeros((1, 1, input_size), dtype=torch.float)
+    cpu_model = copy.deepcopy(model).to("cpu")
+    tmp_path = Path(str(onnx_path) + ".tmp")
+    with torch.inference_mode(False), torch.no_grad():
+        torch.onnx.export(cpu_model, example, str(tmp_path), input_names=["pulses"], output_names=["outputs"],
+                          dynamic_axes={"pulses": {0: "batch"}, "outputs": {0: "batch"}}, dynamo=False)
+    os.replace(tmp_path, onnx_path)
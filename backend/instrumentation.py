@@ -0,0 +1,306 @@
+"""
+Per-stage instrumentation of the processing: wall time, CPU time, peak memory and item counts of each stage, written
+as JSON records and optionally profiled.
+
+Instrumentation is disabled by default and is configured with environment variables read when the module is
+imported:
+    ICP_INSTRUMENT=1         enables the measurements; the records are written to standard error.
+    ICP_INSTRUMENT_LOG=path  appends the records to the file instead, one JSON object per line ("-" - standard error);
+                             setting it also enables the measurements.
+    ICP_PROFILE=directory    profiles every top-level stage and writes the profiles to the directory; setting it also
+                             enables the measurements.
+    ICP_PROFILER=name        the profiler used with ICP_PROFILE: cprofile (.prof files for pstats or snakeviz,
+                             the default) or pyinstrument (.html files, requires the pyinstrument package).
+The measurements can also be switched at runtime with set_enabled.
+"""
+import cProfile
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows; the peak working set size is read with GetProcessMemoryInfo there (see below)
+    resource = None
+
+if sys.platform == "win32":
+    import ctypes
+    from ctypes import wintypes
+
+    class _ProcessMemoryCounters(ctypes.Structure):
+        # PROCESS_MEMORY_COUNTERS filled by GetProcessMemoryInfo
+        _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+            (name, ctypes.c_size_t) for name in (
+                "PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage",
+                "QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage")]
+
+    # K32GetProcessMemoryInfo is the kernel32 export of psapi's GetProcessMemoryInfo (Windows 7 and later)
+    _kernel32 = ctypes.WinDLL("kernel32")
+    _kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    _kernel32.K32GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.c_void_p, wintypes.DWORD]
+    _kernel32.K32GetProcessMemoryInfo.restype = wintypes.BOOL
+
+
+# Directory where profiles of top-level stages are written (unset - no profiling)
+PROFILE_DIR = os.environ.get("ICP_PROFILE", "")
+# Instrumentation is enabled with ICP_INSTRUMENT=1, ICP_INSTRUMENT_LOG or ICP_PROFILE (see the module docstring)
+ENABLED = (os.environ.get("ICP_INSTRUMENT", "0") not in ("", "0") or bool(os.environ.get("ICP_INSTRUMENT_LOG"))
+           or bool(PROFILE_DIR))
+# File to which JSON records are appended, one per line ("-" or unset - standard error)
+LOG_PATH = os.environ.get("ICP_INSTRUMENT_LOG", "")
+# Profiler used with ICP_PROFILE: cprofile (.prof files for pstats/snakeviz) or pyinstrument (.html files)
+PROFILER = os.environ.get("ICP_PROFILER", "cprofile")
+
+# Number of most recent records kept in memory
+MAX_RECORDS = 1000
+
+_records = deque(maxlen=MAX_RECORDS)
+_latest = {}
+_listeners = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class Stage:
+    """
+    Measurement of a single run of a stage: wall time, CPU time of the process, increase of the peak resident set
+    size of the process and item counts (e.g. samples, pulses, batches).
+    """
+
+    __slots__ = ("name", "counts", "parent", "_wall", "_cpu", "_rss", "_profiler")
+
+    def __init__(self, name: str, counts: Dict[str, int]) -> None:
+        self.name = name
+        self.counts = counts
+        self.parent = None
+        self._profiler = None
+
+    def count(self, **counts) -> None:
+        """
+        Adds item counts to the record (e.g. count(pulses=n)).
+        """
+        for key, value in counts.items():
+            self.counts[key] = int(value)
+
+    def __enter__(self) -> "Stage":
+        stack = _stack()
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        if PROFILE_DIR and self.parent is None:
+            self._profiler = _start_profiler()
+        self._rss = _peak_rss()
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        rss = _peak_rss()
+        _stack().pop()
+        if self._profiler is not None:
+            _stop_profiler(self._profiler, self.name)
+
+        record = {
+            "stage": self.name,
+            "parent": self.parent,
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "peak_rss_delta_mb": (rss - self._rss) if rss is not None else None,
+            "counts": self.counts,
+            "timestamp": time.time(),
+            "thread": threading.current_thread().name,
+            "failed": exc_type is not None,
+        }
+        _emit(record)
+
+
+class _DisabledStage:
+    """
+    Stage used when instrumentation is disabled; it does nothing.
+    """
+
+    __slots__ = ()
+
+    def count(self, **counts) -> None:
+        pass
+
+    def __enter__(self) -> "_DisabledStage":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        pass
+
+
+_DISABLED_STAGE = _DisabledStage()
+
+
+def stage(name: str, **counts):
+    """
+    Returns a context manager which measures a stage of the processing.
+
+    Usage:
+        with stage("filter_signal", samples=len(signal)) as s:
+            ...
+            s.count(pulses=n_pulses)
+
+    Stages may be nested (the record holds the name of the enclosing stage). When instrumentation is disabled,
+    a shared object which does nothing is returned.
+
+    Args:
+        name (str): The name of the stage.
+        **counts: Item counts known before the stage starts.
+
+    Returns:
+        Stage: The context manager.
+    """
+    if not ENABLED:
+        return _DISABLED_STAGE
+    return Stage(name, counts)
+
+
+def instrumented(name: Optional[str] = None) -> Callable:
+    """
+    Decorator which measures every call of a function as a stage (named after the function by default).
+    """
+    def decorator(func):
+        stage_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with Stage(stage_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_stage():
+    """
+    Returns the innermost stage running in this thread (e.g. to add item counts in a function decorated
+    with instrumented).
+    """
+    stack = _stack() if ENABLED else None
+    return stack[-1] if stack else _DISABLED_STAGE
+
+
+def set_enabled(enabled: bool) -> None:
+    """
+    Enables or disables instrumentation at runtime (e.g. from a benchmark or the UI).
+    """
+    global ENABLED
+    ENABLED = enabled
+
+
+def add_listener(listener: Callable[[dict], None]) -> None:
+    """
+    Registers a function called with every new record (in the thread which ran the stage).
+    """
+    with _lock:
+        _listeners.append(listener)
+
+
+def remove_listener(listener: Callable[[dict], None]) -> None:
+    with _lock:
+        if listener in _listeners:
+            _listeners.remove(listener)
+
+
+def records() -> List[dict]:
+    """
+    Returns the most recent records (oldest first).
+    """
+    with _lock:
+        return list(_records)
+
+
+def latest_records() -> List[dict]:
+    """
+    Returns the most recent record of each stage, in the order in which the stages were first run.
+    """
+    with _lock:
+        return list(_latest.values())
+
+
+def clear() -> None:
+    with _lock:
+        _records.clear()
+        _latest.clear()
+
+
+def _stack() -> list:
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _peak_rss() -> Optional[float]:
+    """
+    Returns the peak resident set size of the process (in MB).
+    """
+    if resource is None:
+        return _peak_working_set() if sys.platform == "win32" else None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def _peak_working_set() -> Optional[float]:
+    """
+    Returns the peak working set size of the process (in MB), the Windows counterpart of the peak resident set size.
+    """
+    counters = _ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    if not _kernel32.K32GetProcessMemoryInfo(_kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize / 2 ** 20
+
+
+def _emit(record: dict) -> None:
+    with _lock:
+        _records.append(record)
+        _latest[record["stage"]] = record
+        listeners = list(_listeners)
+        line = json.dumps(record)
+        if LOG_PATH and LOG_PATH != "-":
+            with open(LOG_PATH, "a") as f:
+                f.write(line + "\n")
+        else:
+            print(line, file=sys.stderr)
+    for listener in listeners:
+        listener(record)
+
+
+def _start_profiler():
+    if PROFILER == "pyinstrument":
+        import pyinstrument
+        profiler = pyinstrument.Profiler()
+    else:
+        profiler = cProfile.Profile()
+    try:
+        profiler.start() if PROFILER == "pyinstrument" else profiler.enable()
+    except ValueError:
+        # another profiler is already active (e.g. a top-level stage in another thread)
+        return None
+    return profiler
+
+
+def _stop_profiler(profiler, name: str) -> None:
+    directory = Path(PROFILE_DIR).expanduser()
+    directory.mkdir(parents=True, exist_ok=True)
+    file_name = f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{threading.get_ident()}"
+    if PROFILER == "pyinstrument":
+        profiler.stop()
+        (directory / (file_name + ".html")).write_text(profiler.output_html())
+    else:
+        profiler.disable()
+        profiler.dump_stats(directory / (file_name + ".prof"))
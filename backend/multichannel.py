@@ -0,0 +1,96 @@
+import copy
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+from backend.recording_analysis import analyze_signal
+
+
+# Channels classified by default (the classification model was trained on ICP pulses)
+CLASSIFIED_CHANNELS = ("icp[mmHg]",)
+
+
+def analyze_channels(data: Dict[str, np.ndarray], fs: float, channels: Iterable[str], segmenter, basic_analyzer,
+                     classifier=None, classified_channels: Iterable[str] = CLASSIFIED_CHANNELS,
+                     reference_channel: Optional[str] = None, cutoff: float = 10,
+                     max_workers: Optional[int] = None) -> Dict[str, Dict[str, np.ndarray]]:
+    """
+    Runs the pulse analysis (see analyze_signal) of several channels of one recording concurrently.
+
+    All channels share the time vector of the recording (data['time']), so the timestamps are converted only once
+    (by load_recording). The channels are analyzed in a thread pool: filtering, segmentation and the pulse metrics
+    spend most of the time in NumPy and SciPy, which release the GIL, so the analysis of all channels takes about
+    as long as the analysis of the slowest one. The channels share the worker processes of the segmenter
+    (segment.processes in params.yaml).
+
+    If reference_channel is given, it is segmented first and its pulse onsets are used for all other channels
+    (e.g. ABP-driven segmentation of ICP), so the pulses of all channels are aligned and the other channels are
+    not segmented.
+
+    Args:
+        data (dict): The signals of the recording (by column name) and the time vector (under the 'time' key),
+            as returned by load_recording.
+        fs (float): The sampling frequency of the recording (in Hz).
+        channels (Iterable[str]): The names of the analyzed columns (missing columns are skipped).
+        segmenter (PulseSegmenter): The segmenter used to detect pulse onsets.
+        basic_analyzer (BasicPulseAnalyzer): The analyzer used to calculate pulse metrics.
+        classifier (PulseClassifier): The classifier used to classify pulses (None - pulses are not classified).
+        classified_channels (Iterable[str]): The channels whose pulses are classified.
+        reference_channel (str): The channel whose pulse onsets are used for all channels (None - each channel
+            is segmented separately).
+        cutoff (float): The cutoff frequency of the lowpass filter (in Hz).
+        max_workers (int): The number of threads (None - one thread per channel, at most one per CPU).
+
+    Returns:
+        dict: The results of analyze_signal for each analyzed channel (by column name).
+    """
+    time = data["time"]
+    channels = [name for name in dict.fromkeys(channels) if data.get(name) is not None]
+    classified_channels = set(classified_channels)
+    if not channels:
+        return {}
+
+    reference_onsets = None
+    results = {}
+    if reference_channel is not None:
+        if data.get(reference_channel) is None:
+            raise ValueError(f"The reference channel {reference_channel} is missing in the recording")
+        results[reference_channel] = analyze_signal(data[reference_channel], time, fs, segmenter, basic_analyzer,
+                                                    classifier if reference_channel in classified_channels else None,
+                                                    cutoff)
+        reference_onsets = np.append(results[reference_channel]["onsets"], len(time) - 1)
+
+    pending = [name for name in channels if name not in results]
+    if pending:
+        max_workers = max_workers or min(len(pending), os.cpu_count() or 1)
+        # the copies share the worker pool of the segmenter; each channel is split into fewer blocks
+        channel_segmenter = copy.copy(segmenter)
+        channel_segmenter.processes = max(1, (segmenter.processes or 1) // min(max_workers, len(pending)))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                name: executor.submit(analyze_signal, data[name], time, fs, channel_segmenter, basic_analyzer,
+                                      classifier if name in classified_channels else None, cutoff, reference_onsets)
+                for name in pending
+            }
+            for name, future in futures.items():
+                results[name] = future.result()
+
+    return {name: results[name] for name in channels if name in results}
+
+
+def analyze_recording(path: str, channels: Iterable[str], segmenter, basic_analyzer, classifier=None,
+                      **kwargs) -> Dict[str, Dict[str, np.ndarray]]:
+    """
+    Loads the selected channels of a recording (.csv or binary, see load_recording) and analyzes them with
+    analyze_channels (keyword arguments are passed to it).
+
+    Returns:
+        dict: The results of analyze_signal for each analyzed channel (by column name).
+    """
+    from backend.recording_io import load_recording
+    channels = list(channels)
+    data, fs = load_recording(path, *channels)
+    return analyze_channels(data, fs, channels, segmenter, basic_analyzer, classifier, **kwargs)
@@ -0,0 +1,222 @@
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+from backend.instrumentation import stage
+from backend.recording_analysis import analyze_pulses
+from backend.signal_processing import filter_signal
+
+
+class ProgressiveAnalysis:
+    """
+    Pulse analysis of a signal (see analyze_signal) done in chunks, starting from the displayed range.
+
+    The exact results need the signal filtered and conditioned for onset detection as a whole (prepare), which takes
+    time proportional to the length of the recording. So the chunk in the viewport is first analyzed alone: the chunk
+    and VIEWPORT_MARGIN seconds on each side of it are filtered and conditioned, and the chunk is segmented with the
+    dominant scale of that window. These provisional results are yielded before the whole signal is prepared. Then
+    the chunks, including the viewport chunk, are segmented, measured and classified in order of their distance from
+    the viewport, and their results replace the provisional ones. The viewport is read before each chunk, so
+    the pulses the user looks at are analyzed first even if the view changes during the analysis.
+
+    The onset detection needs the dominant scale of the whole signal, which is known only when all chunks are
+    counted. Each chunk is segmented with the dominant scale of the chunks counted so far, and when all chunks are
+    done, the chunks segmented with another scale than the final one are analyzed again. Each chunk looks past its
+    end for the onset which ends its last pulse, so the results of all chunks together are the same as the results
+    of analyze_signal.
+    """
+
+    # Length of the signal (in seconds) conditioned on each side of the viewport chunk for its provisional results,
+    # so that the edges of the filters are outside the chunk and the onset which ends its last pulse is found
+    VIEWPORT_MARGIN = 10
+
+    def __init__(self, signal: np.ndarray, time: np.ndarray, fs: float, segmenter, basic_analyzer, classifier=None,
+                 cutoff: float = 10, chunk_duration: float = 300,
+                 viewport: Optional[Callable[[], Optional[Tuple[int, int]]]] = None) -> None:
+        """
+        Initializes a ProgressiveAnalysis instance.
+
+        Args:
+            signal (numpy array): The one-dimensional signal vector.
+            time (numpy array): The one-dimensional time vector corresponding to the signal.
+            fs (float): The sampling frequency of the signal (in Hz).
+            segmenter (PulseSegmenter): The segmenter used to detect pulse onsets.
+            basic_analyzer (BasicPulseAnalyzer): The analyzer used to calculate pulse metrics.
+            classifier (PulseClassifier): The classifier used to classify pulses (None - pulses are not classified).
+            cutoff (float): The cutoff frequency of the lowpass filter (in Hz).
+            chunk_duration (float): The length of the analyzed chunks (in seconds).
+            viewport (callable): Function returning the displayed (start, stop) range of sample indices or None
+                (None - the chunks are analyzed from the beginning of the signal). It is called from the thread
+                running the analysis.
+        """
+        self.signal = signal
+        self.time = time
+        self.fs = fs
+        self.segmenter = segmenter
+        self.basic_analyzer = basic_analyzer
+        self.classifier = classifier
+        self.cutoff = cutoff
+        self.viewport = viewport or (lambda: None)
+
+        n_samples = len(signal)
+        chunk_size = max(int(chunk_duration * fs), 1)
+        self.chunks = [(start, min(start + chunk_size, n_samples)) for start in range(0, n_samples, chunk_size)]
+
+        self.filtered_signal = None
+        self.detection_signal = None
+        self.n_scales = 0
+        self.scale_counts = None
+        # the number of chunks analyzed and the number of chunks to analyze (including the repeated ones)
+        self._done = 0
+        self._total = len(self.chunks)
+
+    @property
+    def progress(self) -> float:
+        """
+        The fraction of chunks analyzed (0-1).
+        """
+        return self._done / self._total if self._total else 1.0
+
+    def prepare(self) -> None:
+        """
+        Filters the whole signal and prepares it for onset detection (called by run if needed).
+        """
+        self.filtered_signal = filter_signal(self.signal, self.fs, self.cutoff)
+        self.detection_signal, self.n_scales = self.segmenter.prepare_detection(self.filtered_signal, self.fs)
+        self.scale_counts = np.zeros(self.n_scales, dtype=np.int64)
+
+    def run(self) -> Iterator[Tuple[int, int, Dict[str, np.ndarray]]]:
+        """
+        Analyzes the chunks in order of their distance from the viewport.
+
+        Yields:
+            start (int): The first sample index of the chunk.
+            stop (int): The sample index after the last sample of the chunk.
+            results (dict): The results of the pulses with onsets in the [start, stop) range (as returned by
+                analyze_signal). A chunk may be yielded again (the viewport chunk after its provisional results,
+                or a chunk analyzed again with the final dominant scale); its new results replace the previous
+                ones (see PulseTable.replace).
+        """
+        if self.detection_signal is None:
+            if self.chunks:
+                self._total += 1
+                index = self._next_chunk(set(range(len(self.chunks))))
+                start, stop = self.chunks[index]
+                results = self._analyze_viewport_chunk(index)
+                self._done += 1
+                yield start, stop, results
+            self.prepare()
+
+        pending = set(range(len(self.chunks)))
+        scales = {}
+        while pending:
+            index = self._next_chunk(pending)
+            pending.remove(index)
+            start, stop = self.chunks[index]
+            self.scale_counts += self.segmenter.count_scale_maxima(self.detection_signal, start, stop, self.n_scales)
+            scales[index] = int(np.argmax(self.scale_counts))
+            results = self._analyze_chunk(index, scales[index])
+            self._done += 1
+            yield start, stop, results
+
+        # all chunks are counted, so the dominant scale is the same as for the whole signal
+        dominant_scale = int(np.argmax(self.scale_counts)) if len(self.scale_counts) else 0
+        repeated = {index for index, scale in scales.items() if scale != dominant_scale}
+        self._total += len(repeated)
+        while repeated:
+            index = self._next_chunk(repeated)
+            repeated.remove(index)
+            start, stop = self.chunks[index]
+            results = self._analyze_chunk(index, dominant_scale)
+            self._done += 1
+            yield start, stop, results
+
+    def _next_chunk(self, indices: set) -> int:
+        """
+        Returns the chunk closest to the current viewport (visible chunks first, closest to its center first).
+        """
+        viewport = self.viewport()
+        if viewport is None:
+            return min(indices)
+        view_start, view_stop = viewport
+        view_center = (view_start + view_stop) / 2
+
+        def distance(index):
+            start, stop = self.chunks[index]
+            gap = max(view_start - stop, start - view_stop, 0)
+            return gap, abs((start + stop) / 2 - view_center)
+
+        return min(indices, key=distance)
+
+    def _analyze_chunk(self, index: int, dominant_scale: int) -> Dict[str, np.ndarray]:
+        """
+        Segments the chunk and analyzes the pulses which start in it.
+        """
+        start, stop = self.chunks[index]
+        with stage("ProgressiveAnalysis.analyze_chunk", samples=stop - start) as measurement:
+            results = self._analyze_range(self.filtered_signal, self.detection_signal, 0, start, stop,
+                                          dominant_scale)
+            measurement.count(pulses=len(results["onsets"]))
+        return results
+
+    def _analyze_viewport_chunk(self, index: int) -> Dict[str, np.ndarray]:
+        """
+        Analyzes the chunk with the signal conditioned only around it (the provisional results, see the class
+        docstring).
+        """
+        start, stop = self.chunks[index]
+        with stage("ProgressiveAnalysis.analyze_viewport_chunk", samples=stop - start) as measurement:
+            margin = int(self.VIEWPORT_MARGIN * self.fs)
+            offset = max(start - margin, 0)
+            end = min(stop + margin, len(self.signal))
+            filtered_signal = filter_signal(self.signal[offset:end], self.fs, self.cutoff)
+            detection_signal, n_scales = self.segmenter.prepare_detection(filtered_signal, self.fs)
+            scale_counts = self.segmenter.count_scale_maxima(detection_signal, start - offset, stop - offset,
+                                                             n_scales)
+            dominant_scale = int(np.argmax(scale_counts)) if len(scale_counts) else 0
+            results = self._analyze_range(filtered_signal, detection_signal, offset, start, stop, dominant_scale)
+            measurement.count(pulses=len(results["onsets"]))
+        return results
+
+    def _analyze_range(self, filtered_signal: np.ndarray, detection_signal: np.ndarray, offset: int, start: int,
+                       stop: int, dominant_scale: int) -> Dict[str, np.ndarray]:
+        """
+        Segments the [start, stop) range of the signal and analyzes the pulses which start in it.
+
+        Args:
+            filtered_signal (numpy array): The filtered signal from the sample offset on.
+            detection_signal (numpy array): The signal prepared for onset detection from the sample offset on.
+            offset (int): The sample index of the first sample of filtered_signal and detection_signal.
+            start (int): The first sample index of the range.
+            stop (int): The sample index after the last sample of the range.
+            dominant_scale (int): The index of the dominant scale.
+
+        Returns:
+            dict: The results of the pulses (as returned by analyze_signal, with sample indices of the whole signal).
+        """
+        onsets = self.segmenter.find_onsets_in_range(detection_signal, start - offset, stop - offset, dominant_scale)
+        if start == 0:
+            # the first pulse starts at the beginning of the signal, as in PulseSegmenter.split_pulses
+            onsets = np.concatenate(([0], onsets))
+        pulse_onsets = np.append(onsets, self._next_onset(detection_signal, stop - offset, dominant_scale))
+        time = self.time[offset:offset + len(filtered_signal)]
+        results = analyze_pulses(filtered_signal, time, pulse_onsets.astype(np.int64), self.basic_analyzer,
+                                 self.classifier, self.fs)
+        results["onsets"] += offset
+        return results
+
+    def _next_onset(self, detection_signal: np.ndarray, position: int, dominant_scale: int) -> int:
+        """
+        Finds the first onset at or after the position (the end of the signal if there is none).
+        """
+        n_samples = len(detection_signal)
+        # a pulse onset is expected approximately every 0.5-1.5 seconds
+        window = max(int(2 * self.fs), 1)
+        while position < n_samples:
+            stop = min(position + window, n_samples)
+            onsets = self.segmenter.find_onsets_in_range(detection_signal, position, stop, dominant_scale)
+            if len(onsets):
+                return int(onsets[0])
+            position = stop
+            window *= 2
+        return n_samples - 1
@@ -0,0 +1,213 @@
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+
+class PulseBatch:
+    """
+    Compact container of pulses of different lengths (a ragged array).
+
+    The pulses are stored as one buffer of values and an array of offsets: pulse i is values[offsets[i]:offsets[i + 1]].
+    The buffer is usually the signal itself and the offsets are the pulse onsets (as returned by
+    PulseSegmenter.split_pulses), so creating a batch copies nothing and the memory used does not grow with
+    the number of pulses beyond one integer per pulse. Per-pulse quantities (lengths, mean values, matrices of
+    pulses) are calculated for all pulses at once.
+
+    A batch can be used like a list of pulses: len, iteration and indexing return views of the buffer, and slicing
+    returns a batch of the selected pulses (sharing the buffer).
+    """
+
+    __slots__ = ("values", "offsets")
+
+    def __init__(self, values: np.ndarray, offsets: np.ndarray) -> None:
+        """
+        Initializes a PulseBatch instance (the values are not copied).
+
+        Args:
+            values (numpy array): The one-dimensional buffer holding the pulses (e.g. the signal vector).
+            offsets (numpy array): The non-decreasing boundaries of the pulses in the buffer (number of pulses + 1).
+        """
+        self.values = np.asarray(values)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_arrays(cls, pulses: List[np.ndarray]) -> "PulseBatch":
+        """
+        Creates a batch from a list of pulse vectors (the pulses are copied to a new buffer).
+        """
+        if isinstance(pulses, PulseBatch):
+            return pulses
+        lengths = np.fromiter((len(pulse) for pulse in pulses), dtype=np.int64, count=len(pulses))
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        values = np.concatenate(pulses) if len(pulses) else np.zeros(0)
+        return cls(values, offsets)
+
+    def __len__(self) -> int:
+        return max(len(self.offsets) - 1, 0)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("PulseBatch supports only contiguous slices")
+            return PulseBatch(self.values, self.offsets[start:max(stop, start) + 1])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("pulse index out of range")
+        return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        values, offsets = self.values, self.offsets
+        for index in range(len(self)):
+            yield values[offsets[index]:offsets[index + 1]]
+
+    @property
+    def starts(self) -> np.ndarray:
+        """
+        The offsets of the first samples of the pulses in the buffer.
+        """
+        return self.offsets[:-1]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """
+        The number of samples of each pulse.
+        """
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The memory used by the offsets (the buffer is usually shared with the signal).
+        """
+        return self.offsets.nbytes
+
+    def with_values(self, values: np.ndarray) -> "PulseBatch":
+        """
+        Returns a batch of the same pulses of another buffer with the same layout (e.g. the time vector).
+        """
+        return PulseBatch(values, self.offsets)
+
+    def means(self) -> np.ndarray:
+        """
+        Returns the mean value of each pulse (NaN for empty pulses), e.g. the mean times of pulses of
+        the time vector.
+        """
+        return self.reduce(np.add, dtype=np.float64) / self.lengths
+
+    def padded(self, length: Optional[int] = None, fill_value: float = np.nan) -> np.ndarray:
+        """
+        Returns the pulses as rows of a matrix, cut or padded with fill_value to the same length.
+
+        Args:
+            length (int): The number of columns (None - the length of the longest pulse).
+            fill_value (float): The value of the samples after the end of shorter pulses.
+
+        Returns:
+            numpy array: Float64 array of shape (number of pulses, length).
+        """
+        lengths = self.lengths
+        if length is None:
+            length = int(lengths.max()) if len(lengths) else 0
+        columns = np.arange(length)
+        inside = columns < lengths[:, np.newaxis]
+        indices = np.where(inside, self.starts[:, np.newaxis] + columns, 0)
+        matrix = np.asarray(self.values, dtype=np.float64)[indices] if len(self.values) else \
+            np.zeros(indices.shape)
+        matrix[~inside] = fill_value
+        return matrix
+
+    def reduce(self, ufunc, transform: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+               empty_value: float = np.nan, dtype=None) -> np.ndarray:
+        """
+        Reduces each pulse with a NumPy ufunc (e.g. np.add, np.fmax). This is the segment reduction used by all
+        per-pulse calculations (means, BasicPulseAnalyzer.batch_calculate_pulse_metrics, analyze_pulses).
+
+        ufunc.reduceat treats each index as the start of a segment that ends at the next index (the last one ends
+        at the end of the array), and it returns the value at the index for a segment of length 0. So the indices
+        of empty pulses are left out (they get empty_value) and the buffer is cut at the end of the last pulse.
+
+        Args:
+            ufunc (numpy ufunc): The reducing function.
+            transform (callable): Function applied to the values before the reduction (e.g. np.isnan); only
+                the part of the buffer holding the pulses is transformed.
+            empty_value (float): The result for empty pulses.
+            dtype (numpy dtype): The type used for the reduction and the result (None - the type of the values).
+
+        Returns:
+            numpy array: One value per pulse.
+        """
+        lengths = self.lengths
+        non_empty = lengths > 0
+        values = self.values[self.offsets[0]:self.offsets[-1]] if len(self.offsets) else self.values[:0]
+        if transform is not None:
+            values = transform(values)
+        result_dtype = dtype if dtype is not None else np.result_type(values.dtype, type(empty_value))
+        result = np.full(len(self), empty_value, dtype=result_dtype)
+        if np.any(non_empty):
+            result[non_empty] = ufunc.reduceat(values, self.starts[non_empty] - self.offsets[0], dtype=dtype)
+        return result
+
+    def groups_by_length(self, indices: Optional[np.ndarray] = None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Groups the pulses of the same length (in order of increasing length).
+
+        Args:
+            indices (numpy array): The indices of the grouped pulses (None - all pulses).
+
+        Yields:
+            positions (numpy array): The positions of the pulses of the group in indices (the indices of
+                the pulses if indices is None).
+            matrix (numpy array): Float64 array of shape (number of pulses in the group, length) with the pulses.
+        """
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices, dtype=np.int64)
+        lengths = self.lengths[indices]
+        starts = self.starts[indices]
+        order = np.argsort(lengths, kind='stable')
+        group_starts = np.flatnonzero(np.diff(lengths[order], prepend=-1))
+        for positions in np.split(order, group_starts[1:]):
+            if len(positions) == 0:
+                continue
+            length = int(lengths[positions[0]])
+            rows = starts[positions][:, np.newaxis] + np.arange(length)
+            yield positions, np.asarray(self.values[rows], dtype=np.float64)
+
+    def resampled(self, n_samples: int,
+                  resampling_matrix: Optional[Callable[[int], np.ndarray]] = None) -> np.ndarray:
+        """
+        Returns the pulses resampled to the same number of samples.
+
+        Args:
+            n_samples (int): The number of samples of each resampled pulse.
+            resampling_matrix (callable): Function returning the (length, n_samples) matrix which resamples a pulse
+                of a given length (e.g. the cubic interpolation of PulseClassifier); None - linear interpolation.
+
+        Returns:
+            numpy array: Float64 array of shape (number of pulses, n_samples).
+        """
+        resampling_matrix = resampling_matrix or _linear_resampling_matrix(n_samples)
+        data = np.full((len(self), n_samples), np.nan)
+        for indices, group in self.groups_by_length():
+            if group.shape[1]:
+                data[indices] = group @ resampling_matrix(group.shape[1])
+        return data
+
+
+def _linear_resampling_matrix(n_samples: int) -> Callable[[int], np.ndarray]:
+    """
+    Returns a function creating the matrices of the linear interpolation of a pulse to n_samples points.
+    """
+    def matrix(length: int) -> np.ndarray:
+        positions = np.linspace(0, length - 1, n_samples)
+        left = np.minimum(np.floor(positions).astype(np.int64), max(length - 2, 0))
+        weights = positions - left
+        result = np.zeros((length, n_samples))
+        columns = np.arange(n_samples)
+        result[left, columns] = 1 - weights
+        if length > 1:
+            result[left + 1, columns] += weights
+        else:
+            result[left, columns] = 1
+        return result
+    return matrix
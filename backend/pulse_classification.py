@@ -1,8 +1,10 @@
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Tuple, Union
 
-import gc
 import yaml
 import torch
 
@@ -10,6 +12,9 @@ import numpy as np
 import scipy.interpolate as sp_int
 
 from backend.classification_model.ResnetModel import ResNet
+from backend.classification_model.inference_backends import INFERENCE_BACKENDS, load_inference_backend
+from backend.instrumentation import stage
+from backend.pulse_batch import PulseBatch
 
 
 class PulseClassifier:
@@ -17,6 +22,15 @@ class PulseClassifier:
     Helper class that performs pulse classification using a residual neural network.
     """
 
+    # Class of artifacts (invalid pulse shapes)
+    ARTIFACT_CLASS = 5
+
+    # Longest pulse (in samples) resampled with a cached interpolation matrix; building the matrix takes
+    # O(length**2) memory, so longer pulses are interpolated directly
+    MAX_MATRIX_LENGTH = 1024
+    # Memory used by the cached interpolation matrices (the least recently used ones are removed above it)
+    MATRIX_CACHE_BYTES = 64 * 2 ** 20
+
     def __init__(self) -> None:
         """
         Initializes a Classifier instance and loads the ResNet neural network model.
@@ -27,6 +41,13 @@ class PulseClassifier:
         self.model_weights = curr_path / self.model_weights
         self.batch_size = self.params["classification"]["batch_size"]
         self.gpu = self.params["classification"]["gpu"]
+        self.prefetch = self.params["classification"]["prefetch"]
+        self.intra_op_threads = self.params["classification"]["intra_op_threads"]
+        self.cuda_cache_limit = self.params["classification"]["cuda_cache_limit"]
+        self.artifact_gate = self.params["classification"]["artifact_gate"]
+
+        if self.intra_op_threads:
+            torch.set_num_threads(self.intra_op_threads)
 
         self.device = torch.device('cuda:' + str(0) if torch.cuda.is_available() and self.gpu else 'cpu')
         self.model = ResNet(5).to(self.device)
@@ -36,6 +57,27 @@ class PulseClassifier:
         self.resampling = True
         self.resampling_samples = 180
         self.normalization = True
+        self._resampling_matrices = OrderedDict()
+        self._resampling_matrices_nbytes = 0
+        # the classifier is shared by threads (e.g. the model loader, analyze_channels and streaming processors)
+        self._resampling_matrices_lock = threading.Lock()
+
+        self.backend = self.params["classification"]["backend"]
+        self.onnx_model = curr_path / self.params["classification"]["onnx_model"]
+        self.inference_model = self._load_backend(self.backend)
+
+    def _load_backend(self, backend: str):
+        """
+        Prepares the model for inference with the given backend (eager, torchscript or onnx).
+
+        Args:
+            backend (str): The name of the inference backend.
+
+        Returns:
+            callable: The model prepared for inference.
+        """
+        return load_inference_backend(backend, self.model, self.device, self.resampling_samples,
+                                      onnx_path=self.onnx_model, weights_path=self.model_weights)
 
     def _load_parameters(self) -> None:
         """
@@ -48,7 +90,9 @@ class PulseClassifier:
             except yaml.YAMLError as exc:
                 print(exc)
 
-    def classify_batch(self, input_pulses: List[np.ndarray]) -> List[int]:
+    def classify_batch(self, input_pulses: Union[PulseBatch, List[np.ndarray]], fs: Optional[float] = None,
+                       edge_pulses: Tuple[bool, bool] = (False, False),
+                       return_gate_counts: bool = False) -> Union[List[int], Tuple[List[int], dict]]:
         """
         Classifies the pulses using the ResNet model.
 
@@ -58,44 +102,139 @@ class PulseClassifier:
         automatic morphological classification of intracranial pressure pulse waveforms using deep learning,”
         IEEE Journal of Biomedical and Health Informatics, vol. 26, no. 2, pp. 494–504, 2022.
 
+        Pulses which are obviously invalid (see gate_artifacts and classification.artifact_gate in params.yaml) are
+        labeled as artifacts without running the model (their number is returned if return_gate_counts is set;
+        the classifier is shared by threads, so it is not stored in the classifier). The other pulses are
+        processed in batches of batch_size. When prefetch is enabled (see params.yaml), the next batch is preprocessed
+        in a background thread while the model runs on the current one.
+
         Args:
-            input_pulses (List[numpy array]): List of one-dimensional vectors corresponding to individual pulses.
+            input_pulses (PulseBatch or List[numpy array]): The pulses (e.g. as returned by
+                PulseSegmenter.split_pulses) or a list of one-dimensional vectors corresponding to individual pulses.
+            fs (float): The sampling frequency of the pulses (in Hz) used to check their duration (None - the duration
+                is not checked).
+            edge_pulses (Tuple[bool, bool]): The flags which determine if the first and the last pulse are the partial
+                segments at the beginning and the end of the recording (as produced by split_pulses).
+            return_gate_counts (bool): The flag which determines if the counts of gated pulses are returned.
 
         Returns:
-            List[int]: List of predicted classes for individual pulses.
+            classes (List[int]): List of predicted classes for individual pulses.
+            gate_counts (dict): The number of pulses labeled by the artifact gate by reason and in total
+                (see gate_artifacts); returned only if return_gate_counts is set.
         """
+        pulses = PulseBatch.from_arrays(input_pulses)
+        gated, gate_counts = self.gate_artifacts(pulses, fs, edge_pulses)
+        classes = np.full(len(pulses), self.ARTIFACT_CLASS, dtype=np.int64)
+        classified = np.flatnonzero(~gated)
+        starts = range(0, len(classified), self.batch_size)
 
-        predictions = []
-        pulses = []
-        for idp in range(0, len(input_pulses)):
-            data = self.preprocess(input_pulses[idp])
-            pulses.append(data)
-            if len(pulses) % self.batch_size == self.batch_size - 1:
-                tensors = torch.tensor(pulses, dtype=torch.float).to(self.device)
-                tensors = tensors.unsqueeze(1)
-                outputs = self.model(tensors).detach().cpu().tolist()
+        with stage("PulseClassifier.classify_batch", pulses=len(pulses), gated=len(pulses) - len(classified),
+                   batches=len(starts)), ThreadPoolExecutor(max_workers=1) as executor, torch.inference_mode():
+            def preprocess_from(start):
+                indices = classified[start:start + self.batch_size]
+                if self.prefetch:
+                    return executor.submit(self.preprocess_batch, pulses, indices)
+                return _Done(self.preprocess_batch(pulses, indices))
 
-                del tensors
-                torch.cuda.empty_cache()
-                gc.collect()
+            next_batch = preprocess_from(0) if len(starts) else None
+            for start in starts:
+                data = next_batch.result()
+                if start + self.batch_size < len(classified):
+                    next_batch = preprocess_from(start + self.batch_size)
 
-                predictions += outputs
-                pulses = []
+                tensors = torch.from_numpy(data).unsqueeze(1).to(self.device)
+                outputs = self.inference_model(tensors)
+                classes[classified[start:start + len(data)]] = outputs.argmax(dim=1).cpu().numpy() + 1
 
-        if len(pulses) > 0:
-            tensors = torch.tensor(pulses, dtype=torch.float).to(self.device)
-            tensors = tensors.unsqueeze(1)
-            outputs = self.model(tensors).detach().cpu().tolist()
+                del tensors, outputs
+                self._release_cached_memory()
 
-            del tensors
-            torch.cuda.empty_cache()
-            gc.collect()
+        if return_gate_counts:
+            return classes.tolist(), gate_counts
+        return classes.tolist()
 
-            predictions += outputs
+    def gate_artifacts(self, pulses: PulseBatch, fs: Optional[float] = None,
+                       edge_pulses: Tuple[bool, bool] = (False, False)) -> Tuple[np.ndarray, dict]:
+        """
+        Finds the pulses which are labeled as artifacts without running the model (see classification.artifact_gate
+        in params.yaml): segments too short to be resampled, pulses of implausible duration, pulses with too many
+        missing samples, flat pulses (for which calculate_pulse_amplitude returns NaN) and the partial segments
+        at the edges of the recording. All checks are done for all pulses at once.
 
-        classes = [np.argmax(prediction) + 1 for prediction in predictions]
+        Args:
+            pulses (PulseBatch): The pulses.
+            fs (float): The sampling frequency of the pulses (in Hz); None - the duration is not checked.
+            edge_pulses (Tuple[bool, bool]): The flags which determine if the first and the last pulse are
+                partial segments at the edges of the recording.
 
-        return classes
+        Returns:
+            gated (numpy array): Boolean vector, True for the pulses labeled as artifacts.
+            counts (dict): The number of gated pulses for each reason (a pulse may have several reasons)
+                and in total.
+        """
+        gate = self.artifact_gate
+        gated = np.zeros(len(pulses), dtype=bool)
+        if not gate["enabled"] or len(pulses) == 0:
+            return gated, {"total": 0}
+
+        lengths = pulses.lengths
+        reasons = {"length": lengths < max(gate["min_length"], 1)}
+        if fs:
+            durations = lengths / fs
+            reasons["duration"] = (durations < gate["min_duration"]) | (durations > gate["max_duration"])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            nan_fractions = pulses.reduce(np.add, np.isnan, 0) / lengths
+            amplitudes = pulses.reduce(np.fmax) - pulses.reduce(np.fmin)
+        reasons["nan"] = nan_fractions > gate["max_nan_fraction"]
+        # all-NaN pulses have a NaN amplitude
+        reasons["amplitude"] = ~(amplitudes > gate["min_amplitude"])
+        if gate["edge_pulses"]:
+            reasons["edge"] = np.zeros(len(pulses), dtype=bool)
+            reasons["edge"][0] |= bool(edge_pulses[0])
+            reasons["edge"][-1] |= bool(edge_pulses[1])
+
+        for reason in reasons.values():
+            gated |= reason
+        counts = {name: int(np.count_nonzero(reason)) for name, reason in reasons.items()}
+        counts["total"] = int(np.count_nonzero(gated))
+        return gated, counts
+
+    def check_backend_parity(self, reference_pulses: List[np.ndarray], backends: List[str] = None) -> dict:
+        """
+        Compares the classes predicted with each inference backend against the eager model.
+
+        Args:
+            reference_pulses (List[numpy array]): List of one-dimensional vectors corresponding to individual pulses.
+            backends (List[str]): The backends to check (all available backends by default).
+
+        Returns:
+            dict: The fraction of reference pulses for which each backend predicts the same class as the eager model.
+        """
+        backends = backends if backends is not None else INFERENCE_BACKENDS
+        selected_model = self.inference_model
+        try:
+            self.inference_model = self.model
+            reference_classes = np.asarray(self.classify_batch(reference_pulses))
+            parity = {}
+            for backend in backends:
+                self.inference_model = self._load_backend(backend)
+                classes = np.asarray(self.classify_batch(reference_pulses))
+                parity[backend] = float(np.mean(classes == reference_classes)) if len(classes) else 1.0
+        finally:
+            self.inference_model = selected_model
+        return parity
+
+    def _release_cached_memory(self) -> None:
+        """
+        Releases the memory cached by the CUDA allocator, but only if the memory reserved on the device exceeds
+        the cuda_cache_limit fraction of the total device memory. Nothing is done for the CPU.
+        """
+        if self.device.type != 'cuda':
+            return
+        reserved = torch.cuda.memory_reserved(self.device)
+        total = torch.cuda.get_device_properties(self.device).total_memory
+        if reserved > self.cuda_cache_limit * total:
+            torch.cuda.empty_cache()
 
     def preprocess(self, pulse: np.ndarray) -> np.ndarray:
         """
@@ -121,4 +260,103 @@ class PulseClassifier:
                 data = data / np.max(data)
         return data
 
+    def preprocess_batch(self, input_pulses: Union[PulseBatch, List[np.ndarray]],
+                         indices: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Performs the preprocessing of a batch of pulses for classification.
+
+        This is the batch version of preprocess. Cubic interpolation is linear in the pulse values, so for each
+        pulse length the interpolation is expressed as a (length, resampling_samples) matrix (cached between calls)
+        and all pulses of that length are resampled with a single matrix product (pulses longer than
+        MAX_MATRIX_LENGTH are interpolated as a group without the matrix). Normalization is done for all
+        pulses at once. The results match preprocess to within float32 rounding (absolute difference of about 3e-8
+        after normalization), except for flat pulses: both functions then normalize only the round-off noise of
+        the interpolation, which differs between them, so the results may differ by up to 1.
+
+        Args:
+            input_pulses (PulseBatch or List[numpy array]): The pulses or a list of one-dimensional vectors
+                corresponding to individual pulses (copied to a PulseBatch).
+            indices (numpy array): The indices of the preprocessed pulses (None - all pulses).
+
+        Returns:
+            numpy array: Float32 array of shape (number of pulses, resampling_samples) with preprocessed pulses.
+        """
+        pulses = PulseBatch.from_arrays(input_pulses)
+        indices = np.arange(len(pulses)) if indices is None else np.asarray(indices, dtype=np.int64)
+        lengths = pulses.lengths[indices]
+        n_samples = self.resampling_samples if self.resampling else (lengths[0] if len(lengths) else 0)
+        data = np.empty((len(indices), n_samples), dtype=np.float32)
+
+        for positions, group in pulses.groups_by_length(indices):
+            if self.resampling:
+                group = self._resample_group(group)
+            if self.normalization:
+                group = group - np.min(group, axis=1, keepdims=True)
+                group_max = np.max(group, axis=1, keepdims=True)
+                np.divide(group, group_max, out=group, where=group_max != 0)
+            data[positions] = group
+
+        return data
+
+    def _resample_group(self, group: np.ndarray) -> np.ndarray:
+        """
+        Performs the cubic interpolation of pulses of the same length to resampling_samples points (the same
+        interpolation as in preprocess).
+
+        Args:
+            group (numpy array): Array of shape (number of pulses, length) with the pulses.
+
+        Returns:
+            numpy array: Array of shape (number of pulses, resampling_samples).
+        """
+        length = group.shape[1]
+        if length <= self.MAX_MATRIX_LENGTH:
+            return group @ self._resampling_matrix(length)
+        new_t = np.linspace(0, length - 1, self.resampling_samples)
+        spline = sp_int.make_interp_spline(np.arange(0, length, 1), group.T, k=3, axis=0)
+        return spline(new_t).T
+
+    def _resampling_matrix(self, length: int) -> np.ndarray:
+        """
+        Returns the matrix which performs the cubic interpolation of a pulse of a given length
+        to resampling_samples points. The matrices are kept in a least recently used cache limited
+        to MATRIX_CACHE_BYTES.
+
+        Args:
+            length (int): The number of samples in the pulse.
+
+        Returns:
+            numpy array: Array of shape (length, resampling_samples).
+        """
+        with self._resampling_matrices_lock:
+            matrix = self._resampling_matrices.get(length)
+            if matrix is not None:
+                self._resampling_matrices.move_to_end(length)
+                return matrix
+
+        # the matrix is built outside the lock (another thread may build the same matrix at the same time)
+        new_t = np.linspace(0, length - 1, self.resampling_samples)
+        spline = sp_int.make_interp_spline(np.arange(0, length, 1), np.eye(length), k=3, axis=0)
+        matrix = np.ascontiguousarray(spline(new_t).T)
+
+        with self._resampling_matrices_lock:
+            if length not in self._resampling_matrices:
+                self._resampling_matrices[length] = matrix
+                self._resampling_matrices_nbytes += matrix.nbytes
+            while self._resampling_matrices_nbytes > self.MATRIX_CACHE_BYTES and len(self._resampling_matrices) > 1:
+                _, removed = self._resampling_matrices.popitem(last=False)
+                self._resampling_matrices_nbytes -= removed.nbytes
+        return matrix
+
+
+class _Done:
+    """
+    Completed result with the same interface as a Future (used when prefetching is disabled).
+    """
+
+    def __init__(self, value) -> None:
+        self.value = value
+
+    def result(self):
+        return self.value
 
@@ -1,8 +1,20 @@
 import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
 
+import yaml
 import numpy as np
 import scipy.signal as sp_sig
 
+from backend.instrumentation import current_stage, instrumented, stage
+from backend.pulse_batch import PulseBatch
+from backend.signal_processing import fill_missing, lowpass_sos
+
 
 class PulseSegmenter:
     """
@@ -13,7 +25,23 @@ class PulseSegmenter:
         """
         Initializes a Segmenter instance.
         """
-        pass
+        self._load_parameters()
+        self.block_size = self.params["segment"]["block_size"]
+        self.processes = self.params["segment"]["processes"]
+        self.min_parallel_samples = self.params["segment"]["min_parallel_samples"]
+        # shared by copies of the segmenter (e.g. the channel segmenters of analyze_channels)
+        self._worker_pool = _WorkerPool(self.processes)
+
+    def _load_parameters(self) -> None:
+        """
+        Loads the parameters of the segmentation from file.
+        """
+        params_path = Path(os.path.dirname(__file__)) / 'params.yaml'
+        with open(params_path, 'r') as stream:
+            try:
+                self.params = yaml.safe_load(stream)
+            except yaml.YAMLError as exc:
+                print(exc)
 
     def split_pulses(self, signal: np.ndarray, time: np.ndarray, fs: float, use_mean_time: bool = False):
         """
@@ -22,7 +50,8 @@ class PulseSegmenter:
         This function splits the input signal into segments corresponding to individual pulses based on the results
         of pulse onset detection. Each pulse is represented by a fragment of the signal vector and a fragment of the
         time vector (use_mean_time = False) or a single point in time corresponding to mean of the time segment
-        (use_mean_time = True).
+        (use_mean_time = True). The fragments are returned as PulseBatch objects, which hold the pulse onsets and
+        views of the signal and time vectors (nothing is copied) and can be used like lists of pulses.
 
         Args:
             signal (numpy array): The one-dimensional signal vector.
@@ -32,31 +61,33 @@ class PulseSegmenter:
                 vector (use_mean_time = False) or a single point (use_mean_time = True) for each pulse.
 
         Returns:
-            pulses (List[numpy array]): List of segments of the signal vector corresponding to individual pulses.
-            times (List[numpy array] or List[float]): List of segments of the time vector corresponding
-                to individual pulses or list of mean time points for individual pulses.
-            pulse_onsets (List[int]): List of indices of detected pulse onset points in the signal vector.
+            pulses (PulseBatch): Segments of the signal vector corresponding to individual pulses.
+            times (PulseBatch or numpy array): Segments of the time vector corresponding to individual pulses
+                or mean time points for individual pulses.
+            pulse_onsets (numpy array): The indices of detected pulse onset points in the signal vector (including
+                the first and the last sample).
         """
 
-        pulse_onsets = self._detect_pulses_in_signal(signal, fs)
-        pulse_onsets = np.concatenate(([0], pulse_onsets, [len(signal) - 1]))
+        with stage("PulseSegmenter.split_pulses", samples=len(signal)) as measurement:
+            pulse_onsets = self._detect_pulses_in_signal(signal, fs)
+            pulse_onsets = np.concatenate(([0], pulse_onsets, [len(signal) - 1])).astype(np.int64)
 
-        pulses = [signal[pulse_onsets[i]: pulse_onsets[i + 1]] for i in range(len(pulse_onsets) - 1)]
-
-        if use_mean_time:
-            times = [np.mean(time[pulse_onsets[i]: pulse_onsets[i + 1]]) for i in range(len(pulse_onsets) - 1)]
-        else:
-            times = [time[pulse_onsets[i]: pulse_onsets[i + 1]] for i in range(len(pulse_onsets) - 1)]
+            pulses = PulseBatch(signal, pulse_onsets)
+            times = pulses.with_values(time)
+            if use_mean_time:
+                times = times.means()
+            measurement.count(pulses=len(pulses))
 
         return pulses, times, pulse_onsets
 
+    @instrumented("PulseSegmenter.detect_pulses_in_signal")
     def _detect_pulses_in_signal(self, signal: np.ndarray, fs: float) -> np.ndarray:
         """
         Detects pulse onset points in a signal.
 
         This function takes a signal and its sampling frequency as input and detects the onset point for each individual
         pulse. Prior to pulse onset detection, the signal is low-pass filtered (up to 10 Hz) and detrended to improve
-        accuracy.
+        accuracy. The input signal is not modified (missing samples are replaced with the mean value in a copy).
 
         Args:
             signal (numpy array): The one-dimensional signal vector.
@@ -66,33 +97,88 @@ class PulseSegmenter:
             numpy array: The indices of detected pulse onset points in the signal vector.
         """
 
-        mean_signal = np.nanmean(signal)
-        signal[np.argwhere(np.isnan(signal))] = mean_signal
-
-        detrended_signal = sp_sig.detrend(signal)
-
-        filter_critical_coefficient = 10
-        filter_order = 6
-        filter_max_ripple = 60
-        filter_min_attenuation = 1
-        filter_btype = 'lowpass'
-        filter_ftype = 'cheby1'
-        Wc1 = filter_critical_coefficient / fs
-        b1, a1 = sp_sig.iirfilter(N=filter_order, Wn=Wc1, btype=filter_btype,
-            rs=filter_max_ripple, rp=filter_min_attenuation, ftype=filter_ftype)
-        filtered_signal = sp_sig.filtfilt(b1, a1, detrended_signal)
-
         # Note: The signal is passed to the actual detection algorithm in an inverted version so that the pulse onset
         # points are detected as maxima rather than minima (which improves accuracy). The max_scale parameter
         # is set to sampling frequency (i.e. the number of samples per second) because in humans, a pulse onset
         # is expected approximately every 0.5-1.5 seconds and max_scale limits the search range to 1 second
         # (which limits the processing time).
-        signal_peaks = self._detect_peaks_troughs(-filtered_signal, max_scale=fs)
+        inverted_signal = self._condition_signal(signal, fs)
+        signal_peaks = self._detect_peaks_troughs(inverted_signal, max_scale=fs, overwrite_input=True)
         pulse_onsets = signal_peaks[:, 0]
 
         return pulse_onsets
 
-    def _detect_peaks_troughs(self, signal: np.ndarray, max_scale: float = 0) -> np.ndarray:
+    def _condition_signal(self, signal: np.ndarray, fs: float) -> np.ndarray:
+        """
+        Prepares a signal for pulse onset detection: replaces missing samples with the mean value, low-pass filters
+        the signal (up to 5 Hz) and inverts it. The input signal is not modified.
+
+        Args:
+            signal (numpy array): The one-dimensional signal vector.
+            fs (float): The sampling frequency of the signal (in Hz).
+
+        Returns:
+            numpy array: The filtered and inverted signal (a new array).
+        """
+        signal = fill_missing(np.asarray(signal, dtype=np.float64))
+
+        # Normalized cutoff frequency of 10 / fs, i.e. 5 Hz
+        filter_cutoff = 5
+        filter_order = 6
+        # The signal is detrended once, after filtering (in _detect_peaks_troughs): the filter is linear and passes
+        # a linear trend as a linear trend, so detrending before filtering would not change the result
+        filtered_signal = sp_sig.sosfiltfilt(lowpass_sos(float(fs), filter_cutoff, filter_order), signal)
+        return np.negative(filtered_signal, out=filtered_signal)
+
+    def prepare_detection(self, signal: np.ndarray, fs: float):
+        """
+        Prepares a signal for pulse onset detection in parts (see count_scale_maxima and find_onsets_in_range).
+
+        Together, these functions run the same algorithm as _detect_pulses_in_signal, but let the caller choose
+        the order of the processed ranges (e.g. the displayed part of a recording first). The conditioning
+        (filtering and detrending) is done for the whole signal, so the onsets found in any range are the same as
+        the onsets found in the whole signal, provided that the dominant scale is the same.
+
+        Args:
+            signal (numpy array): The one-dimensional signal vector.
+            fs (float): The sampling frequency of the signal (in Hz).
+
+        Returns:
+            detection_signal (numpy array): The filtered, inverted and detrended signal.
+            n_scales (int): The maximum number of scales (L), as used by _detect_peaks_troughs for max_scale = fs.
+        """
+        with stage("PulseSegmenter.prepare_detection", samples=len(signal)):
+            detection_signal = sp_sig.detrend(self._condition_signal(signal, fs), overwrite_data=True)
+        return detection_signal, max(math.ceil(fs / 2) - 1, 0)
+
+    @staticmethod
+    def count_scale_maxima(detection_signal: np.ndarray, start: int, stop: int, n_scales: int) -> np.ndarray:
+        """
+        Counts the local maxima in the [start, stop) range of a signal returned by prepare_detection separately
+        for scales 1 to n_scales. The counts summed over all ranges covering the signal are the same as in the first
+        pass of _detect_peaks_troughs, and the dominant scale is their argmax.
+        """
+        return _count_scale_maxima(detection_signal, start, stop, n_scales)
+
+    @staticmethod
+    def find_onsets_in_range(detection_signal: np.ndarray, start: int, stop: int, dominant_scale: int) -> np.ndarray:
+        """
+        Finds the pulse onsets in the [start, stop) range of a signal returned by prepare_detection.
+
+        Args:
+            detection_signal (numpy array): The signal returned by prepare_detection.
+            start (int): The first index of the range.
+            stop (int): The index after the last index of the range.
+            dominant_scale (int): The index of the dominant scale (argmax of the counts of local maxima).
+
+        Returns:
+            numpy array: The indices of detected pulse onset points in the signal vector.
+        """
+        return _find_block_peaks(detection_signal, start, stop, int(dominant_scale) + 1)
+
+    @instrumented("PulseSegmenter.detect_peaks_troughs")
+    def _detect_peaks_troughs(self, signal: np.ndarray, max_scale: float = 0,
+                              overwrite_input: bool = False) -> np.ndarray:
         """
         Detects local maxima in a signal.
 
@@ -102,9 +188,17 @@ class PulseSegmenter:
         This functions takes a signal and a scale value (which is approximately equivalent to the search range
         expressed in samples) as input and detects the local maxima in the signal.
 
+        The local maxima scalogram is never built as a whole. The signal is processed in blocks of at most
+        block_size samples (see params.yaml), and each block reads up to L samples on each side of it, so the
+        neighbourhood of every sample is the same as for the whole signal. The first pass only counts the maxima
+        at each scale (to find the dominant scale) and the second pass keeps the running "maximum at all scales"
+        state for each block, which limits the working set to O(block_size) instead of O(N * L). For signals longer
+        than min_parallel_samples, the blocks are processed by a pool of segment.processes worker processes.
+
         Args:
             signal (numpy array): The one-dimensional signal vector.
             max_scale (float): The maximum search range (in samples).
+            overwrite_input (bool): The flag which determines if the signal may be detrended in place.
 
         Returns:
             numpy array: The indices of detected local maxima in the signal vector.
@@ -115,20 +209,204 @@ class PulseSegmenter:
         else:
             L = math.ceil(N / 2) - 1
 
-        detrended_signal = sp_sig.detrend(signal)
+        detrended_signal = sp_sig.detrend(signal, overwrite_data=overwrite_input)
+
+        processes = self.processes if self.processes and N >= self.min_parallel_samples else 1
+        blocks = self._split_into_blocks(N, processes)
+        current_stage().count(samples=N, blocks=len(blocks), processes=processes)
+        if processes > 1 and len(blocks) > 1:
+            peaks = self._find_peaks_parallel(detrended_signal, blocks, L, processes)
+        else:
+            def map_blocks(func, n_scales):
+                return (func(detrended_signal, start, stop, n_scales) for start, stop in blocks)
+            peaks = self._find_peaks(map_blocks, L)
+
+        return peaks[:, np.newaxis]
 
-        Mx = np.zeros((N, L), dtype=np.float32)
-        for kk in range(1, L + 1):
-            right = detrended_signal[kk:-kk - 1] > detrended_signal[2*kk:-1]
-            left = detrended_signal[kk:-kk - 1] > detrended_signal[:-2*kk-1]
-            Mx[kk:-kk-1, kk-1] = np.logical_and(left, right)
+    def _find_peaks(self, map_blocks, n_scales: int) -> np.ndarray:
+        """
+        Runs both passes of the blockwise peak detection.
 
-        dx = np.argmax(np.sum(Mx, 0))
-        Mx = Mx[:, :dx + 1]
+        Args:
+            map_blocks (callable): Function which takes a block function and a number of scales and returns
+                the results of the block function for consecutive blocks (in order).
+            n_scales (int): The maximum number of scales (L).
 
-        _, col_count = Mx.shape
-        Zx = col_count - np.count_nonzero(Mx, axis=1)
-        peaks = np.argwhere(Zx == 0)
+        Returns:
+            numpy array: The indices of detected local maxima in the signal vector.
+        """
+        scale_counts = np.zeros(n_scales, dtype=np.int64)
+        for block_counts in map_blocks(_count_scale_maxima, n_scales):
+            scale_counts += block_counts
+        dx = np.argmax(scale_counts)
 
+        peaks = list(map_blocks(_find_block_peaks, dx + 1))
+        return np.concatenate(peaks) if peaks else np.zeros(0, dtype=np.int64)
+
+    def _find_peaks_parallel(self, detrended_signal: np.ndarray, blocks: list, n_scales: int,
+                             processes: int) -> np.ndarray:
+        """
+        Runs the blockwise peak detection in the pool of worker processes of the segmenter.
+
+        The detrended signal is placed in shared memory once and the worker processes only receive its name and
+        the block boundaries. Results are collected in block order, so the output is the same as for a single
+        process. The pool is created on first use and reused by later calls (see _WorkerPool).
+
+        Args:
+            detrended_signal (numpy array): The one-dimensional detrended signal vector.
+            blocks (list): List of (start, stop) index pairs covering the whole signal.
+            n_scales (int): The maximum number of scales (L).
+            processes (int): The number of worker processes.
+
+        Returns:
+            numpy array: The indices of detected local maxima in the signal vector.
+        """
+        shm = SharedMemory(create=True, size=max(detrended_signal.nbytes, 1))
+        try:
+            shared_signal = np.ndarray(detrended_signal.shape, dtype=np.float64, buffer=shm.buf)
+            shared_signal[:] = detrended_signal
+            starts = [start for start, _ in blocks]
+            stops = [stop for _, stop in blocks]
+            executor = self._worker_pool.executor()
+
+            def map_blocks(func, n_scales):
+                return executor.map(_run_on_shared_signal, repeat(func), repeat(shm.name),
+                                    repeat(detrended_signal.shape), starts, stops, repeat(n_scales))
+            peaks = self._find_peaks(map_blocks, n_scales)
+            del shared_signal
+        finally:
+            shm.close()
+            shm.unlink()
         return peaks
 
+    def close(self) -> None:
+        """
+        Shuts down the worker processes of the segmenter (they are started again when needed).
+        """
+        self._worker_pool.shutdown()
+
+    def _split_into_blocks(self, n_samples: int, n_parts: int = 1) -> list:
+        """
+        Divides the range of sample indices into consecutive blocks used by the peak detection algorithm.
+
+        Args:
+            n_samples (int): The number of samples in the signal.
+            n_parts (int): The minimum number of blocks (e.g. the number of worker processes).
+
+        Returns:
+            list: List of (start, stop) index pairs covering the whole signal.
+        """
+        block_size = self.block_size if self.block_size else n_samples
+        block_size = min(block_size, math.ceil(n_samples / n_parts))
+        block_size = max(int(block_size), 1)
+        return [(start, min(start + block_size, n_samples)) for start in range(0, n_samples, block_size)]
+
+
+class _WorkerPool:
+    """
+    Lazily created pool of worker processes used by the parallel peak detection.
+
+    The processes are started with the spawn method: split_pulses may be called from threads (e.g. by
+    analyze_channels or the GUI), and forking a multithreaded process may copy locks held by other threads.
+    Starting the pool once per segmenter instead of once per call also avoids paying the start-up of the
+    processes for every signal.
+    """
+
+    def __init__(self, processes: int) -> None:
+        self.processes = max(int(processes or 1), 1)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+def _run_on_shared_signal(func, name: str, shape: tuple, start: int, stop: int, n_scales: int) -> np.ndarray:
+    """
+    Runs a block function on the signal shared with the worker process.
+
+    The worker attaches to the shared memory block only for the duration of the task, so idle workers keep no
+    handle of it (on Windows, the block is freed only when its last handle is closed).
+    """
+    shared_memory = SharedMemory(name=name)
+    shared_signal = np.ndarray(shape, dtype=np.float64, buffer=shared_memory.buf)
+    try:
+        return func(shared_signal, start, stop, n_scales)
+    finally:
+        del shared_signal
+        shared_memory.close()
+
+
+def _scale_maxima(detrended_signal: np.ndarray, start: int, stop: int, kk: int) -> np.ndarray:
+    """
+    Checks which samples in the [start, stop) range are local maxima at a given scale, i.e. are greater than both
+    samples kk positions away. Samples for which the comparison is not defined (at the signal edges) are never maxima.
+
+    Args:
+        detrended_signal (numpy array): The one-dimensional detrended signal vector.
+        start (int): The first index of the range.
+        stop (int): The index after the last index of the range.
+        kk (int): The scale (in samples).
+
+    Returns:
+        numpy array: Boolean vector of length stop - start.
+    """
+    N = len(detrended_signal)
+    is_max = np.zeros(stop - start, dtype=bool)
+    lo = max(start, kk)
+    hi = min(stop, N - kk - 1)
+    if lo < hi:
+        center = detrended_signal[lo:hi]
+        np.greater(center, detrended_signal[lo + kk:hi + kk], out=is_max[lo - start:hi - start])
+        is_max[lo - start:hi - start] &= center > detrended_signal[lo - kk:hi - kk]
+    return is_max
+
+
+def _count_scale_maxima(detrended_signal: np.ndarray, start: int, stop: int, n_scales: int) -> np.ndarray:
+    """
+    Counts the local maxima in the [start, stop) range separately for scales 1 to n_scales.
+
+    Args:
+        detrended_signal (numpy array): The one-dimensional detrended signal vector.
+        start (int): The first index of the range.
+        stop (int): The index after the last index of the range.
+        n_scales (int): The number of scales.
+
+    Returns:
+        numpy array: The number of local maxima for each scale.
+    """
+    counts = np.zeros(n_scales, dtype=np.int64)
+    for kk in range(1, n_scales + 1):
+        counts[kk - 1] = np.count_nonzero(_scale_maxima(detrended_signal, start, stop, kk))
+    return counts
+
+
+def _find_block_peaks(detrended_signal: np.ndarray, start: int, stop: int, n_scales: int) -> np.ndarray:
+    """
+    Finds the samples in the [start, stop) range which are local maxima at all scales from 1 to n_scales.
+
+    Args:
+        detrended_signal (numpy array): The one-dimensional detrended signal vector.
+        start (int): The first index of the range.
+        stop (int): The index after the last index of the range.
+        n_scales (int): The number of scales.
+
+    Returns:
+        numpy array: The indices of detected local maxima in the signal vector.
+    """
+    all_scales = np.ones(stop - start, dtype=bool)
+    for kk in range(1, n_scales + 1):
+        all_scales &= _scale_maxima(detrended_signal, start, stop, kk)
+        if not all_scales.any():
+            break
+    return np.flatnonzero(all_scales) + start
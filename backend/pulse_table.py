@@ -0,0 +1,134 @@
+from typing import Dict, Optional
+
+import numpy as np
+
+from backend.trend_summary import TrendSummary
+
+
+class PulseTable:
+    """
+    Helper class that holds the analysis results of a recording (one row per pulse) in contiguous arrays sorted
+    by pulse start time, so that the pulse at a given time is found by binary search.
+
+    The windowed summaries of the pulses (trends, see TrendSummary) are updated together with the rows.
+    """
+
+    # Names and types of the columns (the keys of analyze_signal results)
+    COLUMNS = {
+        "onsets": np.int64,
+        "start_times": np.float64,
+        "end_times": np.float64,
+        "means": np.float64,
+        "amplitudes": np.float64,
+        "slopes": np.float64,
+        "classes": np.int64,
+    }
+
+    def __init__(self, results: Optional[Dict[str, np.ndarray]] = None) -> None:
+        """
+        Initializes a PulseTable instance.
+
+        Args:
+            results (dict): The results with one value per pulse (as returned by analyze_signal); other keys
+                are ignored. None - an empty table.
+        """
+        self.columns = self._to_columns(results or {})
+        self.trends = TrendSummary()
+        self.trends.add(self.columns)
+
+    @classmethod
+    def _to_columns(cls, results: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        """
+        Converts results to the columns of the table, sorted by start time.
+        """
+        n_pulses = len(results.get("onsets", ()))
+        # missing columns are filled with NaN (metrics) or 0 (onsets and classes)
+        columns = {name: np.ascontiguousarray(results[name], dtype=dtype) if name in results
+                   else np.full(n_pulses, np.nan if dtype is np.float64 else 0, dtype=dtype)
+                   for name, dtype in cls.COLUMNS.items()}
+        order = np.argsort(columns["start_times"], kind="stable")
+        if np.any(order != np.arange(len(order))):
+            columns = {name: values[order] for name, values in columns.items()}
+        return columns
+
+    def __len__(self) -> int:
+        return len(self.columns["onsets"])
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def find(self, time: float) -> int:
+        """
+        Finds the pulse which contains the time point.
+
+        Args:
+            time (float): The time point (in seconds).
+
+        Returns:
+            int: The index of the pulse (start_time <= time < end_time) or -1 if there is no such pulse.
+        """
+        index = int(np.searchsorted(self.columns["start_times"], time, side="right")) - 1
+        if index < 0 or time >= self.columns["end_times"][index]:
+            return -1
+        return index
+
+    def find_range(self, start_time: float, end_time: float) -> slice:
+        """
+        Returns the rows of pulses which start in the [start_time, end_time) range.
+        """
+        start_times = self.columns["start_times"]
+        return slice(int(np.searchsorted(start_times, start_time, side="left")),
+                     int(np.searchsorted(start_times, end_time, side="left")))
+
+    def row(self, index: int) -> dict:
+        """
+        Returns the values of a single pulse (by column name, as Python numbers).
+        """
+        return {name: values[index].item() for name, values in self.columns.items()}
+
+    def extend(self, results: Dict[str, np.ndarray]) -> None:
+        """
+        Adds pulses to the table (e.g. results of the next part of the recording). Pulses with onsets which
+        are already in the table replace the existing rows.
+        """
+        added = self._to_columns(results)
+        if len(added["onsets"]) == 0:
+            return
+        kept = ~np.isin(self.columns["onsets"], added["onsets"])
+        self.trends.remove({name: values[~kept] for name, values in self.columns.items()})
+        self.trends.add(added)
+        start_times = np.concatenate((self.columns["start_times"][kept], added["start_times"]))
+        order = np.argsort(start_times, kind="stable")
+        self.columns = {name: np.concatenate((values[kept], added[name]))[order]
+                        for name, values in self.columns.items()}
+
+    def replace(self, start: int, stop: int, results: Dict[str, np.ndarray]) -> None:
+        """
+        Replaces the pulses with onsets in the [start, stop) range of sample indices with new results (e.g. the part
+        of the recording analyzed again with another dominant scale, see ProgressiveAnalysis).
+
+        The onsets of the table are sorted (as the start times are), so the replaced rows are found by binary
+        search and the other rows are copied once, without sorting.
+        """
+        added = self._to_columns(results)
+        onsets = self.columns["onsets"]
+        first = int(np.searchsorted(onsets, start, side="left"))
+        last = int(np.searchsorted(onsets, stop, side="left"))
+        self.trends.remove({name: values[first:last] for name, values in self.columns.items()})
+        self.trends.add(added)
+        self.columns = {name: np.concatenate((values[:first], added[name], values[last:]))
+                        for name, values in self.columns.items()}
+
+    def to_dict(self) -> Dict[str, np.ndarray]:
+        return dict(self.columns)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        Returns the columns and the trend summaries as named arrays, e.g. to store them in the ResultCache
+        (a table created from them has the same rows; its trends are summarized again from the rows).
+        """
+        return {**self.columns, **self.trends.to_arrays()}
+
+    @property
+    def nbytes(self) -> int:
+        return sum(values.nbytes for values in self.columns.values()) + self.trends.nbytes
@@ -0,0 +1,86 @@
+from typing import Dict
+
+import numpy as np
+
+from backend.pulse_batch import PulseBatch
+from backend.signal_processing import filter_signal
+
+
+def analyze_signal(signal: np.ndarray, time: np.ndarray, fs: float, segmenter, basic_analyzer, classifier=None,
+                   cutoff: float = 10, pulse_onsets: np.ndarray = None) -> Dict[str, np.ndarray]:
+    """
+    Runs the whole pulse analysis of a signal: filtering, segmentation, basic pulse metrics and classification.
+
+    Args:
+        signal (numpy array): The one-dimensional signal vector.
+        time (numpy array): The one-dimensional time vector corresponding to the signal.
+        fs (float): The sampling frequency of the signal (in Hz).
+        segmenter (PulseSegmenter): The segmenter used to detect pulse onsets.
+        basic_analyzer (BasicPulseAnalyzer): The analyzer used to calculate pulse metrics.
+        classifier (PulseClassifier): The classifier used to classify pulses (None - pulses are not classified).
+        cutoff (float): The cutoff frequency of the lowpass filter (in Hz).
+        pulse_onsets (numpy array): The pulse boundaries (as returned by PulseSegmenter.split_pulses) used instead
+            of segmenting this signal, e.g. the onsets detected in another channel of the same recording.
+
+    Returns:
+        dict: The results with one value per pulse: onsets (indices of the first samples of pulses in the signal
+            vector), start_times, end_times, mean_times, means, amplitudes, slopes and classes (0 if no classifier
+            is used).
+    """
+    filtered_signal = filter_signal(signal, fs, cutoff)
+    if pulse_onsets is None:
+        _, _, pulse_onsets = segmenter.split_pulses(filtered_signal, time, fs)
+    return analyze_pulses(filtered_signal, time, pulse_onsets, basic_analyzer, classifier, fs)
+
+
+def analyze_pulses(filtered_signal: np.ndarray, time: np.ndarray, pulse_onsets: np.ndarray, basic_analyzer,
+                   classifier=None, fs: float = None) -> Dict[str, np.ndarray]:
+    """
+    Calculates the metrics and classes of pulses of a filtered signal.
+
+    Each pulse is analyzed separately, so pulse_onsets may cover only a part of the signal (e.g. the displayed
+    range, see ProgressiveAnalysis) and the results are the same as for these pulses in the whole signal.
+
+    Args:
+        filtered_signal (numpy array): The one-dimensional filtered signal vector.
+        time (numpy array): The one-dimensional time vector corresponding to the signal.
+        pulse_onsets (numpy array): The pulse boundaries (pulse i spans pulse_onsets[i]:pulse_onsets[i + 1]).
+        basic_analyzer (BasicPulseAnalyzer): The analyzer used to calculate pulse metrics.
+        classifier (PulseClassifier): The classifier used to classify pulses (None - pulses are not classified).
+        fs (float): The sampling frequency of the signal (in Hz) used by the artifact gate of the classifier.
+
+    Returns:
+        dict: The results with one value per pulse, as returned by analyze_signal.
+    """
+    pulse_onsets = np.asarray(pulse_onsets, dtype=np.int64)
+    # only the analyzed range of the signal is processed (the metrics are reductions over the signal up to the last
+    # boundary), so that analyzing a part of a long recording is not proportional to its position in the recording
+    first = int(pulse_onsets[0]) if len(pulse_onsets) else 0
+    last = int(pulse_onsets[-1]) + 1 if len(pulse_onsets) else 0
+    # the segments before the first and after the last onset of the signal are not whole pulses
+    edge_pulses = (first == 0, last == len(filtered_signal))
+    filtered_signal = filtered_signal[first:last]
+    time = time[first:last]
+    pulse_onsets = pulse_onsets - first
+    means, amplitudes, slopes = basic_analyzer.batch_calculate_pulse_metrics(filtered_signal, time, pulse_onsets)
+
+    pulses = PulseBatch(filtered_signal, pulse_onsets)
+    # empty pulses (NaN mean time) are placed at their onset
+    mean_times = pulses.with_values(time).means()
+    mean_times = np.where(pulses.lengths > 0, mean_times, time[pulses.starts])
+
+    if classifier is not None:
+        classes = np.asarray(classifier.classify_batch(pulses, fs, edge_pulses), dtype=np.int64)
+    else:
+        classes = np.zeros(len(pulses), dtype=np.int64)
+
+    return {
+        "onsets": np.asarray(pulse_onsets[:-1] + first, dtype=np.int64),
+        "start_times": time[pulse_onsets[:-1]],
+        "end_times": time[pulse_onsets[1:]],
+        "mean_times": mean_times,
+        "means": means,
+        "amplitudes": amplitudes,
+        "slopes": slopes,
+        "classes": classes,
+    }
@@ -0,0 +1,160 @@
+import argparse
+import json
+import os
+import struct
+from pathlib import Path
+from typing import Dict, Tuple
+
+import numpy as np
+
+from backend.signal_processing import convert_datetime_to_time
+
+
+# Binary recording layout:
+#   8 bytes      magic (BINARY_MAGIC)
+#   8 bytes      header length (little-endian unsigned 64-bit integer)
+#   header       UTF-8 JSON: {"n_samples": int, "fs": float, "columns": [name, ...]}
+#   padding      up to a multiple of BINARY_ALIGNMENT bytes
+#   data         one contiguous little-endian float64 array of n_samples values per column, in the header order
+BINARY_SUFFIX = '.icpb'
+BINARY_MAGIC = b'ICPBIN01'
+BINARY_ALIGNMENT = 64
+
+DATETIME_COLUMN = 'DateTime'
+TIME_COLUMN = 'time'
+
+
+def is_binary_recording(path: str) -> bool:
+    """
+    Checks if the file is a recording in the binary format (based on the file content, not the extension).
+
+    Args:
+        path (str): The path of the recording file.
+
+    Returns:
+        bool: True if the file is a binary recording.
+    """
+    with open(path, 'rb') as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def load_recording(path: str, *column_names: str, multi_day: bool = True) -> Tuple[Dict[str, np.ndarray], float]:
+    """
+    Loads the selected columns of a recording together with the time vector.
+
+    This function accepts both ICM+ CSV files and recordings converted to the binary format
+    (see convert_csv_to_binary). Binary recordings are memory-mapped (copy-on-write, so changes made to the arrays
+    are never written back to the file), so loading them does not read the data. For CSV files, the DateTime
+    column is converted to time in seconds.
+
+    Args:
+        path (str): The path of the recording file.
+        column_names (str): The names of the columns to load (e.g. 'icp[mmHg]'); columns missing in the recording
+            are skipped.
+        multi_day (bool): The flag passed to convert_datetime_to_time (CSV files only).
+
+    Returns:
+        data (dict): The loaded columns (by name) and the time vector (under the 'time' key).
+        fs (float): The sampling frequency of the recording (in Hz).
+    """
+    if is_binary_recording(path):
+        return _load_binary_recording(path, column_names)
+
+    import polars as pl
+    header = pl.read_csv(path, n_rows=0).columns
+    selected = [name for name in column_names if name in header and name not in (DATETIME_COLUMN, TIME_COLUMN)]
+    df = pl.read_csv(path, columns=[DATETIME_COLUMN, *selected])
+
+    data = {name: df.get_column(name).to_numpy() for name in selected}
+    data[TIME_COLUMN], fs = convert_datetime_to_time(df.get_column(DATETIME_COLUMN).to_numpy(), multi_day=multi_day)
+    if DATETIME_COLUMN in column_names:
+        data[DATETIME_COLUMN] = df.get_column(DATETIME_COLUMN).to_numpy()
+    return data, fs
+
+
+def _load_binary_recording(path: str, column_names: Tuple[str, ...]) -> Tuple[Dict[str, np.ndarray], float]:
+    """
+    Memory-maps the selected columns of a binary recording.
+    """
+    header, data_start = _read_binary_header(path)
+    n_samples = header['n_samples']
+    columns = header['columns']
+
+    data = {}
+    for name in (*column_names, TIME_COLUMN):
+        if name in columns and name not in data:
+            offset = data_start + columns.index(name) * n_samples * 8
+            data[name] = np.memmap(path, dtype='<f8', mode='c', offset=offset, shape=(n_samples,))
+    return data, header['fs']
+
+
+def _read_binary_header(path: str) -> Tuple[dict, int]:
+    """
+    Reads the header of a binary recording.
+
+    Returns:
+        header (dict): The decoded header.
+        data_start (int): The offset of the first column in the file.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(len(BINARY_MAGIC))
+        if magic != BINARY_MAGIC:
+            raise ValueError(f"{path} is not a binary recording")
+        header_length, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    return header, _align(len(BINARY_MAGIC) + 8 + header_length)
+
+
+def convert_csv_to_binary(csv_path: str, binary_path: str = None, multi_day: bool = True) -> Path:
+    """
+    Converts an ICM+ CSV recording to the binary format.
+
+    All numeric columns of the CSV file are stored as float64, together with the time vector calculated from
+    the DateTime column and the estimated sampling frequency, so loading the binary recording requires neither
+    parsing nor time conversion.
+
+    Args:
+        csv_path (str): The path of the CSV file.
+        binary_path (str): The path of the binary recording (by default, the CSV path with the .icpb extension).
+        multi_day (bool): The flag passed to convert_datetime_to_time.
+
+    Returns:
+        Path: The path of the binary recording.
+    """
+    import polars as pl
+    binary_path = Path(binary_path) if binary_path is not None else Path(csv_path).with_suffix(BINARY_SUFFIX)
+
+    df = pl.read_csv(csv_path)
+    time, fs = convert_datetime_to_time(df.get_column(DATETIME_COLUMN).to_numpy(), multi_day=multi_day)
+    columns = {TIME_COLUMN: time}
+    for name, dtype in zip(df.columns, df.dtypes):
+        if dtype.is_numeric() and name != TIME_COLUMN:
+            columns[name] = df.get_column(name).to_numpy()
+
+    header = {'n_samples': len(time), 'fs': float(fs), 'columns': list(columns)}
+    encoded_header = json.dumps(header).encode('utf-8')
+    data_start = _align(len(BINARY_MAGIC) + 8 + len(encoded_header))
+
+    tmp_path = binary_path.with_name(binary_path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(BINARY_MAGIC)
+        f.write(struct.pack('<Q', len(encoded_header)))
+        f.write(encoded_header)
+        f.write(b'\0' * (data_start - f.tell()))
+        for values in columns.values():
+            f.write(np.ascontiguousarray(values, dtype='<f8').tobytes())
+    os.replace(tmp_path, binary_path)
+    return binary_path
+
+
+def _align(offset: int) -> int:
+    return (offset + BINARY_ALIGNMENT - 1) // BINARY_ALIGNMENT * BINARY_ALIGNMENT
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts ICM+ CSV recordings to the binary format.')
+    parser.add_argument('csv_paths', nargs='+', help='paths of the CSV files')
+    parser.add_argument('--single-day', action='store_true', help='recordings do not span multiple days')
+    args = parser.parse_args()
+    for csv_path in args.csv_paths:
+        print(convert_csv_to_binary(csv_path, multi_day=not args.single_day))
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Dict, Optional
+
+import yaml
+import numpy as np
+
+
+class ResultCache:
+    """
+    Helper class that stores the results of the analysis of a recording (pulse onsets, metrics and classes) on disk.
+
+    Each entry is an uncompressed .npz file named after a key which combines the hash of the recording file content,
+    the analysis parameters and the hash of the classification model weights, so an entry is never used after any
+    of them changes. The total size of the cache is limited and the least recently used entries are removed first.
+    """
+
+    # Increase when the layout of the stored results changes, so old entries are no longer used
+    FORMAT_VERSION = 5
+
+    def __init__(self, directory: Optional[str] = None, max_size_mb: Optional[float] = None) -> None:
+        """
+        Initializes a ResultCache instance.
+
+        Args:
+            directory (str): The directory where the results are stored (cache.directory in params.yaml by default).
+            max_size_mb (float): The maximum total size of the stored results in MB (cache.max_size_mb by default).
+        """
+        self._load_parameters()
+        self.enabled = self.params["cache"]["enabled"]
+        directory = directory if directory is not None else self.params["cache"]["directory"]
+        self.directory = Path(os.path.expanduser(directory))
+        max_size_mb = max_size_mb if max_size_mb is not None else self.params["cache"]["max_size_mb"]
+        self.max_size = int(max_size_mb * 1024 * 1024)
+
+        curr_path = Path(os.path.dirname(__file__))
+        self.model_weights = curr_path / self.params["classification"]["model_weights"]
+        self._file_hashes = {}
+
+    def _load_parameters(self) -> None:
+        """
+        Loads the parameters of the cache from file.
+        """
+        params_path = Path(os.path.dirname(__file__)) / 'params.yaml'
+        with open(params_path, 'r') as stream:
+            try:
+                self.params = yaml.safe_load(stream)
+            except yaml.YAMLError as exc:
+                print(exc)
+
+    @staticmethod
+    def analysis_params(column: str, classifier, cutoff: float = 10) -> dict:
+        """
+        Returns the parameters of the analysis of a recording used in the cache key, so that the application and
+        the scripts store the results of the same analysis under the same key.
+
+        Args:
+            column (str): The name of the analyzed column.
+            classifier (PulseClassifier): The classifier used to classify pulses.
+            cutoff (float): The cutoff frequency of the lowpass filter (in Hz).
+
+        Returns:
+            dict: The parameters of the analysis (see key).
+        """
+        return {"column": column, "filter_cutoff": cutoff, "backend": classifier.backend,
+                "artifact_gate": classifier.artifact_gate}
+
+    def key(self, file_path: str, analysis_params: dict) -> str:
+        """
+        Calculates the cache key of a recording.
+
+        Args:
+            file_path (str): The path of the recording file.
+            analysis_params (dict): The parameters of the analysis which affect the results (e.g. the analyzed
+                column, filter cutoff and classification backend); must be serializable to JSON.
+
+        Returns:
+            str: The cache key.
+        """
+        key = hashlib.sha256()
+        key.update(str(self.FORMAT_VERSION).encode())
+        key.update(self._file_hash(file_path).encode())
+        key.update(json.dumps(analysis_params, sort_keys=True, default=str).encode())
+        key.update(self._file_hash(self.model_weights).encode())
+        return key.hexdigest()
+
+    def get(self, file_path: str, analysis_params: dict) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Reads the stored results of a recording.
+
+        Args:
+            file_path (str): The path of the recording file.
+            analysis_params (dict): The parameters of the analysis (see key).
+
+        Returns:
+            dict or None: The stored arrays (by name) or None if the results are not in the cache.
+        """
+        if not self.enabled:
+            return None
+        entry_path = self._entry_path(self.key(file_path, analysis_params))
+        try:
+            with np.load(entry_path, allow_pickle=False) as entry:
+                results = {name: entry[name] for name in entry.files}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError):
+            # damaged entry (e.g. the disk was full when it was written)
+            self._remove(entry_path)
+            return None
+        try:
+            # marks the entry as recently used for _evict
+            os.utime(entry_path)
+        except OSError:
+            # removed in the meantime by another process sharing the directory; the results are already loaded
+            pass
+        return results
+
+    def put(self, file_path: str, analysis_params: dict, results: Dict[str, np.ndarray]) -> None:
+        """
+        Stores the results of a recording and removes the least recently used entries if the cache is too large.
+
+        Args:
+            file_path (str): The path of the recording file.
+            analysis_params (dict): The parameters of the analysis (see key).
+            results (dict): The arrays to store (by name).
+        """
+        if not self.enabled:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entry_path = self._entry_path(self.key(file_path, analysis_params))
+
+        # the entry is written to a temporary file and then renamed, so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **{name: np.asarray(values) for name, values in results.items()})
+            os.replace(tmp_path, entry_path)
+        except BaseException:
+            self._remove(Path(tmp_path))
+            raise
+        self._evict()
+
+    def clear(self) -> None:
+        """
+        Removes all stored results.
+        """
+        for entry_path in self._entries():
+            self._remove(entry_path)
+
+    def _evict(self) -> None:
+        """
+        Removes the least recently used entries until the total size of the cache is within the limit.
+        """
+        entries = []
+        for entry_path in self._entries():
+            try:
+                stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+        entries.sort()
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in entries:
+            if total_size <= self.max_size:
+                break
+            self._remove(entry_path)
+            total_size -= size
+
+    def _entries(self) -> list:
+        if not self.directory.exists():
+            return []
+        return list(self.directory.glob('*.npz'))
+
+    def _entry_path(self, key: str) -> Path:
+        return self.directory / (key + '.npz')
+
+    def _file_hash(self, file_path) -> str:
+        """
+        Calculates the hash of the file content. Hashes are remembered as long as the size and modification time
+        of the file do not change.
+        """
+        stat = os.stat(file_path)
+        signature = (str(file_path), stat.st_size, stat.st_mtime_ns)
+        if signature not in self._file_hashes:
+            file_hash = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    file_hash.update(chunk)
+            self._file_hashes[signature] = file_hash.hexdigest()
+        return self._file_hashes[signature]
+
+    @staticmethod
+    def _remove(path: Path) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -1,67 +1,165 @@
 
+import warnings
+from functools import lru_cache
+
 import numpy as np
 import scipy.signal as sp_sig
 
+from backend.instrumentation import stage
+
 
-def convert_datetime_to_time(datetime: np.ndarray, multi_day: bool = True) -> (np.ndarray, float):
+def convert_datetime_to_time(datetime: np.ndarray, multi_day: bool = True, return_report: bool = False):
     """
     Converts timestamp vector to time in seconds and estimates the sampling frequency.
 
     This function converts the input vector of timestamps (DateTime standard for the ICM+ data collection protocol)
     to time in seconds, with the recording starting at time 0, and estimates the sampling frequency based
-    on the time difference between consecutive samples.
+    on the median time difference between consecutive samples (so that gaps in the recording do not affect
+    the estimate).
 
     Args:
         datetime (numpy array): The one-dimensional vector of timestamps.
         multi_day (bool): The flag which describes if the recording spans multiple day (multi_day = True) or not
             (multi_day = False). If not set to True, the time vector for recordings spanning multiple days may be
             incorrectly calculated at points when the date changes.
+        return_report (bool): The flag which determines if the function should also return the sampling report
+            (see inspect_sampling).
 
     Returns:
         t_hat (numpy array): Estimated time vector.
         fs_hat (float): Estimated sampling frequency (in Hz).
+        report (dict): The sampling report (only if return_report = True).
     """
 
-    if not multi_day:
-        t0 = (datetime[0] - np.floor(datetime[0])) * 24 * 3600
-        t_hat = np.squeeze((datetime - np.floor(datetime)) * 24 * 3600 - t0)
-        fs_hat = round(1 / (t_hat[1] - t_hat[0]), 0)
-    else:
-        n_datetime = datetime - datetime[0]
-        n_datetime_days = np.floor(n_datetime)
-        c_datetime = n_datetime - n_datetime_days
-        c_datetime_seconds = c_datetime * 24 * 3600
-
-        t_hat = []
-        for idx in range(0, len(datetime)):
-            c_t = n_datetime_days[idx] * 24 * 3600 + c_datetime_seconds[idx]
-            t_hat.append(c_t)
-        t_hat = np.asarray(t_hat)
-        fs_hat = round(1 / (t_hat[1] - t_hat[0]), 0)
+    with stage("convert_datetime_to_time", samples=len(datetime)):
+        if not multi_day:
+            t0 = (datetime[0] - np.floor(datetime[0])) * 24 * 3600
+            t_hat = np.squeeze((datetime - np.floor(datetime)) * 24 * 3600 - t0)
+        else:
+            n_datetime = datetime - datetime[0]
+            n_datetime_days = np.floor(n_datetime)
+            c_datetime = n_datetime - n_datetime_days
+            t_hat = n_datetime_days * 24 * 3600 + c_datetime * 24 * 3600
+
+        report = inspect_sampling(t_hat)
+    fs_hat = report["fs"]
+    if report["n_gaps"] or report["n_duplicates"] or report["n_backward"]:
+        warnings.warn(f"Irregular sampling: {report['n_gaps']} gaps, {report['n_duplicates']} duplicate and "
+                      f"{report['n_backward']} backward timestamps", RuntimeWarning, stacklevel=2)
+
+    if return_report:
+        return t_hat, fs_hat, report
     return t_hat, fs_hat
 
 
-def filter_signal(signal: np.ndarray, fs: float, cutoff: float = 10) -> np.ndarray:
+def inspect_sampling(time: np.ndarray, gap_tolerance: float = 1.5) -> dict:
+    """
+    Estimates the sampling frequency and finds irregularities in the time vector.
+
+    The sampling frequency is estimated from the median of positive time differences between consecutive samples
+    (rounded to 1 Hz). A gap is a difference larger than gap_tolerance sampling periods.
+
+    Args:
+        time (numpy array): The one-dimensional time vector (in seconds).
+        gap_tolerance (float): The largest difference between consecutive samples (in sampling periods)
+            which is not considered a gap.
+
+    Returns:
+        dict: The sampling report with the following keys:
+            fs (float): Estimated sampling frequency (in Hz).
+            n_gaps (int), gap_indices (numpy array), gap_durations (numpy array): The number of gaps, the indices
+                of the samples after which they occur and their durations (in seconds).
+            n_duplicates (int), duplicate_indices (numpy array): The number and indices of samples with the same
+                timestamp as the previous sample.
+            n_backward (int), backward_indices (numpy array): The number and indices of samples with a timestamp
+                earlier than the previous sample.
+    """
+    d_time = np.diff(time)
+    positive = d_time[d_time > 0]
+    if len(positive) == 0:
+        raise ValueError("The sampling frequency cannot be estimated: the timestamps do not increase")
+    period = np.median(positive)
+    fs = round(1 / period, 0)
+
+    gap_indices = np.flatnonzero(d_time > gap_tolerance * period)
+    duplicate_indices = np.flatnonzero(d_time == 0) + 1
+    backward_indices = np.flatnonzero(d_time < 0) + 1
+    return {
+        "fs": fs,
+        "n_gaps": len(gap_indices),
+        "gap_indices": gap_indices,
+        "gap_durations": d_time[gap_indices],
+        "n_duplicates": len(duplicate_indices),
+        "duplicate_indices": duplicate_indices,
+        "n_backward": len(backward_indices),
+        "backward_indices": backward_indices,
+    }
+
+
+@lru_cache(maxsize=32)
+def lowpass_sos(fs: float, cutoff: float, order: int) -> np.ndarray:
+    """
+    Designs the Chebyshev type I lowpass filter used for signal conditioning (1 dB passband ripple).
+
+    The designs are cached by (fs, cutoff, order), so each filter is designed once per sampling frequency. The filter
+    is returned in the second-order sections form, which is numerically stable also for high orders and low cutoff
+    frequencies. The returned array is shared by all callers and must not be modified.
+
+    Args:
+        fs (float): The sampling frequency of the signal (in Hz).
+        cutoff (float): The cutoff frequency (in Hz).
+        order (int): The order of the filter.
+
+    Returns:
+        numpy array: The second-order sections of the filter.
+    """
+    return sp_sig.iirfilter(N=order, Wn=cutoff / (fs / 2), btype='lowpass', rs=60, rp=1, ftype='cheby1', output='sos')
+
+
+def fill_missing(signal: np.ndarray, overwrite_input: bool = False) -> np.ndarray:
+    """
+    Replaces missing samples (NaN) with the mean value of the signal.
+
+    Args:
+        signal (numpy array): The one-dimensional signal vector.
+        overwrite_input (bool): The flag which determines if missing samples may be replaced in the input vector
+            (overwrite_input = True) or in a copy (overwrite_input = False). The input is returned unchanged
+            if no samples are missing.
+
+    Returns:
+        numpy array: The one-dimensional signal vector without missing samples.
+    """
+    is_nan = np.isnan(signal)
+    if not is_nan.any():
+        return signal
+    if not overwrite_input or not signal.flags.writeable:
+        signal = np.array(signal, dtype=np.float64)
+    signal[is_nan] = np.nanmean(signal)
+    return signal
+
+
+def filter_signal(signal: np.ndarray, fs: float, cutoff: float = 10, overwrite_input: bool = False) -> np.ndarray:
     """
     Performs lowpass filtering of the signal.
 
     This function filters the input signal of timestamps based on provided cutoff frequency. The default cutoff
-    is 10 Hz (upper limit) to remove high-frequency noise.
+    is 10 Hz (upper limit) to remove high-frequency noise. Missing samples (NaN) are replaced with the mean value
+    of the signal before filtering.
 
     Args:
         signal (numpy array): The one-dimensional signal vector.
         fs (float): The sampling frequency of the signal (in Hz).
         cutoff (float): The cutoff frequency (in Hz).
+        overwrite_input (bool): The flag which determines if missing samples may be replaced in the input vector
+            (overwrite_input = True), which saves a copy of the signal, or if the input is left unchanged
+            (overwrite_input = False).
 
     Returns:
         numpy array: The one-dimensional signal vector after filtering.
     """
 
-    mean_signal = np.nanmean(signal)
-    signal[np.argwhere(np.isnan(signal))] = mean_signal
-
-    Wn1 = cutoff / (fs / 2)
-    b1, a1 = sp_sig.iirfilter(N=8, Wn=Wn1, btype='lowpass', rs=60, rp=1, ftype='cheby1')
-    filtered_signal = sp_sig.filtfilt(b1, a1, signal)
+    with stage("filter_signal", samples=len(signal)):
+        signal = fill_missing(np.asarray(signal, dtype=np.float64), overwrite_input)
+        filtered_signal = sp_sig.sosfiltfilt(lowpass_sos(float(fs), float(cutoff), 8), signal)
 
     return filtered_signal
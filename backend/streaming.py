@@ -0,0 +1,343 @@
+import math
+import time as time_module
+from typing import Dict, Iterator, Optional, Tuple
+
+import numpy as np
+import scipy.signal as sp_sig
+
+from backend.basic_pulse_analysis import BasicPulseAnalyzer
+from backend.pulse_batch import PulseBatch
+from backend.pulse_segmentation import PulseSegmenter
+from backend.signal_processing import lowpass_sos
+
+
+class StreamingPulseProcessor:
+    """
+    Helper class that performs online pulse segmentation, analysis and classification of a live signal.
+
+    The signal is passed in chunks (push). The dominant scale of the Scholkmann algorithm is estimated causally:
+    the signal is filtered with sosfilt and the same filters as filter_signal and PulseSegmenter (filter states are
+    kept between chunks), and the local maxima are counted at each scale as soon as the samples max_scale/2 after
+    a sample are available.
+
+    The causal filters delay the signal by an amount which depends on the frequency content of the pulses, so
+    the onsets are not placed on the causally filtered signal. Instead, the buffered signal is filtered with the
+    zero-phase filters of filter_signal and PulseSegmenter (sosfiltfilt) and the onsets are found in it with
+    PulseSegmenter.find_onsets_in_range, as in analyze_signal. A zero-phase filtered sample is used once the next
+    settle_duration seconds of the signal are available, so that the edge transient of sosfiltfilt has mostly
+    decayed; it is not filtered again later. Every completed pulse is analyzed with BasicPulseAnalyzer on the
+    zero-phase filtered signal and (optionally) classified with PulseClassifier.
+
+    The latency of a pulse is about settle_duration plus 0.5 s (detection) plus the chunk duration, i.e. up to 2 s
+    for the default settle_duration of 1 s and 0.5 s chunks. The zero-phase filtered samples still differ slightly
+    from the offline ones, and the offline signal is detrended as a whole, so where the diastolic part of a pulse is
+    flat and the detection signal has two nearly equal maxima, the onset may be placed on the other one (within
+    the flat part of the pulse). A longer settle_duration makes this less frequent (see compare_with_offline).
+    Missing samples are replaced with the mean of the signal so far, so the onsets next to them may also differ
+    from the offline onsets.
+
+    A single PulseClassifier may be shared by many processors (e.g. one processor per bed).
+    """
+
+    # Tolerance (in seconds) of the difference between the streaming and the offline onset of a pulse
+    # (see compare_with_offline)
+    STREAMING_ONSET_TOLERANCE = 0.02
+
+    def __init__(self, fs: float, classifier=None, cutoff: float = 10, max_pulse_duration: float = 3.0,
+                 settle_duration: float = 1.0) -> None:
+        """
+        Initializes a StreamingPulseProcessor instance.
+
+        Args:
+            fs (float): The sampling frequency of the signal (in Hz).
+            classifier (PulseClassifier): The classifier used for completed pulses (None - pulses are not classified).
+            cutoff (float): The cutoff frequency of the lowpass filter (in Hz), as in filter_signal.
+            max_pulse_duration (float): The longest pulse (in seconds); longer segments are split at this length.
+            settle_duration (float): The length of the signal (in seconds) needed after a sample before its zero-phase
+                filtered value is used.
+        """
+        self.fs = fs
+        self.classifier = classifier
+        self.basic_analyzer = BasicPulseAnalyzer()
+
+        # filter_signal and PulseSegmenter._condition_signal filter designs
+        self.signal_sos = lowpass_sos(float(fs), float(cutoff), 8)
+        self.detection_sos = lowpass_sos(float(fs), 5, 6)
+        self._signal_zi = None
+        self._detection_zi = None
+
+        # max_scale = fs, as in PulseSegmenter._detect_pulses_in_signal
+        self.n_scales = math.ceil(fs / 2) - 1
+        self.max_pulse_samples = int(round(max_pulse_duration * fs))
+        self.settle_samples = max(int(round(settle_duration * fs)), 1)
+        self._scale_counts = np.zeros(self.n_scales, dtype=np.int64)
+
+        # Buffers of the signal (with missing samples replaced), the causal detection signal and time, and of the
+        # zero-phase filtered signal and detection signal (up to the sample _settled); index 0 of the buffers is
+        # the sample _buffer_start of the stream
+        self._raw = np.zeros(0)
+        self._causal_detection = np.zeros(0)
+        self._time = np.zeros(0)
+        self._signal = np.zeros(0)
+        self._detection = np.zeros(0)
+        self._buffer_start = 0
+        self._n_samples = 0
+        self._settled = 0
+        # The next sample whose local maxima are counted (causal signal) and checked for an onset (zero-phase signal)
+        self._next_counted = 0
+        self._next_checked = 0
+        # The recording start is the first pulse boundary, as in PulseSegmenter.split_pulses
+        self._last_onset = 0
+
+        self._valid_sum = 0.0
+        self._valid_count = 0
+
+    def push(self, values: np.ndarray, times: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Processes the next chunk of the signal.
+
+        Args:
+            values (numpy array): The one-dimensional vector of new signal samples.
+            times (numpy array): The one-dimensional time vector corresponding to the new samples.
+
+        Returns:
+            dict: The pulses completed in this chunk, with the following arrays (one value per pulse):
+                onsets (indices of the first samples in the stream), start_times, end_times, means, amplitudes,
+                slopes and classes (0 if no classifier is used).
+        """
+        values = np.array(values, dtype=np.float64)
+        times = np.asarray(times, dtype=np.float64)
+        if len(values) == 0:
+            return self._pulses(np.zeros(0, dtype=np.int64))
+
+        # Missing samples are replaced with the mean of the signal so far (filter_signal uses the mean of the whole
+        # signal)
+        is_nan = np.isnan(values)
+        self._valid_sum += np.sum(values[~is_nan])
+        self._valid_count += np.count_nonzero(~is_nan)
+        values[is_nan] = self._valid_sum / self._valid_count if self._valid_count else 0
+
+        if self._signal_zi is None:
+            self._signal_zi = sp_sig.sosfilt_zi(self.signal_sos) * values[0]
+        filtered, self._signal_zi = sp_sig.sosfilt(self.signal_sos, values, zi=self._signal_zi)
+        if self._detection_zi is None:
+            self._detection_zi = sp_sig.sosfilt_zi(self.detection_sos) * filtered[0]
+        detection, self._detection_zi = sp_sig.sosfilt(self.detection_sos, filtered, zi=self._detection_zi)
+
+        self._raw = np.concatenate((self._raw, values))
+        # The signal is inverted so that pulse onsets are detected as maxima
+        self._causal_detection = np.concatenate((self._causal_detection, -detection))
+        self._time = np.concatenate((self._time, times))
+        self._n_samples += len(values)
+
+        self._count_scale_maxima()
+        self._settle()
+        onsets = self._detect_onsets()
+        pulses = self._complete_pulses(onsets)
+        self._trim_buffers()
+        return pulses
+
+    def _count_scale_maxima(self) -> None:
+        """
+        Counts the local maxima of the causal detection signal at each scale in all samples which have max_scale/2
+        samples after them (the dominant scale is the argmax of the counts).
+        """
+        start = max(self._next_counted, self.n_scales) - self._buffer_start
+        stop = self._n_samples - self.n_scales - 1 - self._buffer_start
+        if stop > start:
+            self._scale_counts += PulseSegmenter.count_scale_maxima(self._causal_detection, start, stop,
+                                                                    self.n_scales)
+            self._next_counted = stop + self._buffer_start
+
+    def _settle(self) -> None:
+        """
+        Filters the buffered signal with the zero-phase filters and keeps the samples which have settle_samples
+        samples after them. The filtered window starts settle_samples before the first new sample (or at the
+        beginning of the stream, where the edge is handled as in sosfiltfilt of the whole signal).
+        """
+        settled = self._n_samples - self.settle_samples
+        if settled <= self._settled:
+            return
+        window_start = max(self._settled - self.settle_samples, 0)
+        raw = self._raw[window_start - self._buffer_start:]
+        # sosfiltfilt pads the window with 3 * (2 * number of sections + 1) samples
+        if len(raw) <= 3 * (2 * max(len(self.signal_sos), len(self.detection_sos)) + 1):
+            return
+        filtered = sp_sig.sosfiltfilt(self.signal_sos, raw)
+        detection = sp_sig.sosfiltfilt(self.detection_sos, filtered)
+        new = slice(self._settled - window_start, settled - window_start)
+        self._signal = np.concatenate((self._signal, filtered[new]))
+        self._detection = np.concatenate((self._detection, -detection[new]))
+        self._settled = settled
+
+    def _detect_onsets(self) -> np.ndarray:
+        """
+        Checks all zero-phase filtered samples which have max_scale/2 settled samples after them and returns new
+        onsets (stream indices).
+        """
+        start = max(self._next_checked, self.n_scales) - self._buffer_start
+        stop = self._settled - self.n_scales - 1 - self._buffer_start
+        if stop <= start:
+            return np.zeros(0, dtype=np.int64)
+        self._next_checked = stop + self._buffer_start
+
+        dominant_scale = int(np.argmax(self._scale_counts))
+        return PulseSegmenter.find_onsets_in_range(self._detection, start, stop, dominant_scale) + self._buffer_start
+
+    def _complete_pulses(self, onsets: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Splits the signal between consecutive onsets into pulses. Segments longer than max_pulse_duration
+        (e.g. flat signal) are split, so the buffers stay bounded.
+        """
+        # All onsets before this sample are already known
+        confirmed = self._next_checked
+
+        boundaries = [self._last_onset]
+        for onset in np.append(onsets[onsets > self._last_onset], confirmed):
+            while onset - boundaries[-1] > self.max_pulse_samples:
+                boundaries.append(boundaries[-1] + self.max_pulse_samples)
+            if onset < confirmed:
+                boundaries.append(onset)
+        boundaries = np.asarray(boundaries, dtype=np.int64)
+
+        self._last_onset = boundaries[-1]
+        return self._pulses(boundaries)
+
+    def _pulses(self, boundaries: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Analyzes and classifies the pulses between consecutive boundaries (stream indices).
+        """
+        local = boundaries - self._buffer_start
+        n_pulses = max(len(boundaries) - 1, 0)
+        pulses = {"onsets": boundaries[:-1]}
+        if n_pulses == 0:
+            for name in ("start_times", "end_times", "means", "amplitudes", "slopes"):
+                pulses[name] = np.zeros(0)
+            pulses["classes"] = np.zeros(0, dtype=np.int64)
+            return pulses
+
+        pulses["start_times"] = self._time[local[:-1]]
+        pulses["end_times"] = self._time[local[1:]]
+
+        # the zero-phase filtered signal ends at the sample _settled (after the last boundary)
+        time = self._time[:len(self._signal)]
+        pulses["means"], pulses["amplitudes"], pulses["slopes"] = \
+            self.basic_analyzer.batch_calculate_pulse_metrics(self._signal, time, local)
+
+        if self.classifier is not None:
+            segments = PulseBatch(self._signal, local)
+            # the first segment of the stream starts at its beginning, not at a pulse onset
+            edge_pulses = (bool(boundaries[0] == 0), False)
+            pulses["classes"] = np.asarray(self.classifier.classify_batch(segments, self.fs, edge_pulses),
+                                           dtype=np.int64)
+        else:
+            pulses["classes"] = np.zeros(n_pulses, dtype=np.int64)
+        return pulses
+
+    def _trim_buffers(self) -> None:
+        """
+        Removes the samples which are no longer needed by the detection, the zero-phase filtering or the current
+        pulse.
+        """
+        keep_from = min(self._next_counted - self.n_scales - 1, self._next_checked - self.n_scales - 1,
+                        self._settled - self.settle_samples, self._last_onset)
+        drop = keep_from - self._buffer_start
+        if drop > 0:
+            self._raw = self._raw[drop:]
+            self._causal_detection = self._causal_detection[drop:]
+            self._time = self._time[drop:]
+            self._signal = self._signal[drop:]
+            self._detection = self._detection[drop:]
+            self._buffer_start = keep_from
+
+
+def replay_recording(path: str, column: str = 'icp[mmHg]', chunk_duration: float = 0.5,
+                     speed: Optional[float] = 1.0) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Replays a recorded signal as a live feed (for testing the streaming mode).
+
+    Args:
+        path (str): The path of the recording (.csv or binary, see load_recording).
+        column (str): The name of the replayed column.
+        chunk_duration (float): The duration of each chunk (in seconds).
+        speed (float): The replay speed relative to real time (e.g. 10 - ten times faster); None replays
+            the chunks without waiting.
+
+    Returns:
+        Iterator: Chunks of (signal values, time) for consecutive parts of the recording.
+    """
+    from backend.recording_io import load_recording
+    data, fs = load_recording(path, column)
+    values, time = data[column], data['time']
+    chunk_size = max(int(round(chunk_duration * fs)), 1)
+
+    start_clock = time_module.monotonic()
+    for start in range(0, len(values), chunk_size):
+        stop = min(start + chunk_size, len(values))
+        if speed:
+            # wait until the last sample of the chunk would have been recorded
+            wait = (time[stop - 1] - time[0]) / speed - (time_module.monotonic() - start_clock)
+            if wait > 0:
+                time_module.sleep(wait)
+        yield np.asarray(values[start:stop]), np.asarray(time[start:stop])
+
+
+def compare_with_offline(signal: np.ndarray, time: np.ndarray, fs: float, chunk_duration: float = 0.5,
+                         **processor_args) -> Dict[str, float]:
+    """
+    Streams a recorded signal through a StreamingPulseProcessor and compares the onsets with the offline onsets
+    of the same signal (filter_signal and PulseSegmenter.split_pulses).
+
+    Args:
+        signal (numpy array): The one-dimensional signal vector.
+        time (numpy array): The one-dimensional time vector corresponding to the signal.
+        fs (float): The sampling frequency of the signal (in Hz).
+        chunk_duration (float): The duration of each pushed chunk (in seconds).
+        **processor_args: The arguments of StreamingPulseProcessor (e.g. settle_duration).
+
+    Returns:
+        dict: The numbers of offline and streaming onsets, the median, 99th percentile and maximum of the differences
+            (in samples) between the streaming onsets and the nearest offline onsets, the fraction of streaming onsets
+            within STREAMING_ONSET_TOLERANCE of an offline onset and the largest latency (in seconds, from the end
+            of a pulse to the end of the chunk in which it was completed).
+    """
+    from backend.signal_processing import filter_signal
+    segmenter = PulseSegmenter()
+    try:
+        _, _, offline_onsets = segmenter.split_pulses(filter_signal(signal, fs), time, fs)
+    finally:
+        # long signals start the worker processes of the parallel peak detection
+        segmenter.close()
+    # the first and last boundaries are the ends of the signal, not pulse onsets
+    offline_onsets = offline_onsets[1:-1]
+
+    processor = StreamingPulseProcessor(fs, **processor_args)
+    chunk_size = max(int(round(chunk_duration * fs)), 1)
+    onsets = []
+    latency = 0.0
+    for start in range(0, len(signal), chunk_size):
+        stop = min(start + chunk_size, len(signal))
+        pulses = processor.push(signal[start:stop], time[start:stop])
+        onsets.append(pulses["onsets"])
+        if len(pulses["end_times"]):
+            latency = max(latency, time[stop - 1] - pulses["end_times"][0])
+    onsets = np.concatenate(onsets)
+    onsets = onsets[onsets > 0]
+
+    differences = np.zeros(0)
+    if len(onsets) and len(offline_onsets):
+        # the nearest offline onset is either the last one before or the first one after each streaming onset
+        after = np.searchsorted(offline_onsets, onsets)
+        before = offline_onsets[np.maximum(after - 1, 0)]
+        after = offline_onsets[np.minimum(after, len(offline_onsets) - 1)]
+        differences = np.minimum(np.abs(onsets - before), np.abs(onsets - after))
+    tolerance = processor.STREAMING_ONSET_TOLERANCE * fs
+    return {
+        "offline_onsets": len(offline_onsets),
+        "streaming_onsets": len(onsets),
+        "median_difference": float(np.median(differences)) if len(differences) else 0.0,
+        "p99_difference": float(np.percentile(differences, 99)) if len(differences) else 0.0,
+        "max_difference": float(np.max(differences)) if len(differences) else 0.0,
+        "within_tolerance": float(np.mean(differences <= tolerance)) if len(differences) else 1.0,
+        "max_latency_s": float(latency),
+    }
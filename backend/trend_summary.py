@@ -0,0 +1,209 @@
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+
+class TrendSummary:
+    """
+    Helper class that holds windowed summaries of the analysis results of a recording (mean ICP, mean pulse amplitude
+    and the number of pulses of each class) at several resolutions, e.g. for overview plots of multi-day recordings.
+
+    Window k of a resolution r contains the pulses which start in the [origin + k * r, origin + (k + 1) * r) range
+    of time (in seconds). The origin is the start of the window of the coarsest resolution which contains the first
+    added pulse (it is moved back if earlier pulses are added later), so the arrays cover only the time of the pulses
+    even if the times are absolute (e.g. seconds since the epoch in a live feed). Each window stores sums and counts
+    rather than averages, so pulses are grouped by window with np.bincount and the summaries are updated
+    incrementally when pulses are added or removed (e.g. by the streaming processor or the progressive analysis, see
+    PulseTable), with the same result as for all pulses at once.
+    """
+
+    # Window lengths (in seconds): 10 s, 1 min, 10 min and 1 h
+    RESOLUTIONS = (10, 60, 600, 3600)
+    # Class 0 - not classified, classes 1-4 - valid pulse shapes, class 5 - artifacts
+    N_CLASSES = 6
+    # Names and types of the stored sums and counts of each window
+    FIELDS = {
+        "pulses": np.int64,
+        "mean_sums": np.float64,
+        "mean_counts": np.int64,
+        "amplitude_sums": np.float64,
+        "amplitude_counts": np.int64,
+    }
+
+    def __init__(self, resolutions: Tuple[float, ...] = RESOLUTIONS) -> None:
+        """
+        Initializes an empty TrendSummary instance.
+
+        Args:
+            resolutions (tuple): The window lengths (in seconds).
+        """
+        self.resolutions = tuple(resolutions)
+        self.levels = {resolution: self._empty_level(0) for resolution in self.resolutions}
+        # the start time of window 0 of all resolutions (None before the first pulse is added)
+        self.origin = None
+
+    def _empty_level(self, n_windows: int) -> Dict[str, np.ndarray]:
+        level = {name: np.zeros(n_windows, dtype=dtype) for name, dtype in self.FIELDS.items()}
+        level["class_counts"] = np.zeros((n_windows, self.N_CLASSES), dtype=np.int64)
+        return level
+
+    def add(self, results: Dict[str, np.ndarray]) -> None:
+        """
+        Adds pulses to the summaries.
+
+        Args:
+            results (dict): The results with one value per pulse (start_times, means, amplitudes and classes,
+                as returned by analyze_signal or StreamingPulseProcessor.push); missing metrics are not summarized.
+        """
+        self._update(results, 1)
+
+    def remove(self, results: Dict[str, np.ndarray]) -> None:
+        """
+        Removes pulses which were added before (e.g. the pulses replaced by PulseTable.replace).
+        """
+        self._update(results, -1)
+
+    def _update(self, results: Dict[str, np.ndarray], sign: int) -> None:
+        start_times = np.asarray(results.get("start_times", ()), dtype=np.float64)
+        if len(start_times) == 0:
+            return
+        means = results.get("means")
+        amplitudes = results.get("amplitudes")
+        classes = results.get("classes")
+
+        first_time = float(np.min(start_times))
+        if self.origin is None or first_time < self.origin:
+            coarsest = max(self.resolutions)
+            self._move_origin(np.floor(first_time / coarsest) * coarsest)
+
+        for resolution, level in self.levels.items():
+            windows = np.maximum(np.floor((start_times - self.origin) / resolution), 0).astype(np.int64)
+            if windows.max() >= len(level["pulses"]):
+                level = self._grow(resolution, int(windows.max()) + 1)
+            n_windows = len(level["pulses"])
+
+            level["pulses"] += sign * np.bincount(windows, minlength=n_windows)
+            for values, sums, counts in ((means, "mean_sums", "mean_counts"),
+                                         (amplitudes, "amplitude_sums", "amplitude_counts")):
+                if values is None:
+                    continue
+                values = np.asarray(values, dtype=np.float64)
+                valid = ~np.isnan(values)
+                level[sums] += sign * np.bincount(windows[valid], weights=values[valid], minlength=n_windows)
+                level[counts] += sign * np.bincount(windows[valid], minlength=n_windows)
+            if classes is not None:
+                classes = np.clip(np.asarray(classes, dtype=np.int64), 0, self.N_CLASSES - 1)
+                class_counts = np.bincount(windows * self.N_CLASSES + classes, minlength=n_windows * self.N_CLASSES)
+                level["class_counts"] += sign * class_counts.reshape(n_windows, self.N_CLASSES)
+
+    def _move_origin(self, origin: float) -> None:
+        """
+        Moves the origin back to an earlier time, adding empty windows at the beginning of each resolution.
+        """
+        if self.origin is not None:
+            for resolution, level in self.levels.items():
+                n_added = int(round((self.origin - origin) / resolution))
+                if n_added > 0:
+                    moved = self._empty_level(n_added + len(level["pulses"]))
+                    for name, values in level.items():
+                        moved[name][n_added:] = values
+                    self.levels[resolution] = moved
+        self.origin = float(origin)
+
+    def _grow(self, resolution: float, n_windows: int) -> Dict[str, np.ndarray]:
+        """
+        Extends the arrays of a resolution to n_windows windows (at least doubling them, so that adding pulses
+        in time order copies the arrays O(log n) times).
+        """
+        level = self.levels[resolution]
+        n_windows = max(n_windows, 2 * len(level["pulses"]))
+        grown = self._empty_level(n_windows)
+        for name, values in level.items():
+            grown[name][:len(values)] = values
+        self.levels[resolution] = grown
+        return grown
+
+    def windows(self, resolution: float, start_time: float = 0, end_time: float = np.inf) -> Dict[str, np.ndarray]:
+        """
+        Returns the summaries of the windows of a resolution which contain pulses.
+
+        Args:
+            resolution (float): The window length (one of resolutions).
+            start_time (float): The beginning of the returned range (in seconds).
+            end_time (float): The end of the returned range (in seconds).
+
+        Returns:
+            dict: start_times (the beginnings of the windows), pulses (the numbers of pulses), means (the mean ICP),
+                amplitudes (the mean pulse amplitudes), class_counts (the numbers of pulses of each class,
+                one column per class 0-5) and artifact_fractions (the fractions of the classified pulses
+                which are artifacts, class 5).
+        """
+        level = self.levels[resolution]
+        origin = self.origin if self.origin is not None else 0.0
+        first = max(int(np.floor((start_time - origin) / resolution)), 0)
+        last = int(min(np.ceil((end_time - origin) / resolution), len(level["pulses"])))
+        indices = np.flatnonzero(level["pulses"][first:max(last, first)] > 0) + first
+
+        class_counts = level["class_counts"][indices]
+        classified = class_counts[:, 1:].sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return {
+                "start_times": origin + indices * float(resolution),
+                "pulses": level["pulses"][indices],
+                "means": level["mean_sums"][indices] / level["mean_counts"][indices],
+                "amplitudes": level["amplitude_sums"][indices] / level["amplitude_counts"][indices],
+                "class_counts": class_counts,
+                "artifact_fractions": class_counts[:, self.N_CLASSES - 1] / classified,
+            }
+
+    def overview(self, start_time: float, end_time: float, max_points: int = 5000) -> Tuple[float, Dict]:
+        """
+        Returns the summaries of the finest resolution with at most max_points windows in the time range
+        (the coarsest resolution if none of them is coarse enough).
+
+        Returns:
+            resolution (float): The selected resolution.
+            windows (dict): The summaries of its windows (see windows).
+        """
+        resolutions = sorted(self.resolutions)
+        duration = max(end_time - start_time, 0)
+        resolution = next((resolution for resolution in resolutions if duration / resolution <= max_points),
+                          resolutions[-1])
+        return resolution, self.windows(resolution, start_time, end_time)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        Returns the stored sums and counts as arrays named trend_<resolution>_<field> and the origin as
+        trend_origin, e.g. to store them with the results of the recording in the ResultCache.
+        """
+        arrays = {"trend_origin": np.array(self.origin if self.origin is not None else np.nan)}
+        for resolution, level in self.levels.items():
+            n_windows = int(np.flatnonzero(level["pulses"])[-1]) + 1 if np.any(level["pulses"]) else 0
+            for name, values in level.items():
+                arrays[f"trend_{resolution:g}_{name}"] = values[:n_windows]
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> Optional["TrendSummary"]:
+        """
+        Restores the summaries from the arrays returned by to_arrays (other arrays are ignored).
+
+        Returns:
+            TrendSummary or None: The summaries or None if the arrays do not contain them.
+        """
+        summary = cls()
+        if "trend_origin" not in arrays:
+            return None
+        origin = float(arrays["trend_origin"])
+        summary.origin = origin if not np.isnan(origin) else None
+        for resolution in summary.resolutions:
+            names = [f"trend_{resolution:g}_{name}" for name in summary.levels[resolution]]
+            if not all(name in arrays for name in names):
+                return None
+            summary.levels[resolution] = {name: np.array(arrays[key])
+                                          for name, key in zip(summary.levels[resolution], names)}
+        return summary
+
+    @property
+    def nbytes(self) -> int:
+        return sum(values.nbytes for level in self.levels.values() for values in level.values())
@@ -1,4 +1,4 @@
-from PySide6.QtCore import QObject, Signal, Property
+from PySide6.QtCore import QObject, Signal, Property, Slot
 
 class Backend(QObject):
     def __init__(self):
@@ -48,4 +48,12 @@ class Backend(QObject):
     peakClass = Property(int, _get_class, _set_class, notify=classChanged)
     peakMean = Property(float, _get_mean, _set_mean, notify=meanChanged)
     peakAmplitude = Property(float, _get_amplitude, _set_amplitude, notify=amplitudeChanged)
-    peakSlope = Property(float, _get_slope, _set_slope, notify=slopeChanged)
\ No newline at end of file
+    peakSlope = Property(float, _get_slope, _set_slope, notify=slopeChanged)
+
+    # Shows the properties of the pulse under the cursor (Plotter.pulseAt); an empty map clears them
+    @Slot("QVariantMap")
+    def showPulse(self, pulse):
+        self._set_class(int(pulse.get("classes", 0)))
+        self._set_mean(float(pulse.get("means", float("nan"))))
+        self._set_amplitude(float(pulse.get("amplitudes", float("nan"))))
+        self._set_slope(float(pulse.get("slopes", float("nan"))))
\ No newline at end of file
@@ -0,0 +1,167 @@
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from backend.recording_io import BINARY_SUFFIX
+
+
+# Analysis objects of a worker process, created once by _init_worker
+_worker = {}
+
+
+def find_recordings(inputs):
+    """
+    Expands directories and glob patterns into a sorted list of recording files (.csv and binary recordings).
+
+    A CSV file converted with convert_csv_to_binary is found together with its binary copy, so only the binary
+    recording is analyzed.
+
+    Returns:
+        List[tuple]: Pairs of the recording path and its root: the directory, the directory part of the glob pattern
+            before the first wildcard, or the parent directory of the file given as the input. The results are
+            stored under the path of the recording relative to its root (see output_path).
+    """
+    recordings = {}
+    for item in inputs:
+        if os.path.isdir(item):
+            root = Path(item)
+            paths = [path for suffix in ('.csv', BINARY_SUFFIX) for path in root.rglob('*' + suffix)]
+        else:
+            root = _pattern_root(item)
+            paths = [Path(path) for path in glob.glob(item, recursive=True)]
+        for path in paths:
+            recordings.setdefault(path, root)
+
+    # the binary recording is preferred over the CSV file it was converted from
+    binary = {path.with_suffix('') for path in recordings if path.suffix == BINARY_SUFFIX}
+    return sorted((path, root) for path, root in recordings.items()
+                  if not (path.suffix == '.csv' and path.with_suffix('') in binary))
+
+
+def _pattern_root(pattern):
+    """
+    Returns the directory part of a path or glob pattern before the first wildcard.
+    """
+    parts = Path(pattern).parts
+    fixed = next((index for index, part in enumerate(parts) if glob.has_magic(part)), len(parts) - 1)
+    return Path(*parts[:fixed]) if fixed else Path('.')
+
+
+def output_path(recording_path, root, output_dir):
+    """
+    Returns the path of the results of a recording: its path relative to the root, with the .pulses.parquet
+    extension, in the output directory (so recordings with the same name in different subdirectories do not
+    overwrite each other).
+    """
+    relative = Path(os.path.relpath(recording_path, root))
+    return Path(output_dir) / relative.parent / (relative.stem + '.pulses.parquet')
+
+
+def is_processed(recording_path, root, output_dir):
+    """
+    Checks if the results of the recording exist and are newer than the recording.
+    """
+    result_path = output_path(recording_path, root, output_dir)
+    return result_path.exists() and result_path.stat().st_mtime >= recording_path.stat().st_mtime
+
+
+def _init_worker(threads_per_worker):
+    # Heavy modules are imported in workers only; the model is loaded once per worker
+    import torch
+    from backend.pulse_segmentation import PulseSegmenter
+    from backend.basic_pulse_analysis import BasicPulseAnalyzer
+    from backend.pulse_classification import PulseClassifier
+
+    torch.set_num_threads(threads_per_worker)
+    segmenter = PulseSegmenter()
+    # files are already processed in parallel, so each file is segmented in a single process
+    segmenter.processes = 1
+    _worker['segmenter'] = segmenter
+    _worker['basic_analyzer'] = BasicPulseAnalyzer()
+    _worker['classifier'] = PulseClassifier()
+
+
+def process_recording(recording_path, root, output_dir, column):
+    """
+    Analyzes a single recording in a worker process and writes the per-pulse results to Parquet.
+
+    Returns:
+        tuple: The number of samples and the number of pulses.
+    """
+    import polars as pl
+    from backend.recording_io import load_recording
+    from backend.recording_analysis import analyze_signal
+
+    data, fs = load_recording(recording_path, column)
+    if column not in data:
+        raise ValueError(f"no column {column}")
+    results = analyze_signal(data[column], data['time'], fs, _worker['segmenter'], _worker['basic_analyzer'],
+                             _worker['classifier'])
+
+    result_path = output_path(recording_path, root, output_dir)
+    result_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = result_path.with_name(result_path.name + '.tmp')
+    pl.DataFrame(results).write_parquet(tmp_path)
+    os.replace(tmp_path, result_path)
+    return len(data['time']), len(results['onsets'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyzes ICM+ recordings (filtering, segmentation, pulse metrics '
+                                                 'and classification) and writes per-pulse results to Parquet.')
+    parser.add_argument('inputs', nargs='+', help='recording files, directories or glob patterns')
+    parser.add_argument('-o', '--output', required=True, help='directory for the results')
+    parser.add_argument('-c', '--column', default='icp[mmHg]', help='analyzed column (default: icp[mmHg])')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--force', action='store_true', help='process recordings which are already processed')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    recordings = find_recordings(args.inputs)
+    outputs = {}
+    for path, root in recordings:
+        result_path = output_path(path, root, args.output)
+        if result_path in outputs:
+            print(f"{path}: skipped, the results of {outputs[result_path]} are stored in {result_path}")
+        else:
+            outputs[result_path] = path
+    recordings = [(path, root) for path, root in recordings if outputs[output_path(path, root, args.output)] == path]
+    pending = [(path, root) for path, root in recordings
+               if args.force or not is_processed(path, root, args.output)]
+    print(f"{len(recordings)} recordings found, {len(recordings) - len(pending)} already processed")
+    if not pending:
+        return
+
+    jobs = max(1, min(args.jobs, len(pending)))
+    threads_per_worker = max(1, (os.cpu_count() or 1) // jobs)
+
+    start = time.perf_counter()
+    total_samples = 0
+    total_pulses = 0
+    failed = 0
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(threads_per_worker,)) as executor:
+        futures = {executor.submit(process_recording, path, root, args.output, args.column): path
+                   for path, root in pending}
+        for done, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            try:
+                n_samples, n_pulses = future.result()
+            except Exception as exc:
+                failed += 1
+                print(f"[{done}/{len(pending)}] {path}: failed ({exc})")
+                continue
+            total_samples += n_samples
+            total_pulses += n_pulses
+            print(f"[{done}/{len(pending)}] {path}: {n_samples} samples, {n_pulses} pulses")
+
+    elapsed = time.perf_counter() - start
+    print(f"Processed {len(pending) - failed} recordings ({failed} failed) in {elapsed:.1f} s: "
+          f"{(len(pending) - failed) / elapsed:.2f} recordings/s, {total_samples / elapsed:.0f} samples/s, "
+          f"{total_pulses / elapsed:.0f} pulses/s")
+
+
+if __name__ == '__main__':
+    main()
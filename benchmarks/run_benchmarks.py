@@ -0,0 +1,194 @@
+import argparse
+import json
+import os
+import platform
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+from benchmarks.synthetic import generate_recording
+
+
+STAGES = ("convert_datetime_to_time", "filter_signal", "split_pulses", "pulse_metrics", "pulse_metrics_lists",
+          "classify_batch", "plot_pyramid", "plot_query", "streaming")
+
+
+def parse_duration(text):
+    """
+    Parses a duration such as 30m, 1h or 72h (plain numbers are seconds).
+    """
+    units = {"s": 1, "m": 60, "h": 3600, "d": 24 * 3600}
+    if text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def measure(func, repeat=1, memory=True):
+    """
+    Runs the function and measures the best wall time and CPU time of repeat runs and the peak memory allocated
+    during an additional run (traced with tracemalloc, which also covers NumPy arrays but not PyTorch tensors).
+
+    Returns:
+        tuple: The measurements (dict) and the result of the last run.
+    """
+    wall_times = []
+    cpu_times = []
+    for _ in range(repeat):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        result = func()
+        cpu_times.append(time.process_time() - cpu_start)
+        wall_times.append(time.perf_counter() - wall_start)
+
+    measurements = {"wall_s": min(wall_times), "cpu_s": min(cpu_times)}
+    if memory:
+        tracemalloc.start()
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        measurements["peak_mb"] = peak / 2 ** 20
+    return measurements, result
+
+
+def run_duration(duration, fs, stages, repeat, memory, max_classified):
+    """
+    Runs the selected stages on a synthetic recording of the given duration.
+    """
+    from backend.signal_processing import convert_datetime_to_time, filter_signal
+    from backend.pulse_segmentation import PulseSegmenter
+    from backend.basic_pulse_analysis import BasicPulseAnalyzer
+    from controller.level_of_detail import MinMaxPyramid
+
+    recording = generate_recording(duration, fs=fs)
+    n_samples = len(recording["time"])
+    results = []
+
+    def record(stage, func, items):
+        measurements, result = measure(func, repeat, memory)
+        measurements.update({"stage": stage, "duration_s": duration, "fs": fs, "n_samples": n_samples})
+        measurements.update(items(result) if callable(items) else items)
+        results.append(measurements)
+        print(f"{duration / 3600:7.2f} h  {stage:26s} {measurements['wall_s']:9.3f} s"
+              + (f"  {measurements['peak_mb']:9.1f} MB" if memory else ""))
+        return result
+
+    time_vector, fs_hat = convert_datetime_to_time(recording["DateTime"])
+    if "convert_datetime_to_time" in stages:
+        record("convert_datetime_to_time", lambda: convert_datetime_to_time(recording["DateTime"]), {})
+
+    signal = recording["icp[mmHg]"]
+    filtered = filter_signal(signal, fs_hat)
+    if "filter_signal" in stages:
+        record("filter_signal", lambda: filter_signal(signal, fs_hat), {})
+
+    segmenter = PulseSegmenter()
+    try:
+        pulses, times, pulse_onsets = segmenter.split_pulses(filtered, time_vector, fs_hat)
+        n_pulses = len(pulse_onsets) - 1
+        if "split_pulses" in stages:
+            record("split_pulses", lambda: segmenter.split_pulses(filtered, time_vector, fs_hat),
+                   {"n_pulses": n_pulses})
+    finally:
+        # long signals start the worker processes of the parallel peak detection
+        segmenter.close()
+
+    analyzer = BasicPulseAnalyzer()
+    if "pulse_metrics" in stages:
+        record("pulse_metrics",
+               lambda: analyzer.batch_calculate_pulse_metrics(filtered, time_vector, pulse_onsets),
+               {"n_pulses": n_pulses})
+    if "pulse_metrics_lists" in stages:
+        # the list-of-arrays baseline (a PulseBatch would be measured with batch_calculate_pulse_metrics)
+        pulse_list, time_list = list(pulses), list(times)
+        record("pulse_metrics_lists",
+               lambda: (analyzer.batch_calculate_pulse_mean(pulse_list),
+                        analyzer.batch_calculate_pulse_amplitude(pulse_list),
+                        analyzer.batch_calculate_pulse_slope(pulse_list, time_list)),
+               {"n_pulses": n_pulses})
+
+    if "classify_batch" in stages:
+        from backend.pulse_classification import PulseClassifier
+        classifier = PulseClassifier()
+        classified = pulses[:max_classified] if max_classified else pulses
+        record("classify_batch", lambda: classifier.classify_batch(classified),
+               {"n_pulses": len(classified), "n_batches": -(-len(classified) // classifier.batch_size)})
+
+    pyramid = MinMaxPyramid(time_vector, filtered)
+    if "plot_pyramid" in stages:
+        record("plot_pyramid", lambda: MinMaxPyramid(time_vector, filtered), {})
+    if "plot_query" in stages:
+        record("plot_query", lambda: (pyramid.query(0, n_samples, 2000),
+                                      pyramid.query(n_samples // 2, n_samples // 2 + int(60 * fs), 2000)),
+               {"n_points": 2 * 2000})
+
+    if "streaming" in stages:
+        # the whole recording is streamed in 0.5 s chunks and the onsets are compared with split_pulses (the time
+        # includes the offline analysis)
+        from backend.streaming import compare_with_offline
+        agreement = record("streaming", lambda: compare_with_offline(signal, time_vector, fs_hat),
+                           lambda result: result)
+        print(f"{'':10s} {'':26s} {agreement['within_tolerance']:.1%} of onsets within the tolerance, "
+              f"latency up to {agreement['max_latency_s']:.2f} s")
+
+    return results
+
+
+def compare(results, baseline_path):
+    """
+    Prints the ratio of wall times and peak memory to a previous run.
+    """
+    with open(baseline_path, "r") as f:
+        baseline = {(item["stage"], item["duration_s"]): item for item in json.load(f)["results"]}
+    print("\nComparison with " + str(baseline_path) + " (current / baseline):")
+    for item in results:
+        previous = baseline.get((item["stage"], item["duration_s"]))
+        if previous is None:
+            continue
+        line = (f"{item['duration_s'] / 3600:7.2f} h  {item['stage']:26s} "
+                f"time x{item['wall_s'] / previous['wall_s']:.2f}")
+        if "peak_mb" in item and "peak_mb" in previous and previous["peak_mb"] > 0:
+            line += f"  memory x{item['peak_mb'] / previous['peak_mb']:.2f}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the pulse analysis pipeline on synthetic recordings.")
+    parser.add_argument("--durations", nargs="+", default=["1h", "24h", "72h"],
+                        help="durations of synthetic recordings (e.g. 30m 1h 24h 72h)")
+    parser.add_argument("--fs", type=float, default=125, help="sampling frequency (Hz)")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES, help="benchmarked stages")
+    parser.add_argument("--repeat", type=int, default=1, help="number of timed runs of each stage (best is kept)")
+    parser.add_argument("--no-memory", action="store_true", help="do not measure peak memory")
+    parser.add_argument("--max-classified", type=int, default=0,
+                        help="classify at most this many pulses per recording (0 - all)")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file with the results")
+    parser.add_argument("--compare", help="JSON file with results of a previous run")
+    args = parser.parse_args()
+
+    results = []
+    for duration in args.durations:
+        results += run_duration(parse_duration(duration), args.fs, args.stages, args.repeat, not args.no_memory,
+                                args.max_classified)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to " + args.output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
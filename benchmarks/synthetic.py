@@ -0,0 +1,77 @@
+from typing import Dict
+
+import numpy as np
+
+
+# DateTime of the first sample (days, as in ICM+ recordings)
+START_DATETIME = 45000.25
+
+
+def generate_recording(duration: float, fs: float = 125, heart_rate: float = 75, noise: float = 0.3,
+                       nan_gap_fraction: float = 0.01, artifact_fraction: float = 0.02,
+                       seed: int = 0) -> Dict[str, np.ndarray]:
+    """
+    Generates a deterministic synthetic ICP/ABP recording.
+
+    Each heartbeat is modelled as a sum of three Gaussian waves (P1, P2 and P3 components of the ICP pulse; a single
+    systolic wave and the dicrotic wave for ABP) with slowly varying heart rate, respiratory modulation and
+    baseline. A fraction of beats is replaced with artifacts (spikes, flat segments and noise) and a fraction
+    of samples is removed as NaN gaps of 1-10 s.
+
+    Args:
+        duration (float): The duration of the recording (in seconds).
+        fs (float): The sampling frequency (in Hz).
+        heart_rate (float): The mean heart rate (in beats per minute).
+        noise (float): The standard deviation of the measurement noise (in mmHg).
+        nan_gap_fraction (float): The approximate fraction of samples in NaN gaps.
+        artifact_fraction (float): The fraction of beats replaced with artifacts.
+        seed (int): The seed of the random number generator.
+
+    Returns:
+        dict: Arrays 'DateTime' (days), 'time' (seconds), 'icp[mmHg]' and 'abp[mmHg]', and the number of samples
+            in artifact beats under 'artifact_samples'.
+    """
+    rng = np.random.default_rng(seed)
+    n_samples = int(round(duration * fs))
+    time = np.arange(n_samples) / fs
+
+    # beat times with slowly varying heart rate
+    mean_interval = 60 / heart_rate
+    n_beats = int(duration / mean_interval * 1.2) + 2
+    intervals = mean_interval * (1 + 0.05 * np.sin(2 * np.pi * np.arange(n_beats) / 300)
+                                 + 0.02 * rng.standard_normal(n_beats))
+    beat_times = np.cumsum(intervals) - intervals[0]
+    beat_times = beat_times[beat_times < duration]
+
+    beat_index = np.searchsorted(beat_times, time, side='right') - 1
+    phase = time - beat_times[beat_index]
+
+    def wave(center, width, height):
+        return height * np.exp(-0.5 * ((phase - center) / width) ** 2)
+
+    baseline = 12 + 3 * np.sin(2 * np.pi * time / 3600) + 0.8 * np.sin(2 * np.pi * time / 4)
+    icp = baseline + wave(0.10, 0.03, 4.0) + wave(0.25, 0.05, 3.0) + wave(0.42, 0.06, 2.0)
+    abp = 80 + 10 * np.sin(2 * np.pi * time / 4) + wave(0.15, 0.06, 40.0) + wave(0.45, 0.05, 8.0)
+    icp += noise * rng.standard_normal(n_samples)
+    abp += 3 * noise * rng.standard_normal(n_samples)
+
+    artifact_beats = rng.random(len(beat_times)) < artifact_fraction
+    is_artifact = artifact_beats[beat_index]
+    kinds = rng.integers(0, 3, len(beat_times))[beat_index]
+    icp[is_artifact & (kinds == 0)] += 30 * np.exp(-phase[is_artifact & (kinds == 0)] / 0.05)
+    icp[is_artifact & (kinds == 1)] = baseline[is_artifact & (kinds == 1)]
+    icp[is_artifact & (kinds == 2)] += 5 * rng.standard_normal(np.count_nonzero(is_artifact & (kinds == 2)))
+
+    n_gaps = int(nan_gap_fraction * duration / 5.5)
+    for start in rng.integers(0, n_samples, n_gaps):
+        stop = start + int(rng.uniform(1, 10) * fs)
+        icp[start:stop] = np.nan
+        abp[start:stop] = np.nan
+
+    return {
+        'DateTime': START_DATETIME + time / (24 * 3600),
+        'time': time,
+        'icp[mmHg]': icp,
+        'abp[mmHg]': abp,
+        'artifact_samples': np.count_nonzero(is_artifact),
+    }
@@ -0,0 +1,67 @@
+import threading
+
+from PySide6.QtCore import QObject, QThreadPool, Signal
+
+
+class TaskCancelled(Exception):
+    """
+    Raised inside a background task when it has been cancelled.
+    """
+    pass
+
+
+class BackgroundTask(QObject):
+    """
+    Runs a function in the global Qt thread pool and reports its progress and results with signals.
+
+    The function receives the task as its first argument and should call report (and optionally publish) between
+    its stages; after cancel is called, the next such call raises TaskCancelled, which stops the function. Signals
+    are delivered to receivers in their own threads (e.g. the GUI thread), and no signal is emitted after the task
+    is cancelled.
+    """
+
+    # fraction of work done (0-1), name of the current stage
+    progress = Signal(float, str)
+    # intermediate result, e.g. the first part of the analysis
+    partialResult = Signal(object)
+    # result returned by the function
+    finished = Signal(object)
+    # error message
+    failed = Signal(str)
+
+    def __init__(self, func, *args) -> None:
+        QObject.__init__(self)
+        self.func = func
+        self.args = args
+        self._cancelled = threading.Event()
+
+    def start(self) -> None:
+        QThreadPool.globalInstance().start(self._run)
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def report(self, fraction: float, stage: str) -> None:
+        if self.is_cancelled():
+            raise TaskCancelled()
+        self.progress.emit(fraction, stage)
+
+    def publish(self, partial_result) -> None:
+        if self.is_cancelled():
+            raise TaskCancelled()
+        self.partialResult.emit(partial_result)
+
+    def _run(self) -> None:
+        try:
+            result = self.func(self, *self.args)
+        except TaskCancelled:
+            return
+        except Exception as exc:
+            if not self.is_cancelled():
+                self.failed.emit(str(exc))
+            return
+        if not self.is_cancelled():
+            self.finished.emit(result)
@@ -1,24 +1,30 @@
-from backend.pulse_segmentation import PulseSegmenter
-from backend.basic_pulse_analysis import BasicPulseAnalyzer
-from backend.pulse_classification import PulseClassifier
-from backend.signal_processing import convert_datetime_to_time
-from test.utils import Utils
+from controller.model_loader import models
 
-from PySide6.QtCore import QObject, Slot, Signal
+from PySide6.QtCore import QObject, Slot, Signal, Property
 
-import polars as pl
-import numpy as np
-
-segmenter = PulseSegmenter()
-basic_analyzer = BasicPulseAnalyzer()
-classifier = PulseClassifier()
+# The analysis objects are created on first use (see controller/model_loader.py), so importing this module
+# does not import scipy or torch
 
 class Controller(QObject):
+    # Emitted (from the loading thread) when the classifier is loaded
+    classifierReadyChanged = Signal()
+
     def __init__(self):
         QObject.__init__(self)
         self.columnLabels = []
         print("Column labels in __init__: ")
         print(self.columnLabels)
+        models.on_classifier_ready(self.classifierReadyChanged.emit)
+
+    def getClassifierReady(self):
+        return models.is_classifier_ready()
+
+    classifierReady = Property(bool, getClassifierReady, notify=classifierReadyChanged)
+
+    # Starts loading the classifier in the background (app.py does it after the window is shown)
+    @Slot()
+    def warmUpModels(self):
+        models.start_classifier_warmup()
     
     
     @Slot(list)
@@ -0,0 +1,269 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from controller.level_of_detail import MinMaxPyramid
+
+
+class Dataset:
+    """
+    A recording loaded for plotting: the time vector, the selected channels and their level-of-detail pyramids.
+
+    Channels read from binary recordings stay memory-mapped (the operating system reads and drops their pages as
+    needed); channels read from CSV files are stored as float32, which is enough for plotting. The pulse analysis
+    always uses the float64 samples of the recording (see takeAnalysisSource), so its results are the same as
+    the results of batch_processing.py and processing_example.py for the same file.
+
+    An evicted dataset keeps the stored levels of its pyramids (see MinMaxPyramid.release), so it can still be
+    plotted and autoscaled; only zooming in below the base level of the pyramids needs the data to be read again.
+    """
+
+    # Labels of the channels whose pulses are analyzed (see Plotter.startAnalysis)
+    analyzedLabels = ("icp",)
+
+    def __init__(self, path: str, columnNames: dict) -> None:
+        """
+        Initializes an empty (not loaded) Dataset instance.
+
+        Args:
+            path (str): The path of the recording.
+            columnNames (dict): The names of the loaded columns by channel label (e.g. {"icp": "icp[mmHg]"}).
+        """
+        self.path = path
+        self.columnNames = dict(columnNames)
+        self.fs = None
+        self.time = None
+        self.channels = {}
+        self.pyramids = {}
+        # float64 samples of the analyzed channels read from a CSV file, kept until the analysis takes them
+        self.analysisSources = {}
+        # Analysis results of the ICP channel (PulseTable), kept when the data is evicted
+        self.pulseTable = None
+        # Displayed range of sample indices (start, stop), None before the dataset is plotted
+        self.viewport = None
+        # Memory used by the data released by evict (see nbytes), i.e. needed to load it again
+        self.loadedBytes = 0
+
+    @property
+    def isLoaded(self) -> bool:
+        return self.time is not None
+
+    def load(self, report=None) -> "Dataset":
+        """
+        Reads the recording and builds the pyramids of all channels.
+
+        Args:
+            report (callable): Function called with the fraction of work done (0-1) and the name of the current
+                stage (e.g. BackgroundTask.report).
+
+        Returns:
+            Dataset: The dataset itself.
+        """
+        # imported here, so that scipy is not imported before the window is shown
+        from backend.recording_io import load_recording
+
+        report = report or (lambda fraction, stage: None)
+        report(0.0, "Reading file")
+        data, fs = load_recording(self.path, *self.columnNames.values())
+        report(0.6, "Preparing plot")
+
+        channels = {}
+        pyramids = {}
+        analysisSources = {}
+        for index, (label, columnName) in enumerate(self.columnNames.items()):
+            values = data.get(columnName)
+            if values is not None:
+                channels[label] = values if isinstance(values, np.memmap) else np.asarray(values, dtype=np.float32)
+                pyramids[label] = MinMaxPyramid(data["time"], channels[label])
+                if label in self.analyzedLabels and channels[label] is not values:
+                    analysisSources[label] = np.asarray(values, dtype=np.float64)
+            report(0.6 + 0.4 * (index + 1) / max(len(self.columnNames), 1), "Preparing plot")
+
+        self.fs = fs
+        self.time = data["time"]
+        self.channels = channels
+        self.pyramids = pyramids
+        self.loadedBytes = self._dataBytes()
+        self.analysisSources = analysisSources
+        return self
+
+    def takeAnalysisSource(self, label: str):
+        """
+        Returns the float64 samples of a channel for the pulse analysis: the memory-mapped channel of a binary
+        recording or the samples read from a CSV file (released by the dataset, the analysis holds them until it
+        is done). Returns None if the samples of a CSV file were already taken; they are then read again from
+        the file (see readAnalysisSource).
+        """
+        values = self.analysisSources.pop(label, None)
+        if values is None and isinstance(self.channels.get(label), np.memmap):
+            values = self.channels[label]
+        return values
+
+    def readAnalysisSource(self, label: str) -> np.ndarray:
+        """
+        Reads the float64 samples of a channel from the recording (e.g. when the analysis of a CSV file is started
+        again, see takeAnalysisSource).
+        """
+        # imported here, so that scipy is not imported before the window is shown
+        from backend.recording_io import load_recording
+
+        columnName = self.columnNames[label]
+        data, _ = load_recording(self.path, columnName)
+        return np.asarray(data[columnName], dtype=np.float64)
+
+    def restore(self, loaded: "Dataset") -> None:
+        """
+        Takes the data of another dataset of the same recording (e.g. read again in a worker thread).
+        """
+        self.fs = loaded.fs
+        self.time = loaded.time
+        self.channels = loaded.channels
+        self.pyramids = loaded.pyramids
+        self.loadedBytes = loaded.loadedBytes
+
+    def evict(self) -> None:
+        """
+        Releases the data and keeps the stored levels of the pyramids; the data is read again from the recording
+        when needed.
+        """
+        self.time = None
+        self.channels = {}
+        self.analysisSources = {}
+        for pyramid in self.pyramids.values():
+            pyramid.release()
+
+    @property
+    def nSamples(self) -> int:
+        if self.isLoaded:
+            return len(self.time)
+        return next(iter(self.pyramids.values())).n_samples if self.pyramids else 0
+
+    @property
+    def timeRange(self) -> (float, float):
+        """
+        The times of the first and the last sample (after eviction, the last one is the start of the last block
+        of the pyramids).
+        """
+        if self.isLoaded:
+            return float(self.time[0]), float(self.time[-1])
+        blockTimes = next(iter(self.pyramids.values())).block_times
+        return float(blockTimes[0]), float(blockTimes[-1])
+
+    def sampleRange(self, startTime: float, endTime: float) -> (int, int):
+        """
+        Returns the [start, stop) range of sample indices with times in the [startTime, endTime] range.
+        """
+        if self.isLoaded:
+            return (int(np.searchsorted(self.time, startTime, side="left")),
+                    int(np.searchsorted(self.time, endTime, side="right")))
+        if not self.pyramids:
+            return 0, 0
+        return next(iter(self.pyramids.values())).sample_range(startTime, endTime)
+
+    def _dataBytes(self) -> int:
+        arrays = [self.time, *self.channels.values(), *self.analysisSources.values()]
+        return sum(array.nbytes for array in arrays if not isinstance(array, np.memmap))
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The memory used by the dataset (memory-mapped arrays are not counted). The pyramids and the pulse table
+        are kept when the dataset is evicted, so they are counted in both cases.
+        """
+        return ((self._dataBytes() if self.isLoaded else 0)
+                + sum(pyramid.nbytes for pyramid in self.pyramids.values())
+                + (self.pulseTable.nbytes if self.pulseTable is not None else 0))
+
+
+class DatasetRegistry:
+    """
+    Helper class that holds the recordings loaded by a Plotter (e.g. many recordings overlaid in the hold on mode).
+
+    The memory used by the loaded recordings is limited by plot.memory_budget_mb (see params.yaml). Above it,
+    the data of the least recently used recordings is evicted (the most recently used one never). The evicted
+    recordings are plotted from their pyramids and are read again only when their samples are needed and fit in
+    the budget (see canReload), so overlaid recordings which do not fit together are not read again and again.
+    """
+
+    def __init__(self, budgetMb: float) -> None:
+        """
+        Initializes an empty DatasetRegistry instance.
+
+        Args:
+            budgetMb (float): The memory budget (in MB), plot.memory_budget_mb in params.yaml.
+        """
+        self.budget = int(budgetMb * 2 ** 20)
+        # least recently used first
+        self._datasets = OrderedDict()
+
+    def __contains__(self, path: str) -> bool:
+        return path in self._datasets
+
+    def __len__(self) -> int:
+        return len(self._datasets)
+
+    def paths(self) -> list:
+        return list(self._datasets)
+
+    def add(self, dataset: Dataset) -> None:
+        """
+        Adds a loaded dataset (replacing a dataset with the same path) and evicts others if needed.
+        """
+        self._datasets[dataset.path] = dataset
+        self._datasets.move_to_end(dataset.path)
+        self._enforceBudget()
+
+    def get(self, path: str) -> Dataset:
+        """
+        Returns the dataset (loaded or evicted) and marks it as the most recently used.
+        """
+        dataset = self._datasets[path]
+        self._datasets.move_to_end(path)
+        return dataset
+
+    def canReload(self, path: str) -> bool:
+        """
+        Checks if the data of an evicted dataset fits in the budget without evicting other datasets.
+        """
+        dataset = self._datasets.get(path)
+        return dataset is not None and not dataset.isLoaded and self.nbytes + dataset.loadedBytes <= self.budget
+
+    def restore(self, loaded: Dataset) -> None:
+        """
+        Restores the data of an evicted dataset read again from its recording (see Dataset.restore).
+        """
+        dataset = self._datasets.get(loaded.path)
+        if dataset is None or dataset.isLoaded:
+            return
+        dataset.restore(loaded)
+        self._datasets.move_to_end(loaded.path)
+        self._enforceBudget()
+
+    def peek(self, path: str) -> Dataset:
+        """
+        Returns the dataset without loading it or changing the order of use.
+        """
+        return self._datasets.get(path)
+
+    def remove(self, path: str) -> None:
+        self._datasets.pop(path, None)
+
+    def clear(self) -> None:
+        self._datasets.clear()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(dataset.nbytes for dataset in self._datasets.values())
+
+    def _enforceBudget(self) -> None:
+        used = self.nbytes
+        if used <= self.budget:
+            return
+        # least recently used first; the last one is never evicted
+        for dataset in list(self._datasets.values())[:-1]:
+            if used <= self.budget:
+                break
+            if dataset.isLoaded:
+                loadedBytes = dataset.nbytes
+                dataset.evict()
+                used -= loadedBytes - dataset.nbytes
@@ -0,0 +1,274 @@
+import math
+
+import numpy as np
+
+
+class MinMaxPyramid:
+    """
+    Level-of-detail structure for plotting long signals.
+
+    Level k of the pyramid holds the minimum and maximum of consecutive blocks of 2**k samples (level 0 is the signal
+    itself). For a visible range of samples and a plot width in pixels, the coarsest level with at most one block
+    per pixel is used and each block is drawn as two points (its minimum and maximum), so the number of plotted
+    points does not depend on the length of the recording, while the envelope of the signal is preserved.
+
+    Only the levels from base_level up are stored (as float32), which takes 2 / 2**base_level float32 values
+    per sample; finer levels are only used for short visible ranges (at most 2**base_level samples per pixel)
+    and are computed from the signal when queried.
+
+    The stored levels also hold the sum of the non-NaN samples (float64) and the number of NaN samples (int32)
+    of each block, so the minimum, maximum, mean and the number of missing samples of any range are combined from
+    O(log n) blocks (see statistics), e.g. for autoscaling the plot or for the statistics of a selected region.
+
+    The signal and the time vector can be released (see release), e.g. when the recording is evicted from memory.
+    The stored levels and the times of the base level blocks are kept, so the pyramid can still be queried, with
+    at most one block of the base level per pixel.
+    """
+
+    # The finest stored level (blocks of 16 samples)
+    BASE_LEVEL = 4
+
+    # The number of samples converted to float64 at a time when the sums are built
+    BUILD_CHUNK = 1 << 20
+
+    def __init__(self, time: np.ndarray, values: np.ndarray, base_level: int = BASE_LEVEL) -> None:
+        """
+        Initializes a MinMaxPyramid instance and builds all levels.
+
+        Args:
+            time (numpy array): The one-dimensional time vector.
+            values (numpy array): The one-dimensional signal vector corresponding to the time vector.
+            base_level (int): The finest stored level.
+        """
+        self.time = time
+        self.values = values
+        self.base_level = base_level
+        self.n_samples = len(values)
+        # times of the first samples of the base level blocks, kept when the signal is released
+        self.block_times = None
+        self.mins = [values] + [None] * (base_level - 1)
+        self.maxs = [values] + [None] * (base_level - 1)
+        self.sums = [None] * base_level
+        self.nan_counts = [None] * base_level
+        if len(values) == 0:
+            self.mins, self.maxs = [values], [values]
+            return
+
+        block_starts = np.arange(0, len(values), 1 << base_level)
+        level_min = np.fmin.reduceat(values, block_starts).astype(np.float32)
+        level_max = np.fmax.reduceat(values, block_starts).astype(np.float32)
+        level_sum, level_nan_count = self._block_sums(values, base_level)
+        self.mins.append(level_min)
+        self.maxs.append(level_max)
+        self.sums.append(level_sum)
+        self.nan_counts.append(level_nan_count)
+        while len(level_min) > 1:
+            level_min = self._reduce_pairs(level_min, np.fmin)
+            level_max = self._reduce_pairs(level_max, np.fmax)
+            level_sum = self._reduce_pairs(level_sum, np.add)
+            level_nan_count = self._reduce_pairs(level_nan_count, np.add)
+            self.mins.append(level_min)
+            self.maxs.append(level_max)
+            self.sums.append(level_sum)
+            self.nan_counts.append(level_nan_count)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The memory used by the stored levels (without the signal itself).
+        """
+        levels = self.mins[1:] + self.maxs[1:] + self.sums + self.nan_counts + [self.block_times]
+        return sum(level.nbytes for level in levels if level is not None)
+
+    @property
+    def isReleased(self) -> bool:
+        return self.values is None
+
+    def release(self) -> None:
+        """
+        Releases the signal and the time vector and keeps the stored levels and the times of the base level blocks
+        (a float64 value per 2**base_level samples).
+        """
+        if self.isReleased or len(self.mins) <= self.base_level:
+            return
+        self.block_times = np.array(self.time[::1 << self.base_level], dtype=np.float64)
+        self.mins[0] = self.maxs[0] = None
+        self.time = None
+        self.values = None
+
+    def level(self, start: int, stop: int, width: int) -> int:
+        """
+        Returns the level with at most one block per pixel used by query for the [start, stop) range of samples.
+        """
+        samples_per_pixel = (stop - start) / max(int(width), 1)
+        level = math.ceil(math.log2(samples_per_pixel)) if samples_per_pixel > 1 else 0
+        return min(level, len(self.mins) - 1)
+
+    def _times(self, indices: np.ndarray) -> np.ndarray:
+        """
+        Returns the times of samples; after release, they are interpolated between the times of the blocks.
+        """
+        if not self.isReleased:
+            return self.time[indices]
+        block_indices = np.arange(len(self.block_times)) << self.base_level
+        return np.interp(indices, block_indices, self.block_times)
+
+    def sample_range(self, start_time: float, end_time: float) -> (int, int):
+        """
+        Returns the [start, stop) range of sample indices with times in the [start_time, end_time] range
+        (after release, extended to whole base level blocks).
+        """
+        if not self.isReleased:
+            return (int(np.searchsorted(self.time, start_time, side="left")),
+                    int(np.searchsorted(self.time, end_time, side="right")))
+        first_block = max(int(np.searchsorted(self.block_times, start_time, side="right")) - 1, 0)
+        last_block = int(np.searchsorted(self.block_times, end_time, side="right"))
+        return first_block << self.base_level, min(last_block << self.base_level, self.n_samples)
+
+    @classmethod
+    def _block_sums(cls, values: np.ndarray, level: int) -> (np.ndarray, np.ndarray):
+        """
+        Returns the sums of the non-NaN samples and the numbers of NaN samples of consecutive blocks of 2**level
+        samples (the signal is processed in parts, so that it is not converted to float64 as a whole).
+        """
+        n_blocks = -(-len(values) // (1 << level))
+        sums = np.empty(n_blocks, dtype=np.float64)
+        nan_counts = np.empty(n_blocks, dtype=np.int32)
+        chunk = max(cls.BUILD_CHUNK >> level, 1) << level
+        for chunk_start in range(0, len(values), chunk):
+            part = np.asarray(values[chunk_start:chunk_start + chunk], dtype=np.float64)
+            is_nan = np.isnan(part)
+            local_starts = np.arange(0, len(part), 1 << level)
+            blocks = slice(chunk_start >> level, (chunk_start >> level) + len(local_starts))
+            sums[blocks] = np.add.reduceat(np.where(is_nan, 0.0, part), local_starts)
+            nan_counts[blocks] = np.add.reduceat(is_nan, local_starts, dtype=np.int32)
+        return sums, nan_counts
+
+    @staticmethod
+    def _reduce_pairs(values: np.ndarray, func) -> np.ndarray:
+        """
+        Reduces pairs of consecutive values (the last value is kept as it is if the length is odd).
+        """
+        reduced = func(values[0:len(values) - 1:2], values[1::2])
+        if len(values) % 2:
+            reduced = np.append(reduced, values[-1])
+        return reduced
+
+    def query(self, start: int, stop: int, width: int) -> (np.ndarray, np.ndarray):
+        """
+        Returns the points to plot for the [start, stop) range of samples.
+
+        Args:
+            start (int): The first index of the visible range.
+            stop (int): The index after the last index of the visible range.
+            width (int): The width of the plot (in pixels).
+
+        Returns:
+            x (numpy array): The time coordinates of the points.
+            y (numpy array): The signal values of the points.
+        """
+        start = max(int(start), 0)
+        stop = min(int(stop), self.n_samples)
+        if stop <= start:
+            return np.zeros(0), np.zeros(0)
+
+        level = self.level(start, stop, width)
+        if self.isReleased:
+            # the levels finer than base_level need the signal
+            level = max(level, self.base_level)
+        # QXYSeries.replaceNp ignores the points if x and y arrays have different types, so both are float64
+        if level == 0:
+            return (np.ascontiguousarray(self.time[start:stop], dtype=np.float64),
+                    np.ascontiguousarray(self.values[start:stop], dtype=np.float64))
+
+        first_block = start >> level
+        last_block = ((stop - 1) >> level) + 1
+        block_starts = np.arange(first_block, last_block) << level
+        block_centers = np.minimum(block_starts + (1 << (level - 1)), self.n_samples - 1)
+
+        x = np.empty(2 * len(block_starts))
+        y = np.empty(2 * len(block_starts))
+        x[0::2] = self._times(block_starts)
+        x[1::2] = self._times(block_centers)
+        if self.mins[level] is not None:
+            y[0::2] = self.mins[level][first_block:last_block]
+            y[1::2] = self.maxs[level][first_block:last_block]
+        else:
+            # levels finer than base_level are computed from the visible samples
+            visible = self.values[block_starts[0]:min(last_block << level, len(self.values))]
+            y[0::2] = np.fmin.reduceat(visible, block_starts - block_starts[0])
+            y[1::2] = np.fmax.reduceat(visible, block_starts - block_starts[0])
+        return x, y
+
+    def statistics(self, start: int, stop: int) -> dict:
+        """
+        Returns the statistics of the [start, stop) range of samples.
+
+        The range is covered by at most two blocks of each stored level (combined like in a segment tree) and
+        fewer than 2**base_level samples at each end, which are read from the signal, so the time does not depend
+        on the length of the range. After release, the range is extended to whole base level blocks instead.
+
+        Args:
+            start (int): The first index of the range.
+            stop (int): The index after the last index of the range.
+
+        Returns:
+            dict: min, max (NaN samples are ignored), mean (of the non-NaN samples), count (the number of samples)
+                and nan_count (the number of NaN samples); min, max and mean are NaN if there are no valid samples.
+        """
+        start = max(int(start), 0)
+        stop = min(int(stop), self.n_samples)
+        block_size = 1 << self.base_level
+        if self.isReleased and stop > start:
+            # the last block may be shorter than block_size
+            start = start // block_size * block_size
+            stop = min(-(-stop // block_size) * block_size, self.n_samples)
+        count = max(stop - start, 0)
+        first_block = -(-start // block_size)
+        last_block = -(-stop // block_size) if stop == self.n_samples else stop // block_size
+        if self.isReleased:
+            edges = []
+        elif len(self.mins) <= self.base_level or first_block >= last_block:
+            first_block = last_block = stop // block_size
+            edges = [self.values[start:stop]]
+        else:
+            edges = [self.values[start:first_block * block_size], self.values[last_block * block_size:stop]]
+
+        mins, maxs, sums, nan_counts = [], [], [], []
+        for edge in edges:
+            edge = np.asarray(edge, dtype=np.float64)
+            if len(edge):
+                mins.append(np.fmin.reduce(edge))
+                maxs.append(np.fmax.reduce(edge))
+                is_nan = np.isnan(edge)
+                sums.append(np.sum(edge, where=~is_nan))
+                nan_counts.append(np.count_nonzero(is_nan))
+
+        level = self.base_level
+        low, high = first_block, last_block
+        while low < high:
+            blocks = []
+            if low & 1:
+                blocks.append(low)
+                low += 1
+            if high & 1:
+                high -= 1
+                blocks.append(high)
+            for block in blocks:
+                mins.append(self.mins[level][block])
+                maxs.append(self.maxs[level][block])
+                sums.append(self.sums[level][block])
+                nan_counts.append(self.nan_counts[level][block])
+            low >>= 1
+            high >>= 1
+            level += 1
+
+        nan_count = int(sum(nan_counts))
+        valid = count - nan_count
+        return {
+            "min": float(np.fmin.reduce(mins)) if valid else math.nan,
+            "max": float(np.fmax.reduce(maxs)) if valid else math.nan,
+            "mean": float(sum(sums)) / valid if valid else math.nan,
+            "count": count,
+            "nan_count": nan_count,
+        }
@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+from pathlib import Path
+
+
+class ModelLoader:
+    """
+    Helper class that creates the analysis objects on first use, so that starting the application does not import
+    scipy and torch or load the neural network model before the window is shown.
+
+    The segmenter, the basic analyzer and the result cache are cheap and are created when first requested, and
+    the parameters (backend/params.yaml) are read once and shared by the controllers.
+    The classifier is loaded in a background thread (start_classifier_warmup, called by app.py after the first frame
+    is shown) and the callers which need it wait for it with wait_for_classifier.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._params = None
+        self._segmenter = None
+        self._basic_analyzer = None
+        self._result_cache = None
+        self._classifier = None
+        self._classifier_error = None
+        self._classifier_ready = threading.Event()
+        self._warmup_thread = None
+        self._ready_callbacks = []
+
+    def params(self) -> dict:
+        with self._lock:
+            if self._params is None:
+                import yaml
+                params_path = Path(os.path.dirname(__file__)).parent / 'backend' / 'params.yaml'
+                with open(params_path, 'r') as stream:
+                    self._params = yaml.safe_load(stream)
+            return self._params
+
+    def segmenter(self):
+        with self._lock:
+            if self._segmenter is None:
+                from backend.pulse_segmentation import PulseSegmenter
+                self._segmenter = PulseSegmenter()
+            return self._segmenter
+
+    def basic_analyzer(self):
+        with self._lock:
+            if self._basic_analyzer is None:
+                from backend.basic_pulse_analysis import BasicPulseAnalyzer
+                self._basic_analyzer = BasicPulseAnalyzer()
+            return self._basic_analyzer
+
+    def result_cache(self):
+        with self._lock:
+            if self._result_cache is None:
+                from backend.result_cache import ResultCache
+                self._result_cache = ResultCache()
+            return self._result_cache
+
+    def start_classifier_warmup(self) -> None:
+        """
+        Starts loading the classifier in a background thread (does nothing if it is already loading or loaded).
+        """
+        with self._lock:
+            if self._warmup_thread is not None:
+                return
+            self._warmup_thread = threading.Thread(target=self._load_classifier, name="classifier-warmup",
+                                                   daemon=True)
+        self._warmup_thread.start()
+
+    def is_classifier_ready(self) -> bool:
+        return self._classifier_ready.is_set()
+
+    def on_classifier_ready(self, callback) -> None:
+        """
+        Registers a function called (in the loading thread) when the classifier is loaded or fails to load;
+        it is called immediately if this has already happened.
+        """
+        with self._lock:
+            if not self._classifier_ready.is_set():
+                self._ready_callbacks.append(callback)
+                return
+        callback()
+
+    def wait_for_classifier(self, timeout: float = None):
+        """
+        Returns the classifier, starting the warmup if needed and waiting until it is loaded.
+
+        Args:
+            timeout (float): The longest time to wait (in seconds); None - wait until the classifier is loaded.
+
+        Returns:
+            PulseClassifier: The loaded classifier.
+
+        Raises:
+            TimeoutError: If the classifier is not loaded within timeout.
+            RuntimeError: If the classifier could not be loaded.
+        """
+        self.start_classifier_warmup()
+        if not self._classifier_ready.wait(timeout):
+            raise TimeoutError("The classifier is still loading")
+        if self._classifier_error is not None:
+            raise RuntimeError("The classifier could not be loaded: " + self._classifier_error)
+        return self._classifier
+
+    def _load_classifier(self) -> None:
+        start = time.perf_counter()
+        try:
+            import numpy as np
+            from backend.pulse_classification import PulseClassifier
+            classifier = PulseClassifier()
+            # the first batch initializes the inference backend (e.g. the ONNX Runtime session)
+            classifier.classify_batch([np.sin(np.linspace(0, np.pi, 100))])
+            self._classifier = classifier
+            print(f"Classifier loaded in {time.perf_counter() - start:.2f} s")
+        except Exception as exc:
+            self._classifier_error = str(exc)
+            print("Loading the classifier failed: " + self._classifier_error)
+
+        with self._lock:
+            self._classifier_ready.set()
+            callbacks, self._ready_callbacks = self._ready_callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except RuntimeError as exc:
+                # the receiver no longer exists (e.g. a Qt object of a closed dialog)
+                print(exc)
+
+
+# Analysis objects shared by the whole application
+models = ModelLoader()
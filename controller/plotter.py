@@ -1,30 +1,60 @@
-import polars as pl
-import time
 import numpy as np
 
-from backend.signal_processing import convert_datetime_to_time
+from backend import instrumentation
+from backend.instrumentation import stage
+from backend.pulse_table import PulseTable
+from controller.background_task import BackgroundTask
+from controller.dataset_registry import Dataset, DatasetRegistry
+from controller.model_loader import models
 
-from PySide6.QtCore import  QObject, QPointF, Slot, Signal
+from PySide6.QtCore import  QObject, QPointF, Slot, Signal, Property
 from PySide6.QtCharts import QChart, QChartView, QLineSeries, QValueAxis
 
 class Plotter(QObject):
-    # Limit values
-    minX = 0
-    maxX = 0
-    minY = 0
-    maxY = 0
-    values = dict.fromkeys(["time", "abp", "icp", "fvl", "fvr"])
-    valuesLen = 0
+    # Names of .csv columns corresponding to data column labels
+    columnNames = {"abp": "abp[mmHg]", "icp": "icp[mmHg]", "fvl": "fvl[cm/s]", "fvr": "fvr[cm/s]"}
 
-    # Names of .csv files
-    fileNames = []
+    # Plot width (in pixels) used when the width of the chart is not known
+    defaultPlotWidth = 2000
 
-    # Data column labels
-    columnLabels = []
+    # Emitted while a file is loaded in the background: fraction of work done (0-1), name of the current stage
+    loadingProgress = Signal(float, str)
+    # Emitted when a file is loaded and series can be filled
+    loaded = Signal(str)
+    # Emitted when a file cannot be loaded: path, error message
+    loadingFailed = Signal(str, str)
+    # Emitted when an evicted file is read again in the background and its series can be redrawn in detail
+    reloaded = Signal(str)
+    # Emitted while the pulses of a file are analyzed: path, fraction of work done (0-1)
+    analysisProgress = Signal(str, float)
+    # Emitted when the pulses of a part of a file are analyzed (the displayed part first): path
+    pulsesUpdated = Signal(str)
+    # Emitted when the pulses of the whole file are analyzed: path
+    pulsesReady = Signal(str)
+    # Emitted when new stage timings are available (see backend/instrumentation.py)
+    stageTimingsChanged = Signal()
 
-    time = np.ndarray([])
-    fs = np.float64()
+    def __init__(self, parent=None):
+        QObject.__init__(self, parent)
+        # Limit values
+        self.minX = 0
+        self.maxX = 0
+        self.minY = 0
+        self.maxY = 0
 
+        # Loaded recordings (many in the hold on mode)
+        self.datasets = DatasetRegistry(models.params()["plot"]["memory_budget_mb"])
+        # Path of the most recently loaded recording
+        self.currentPath = None
+
+        # Task loading the most recently selected file (None when nothing is being loaded)
+        self.loadingTask = None
+        # Tasks analyzing pulses of loaded files (by path)
+        self.analysisTasks = {}
+        # Tasks reading evicted files again (by path)
+        self.reloadTasks = {}
+
+    @staticmethod
     def new_column_labels(dataColumns):
         columnLabels = []
 
@@ -43,66 +73,294 @@ class Plotter(QObject):
 
         return columnLabels
         
-    # Fills plot with provided fillSeries
-    @Slot(str)
+    # Starts loading the file in the background; loaded is emitted when series can be filled
+    # Accepts .csv files and recordings converted to the binary format (backend/recording_io.py)
+    @Slot(str, list)
     def initialize(self, path, columnLabels):
-        self.fileNames.append(path)
-        df = pl.read_csv(path)
-        self.time, self.fs = convert_datetime_to_time(df.get_column("DateTime").to_numpy())
-        self.columnLabels = self.new_column_labels(columnLabels)
+        # Selecting another file cancels loading of the previous one (the analysis of loaded files continues)
+        if self.loadingTask is not None:
+            self.loadingTask.cancel()
+            self.loadingTask = None
+
+        columnLabels = self.new_column_labels(columnLabels)
         print("Column labels in plot: ")
-        print(self.columnLabels)
+        print(columnLabels)
+
+        dataset = Dataset(path, {label: self.columnNames[label] for label in columnLabels})
+        self.loadingTask = BackgroundTask(self.load, dataset)
+        self.loadingTask.progress.connect(self.onLoadingProgress)
+        self.loadingTask.finished.connect(self.onLoadingFinished)
+        self.loadingTask.failed.connect(self.onLoadingFailed)
+        self.loadingTask.start()
 
+    # Cancels loading of the current file and the analysis of all files
+    # The partial pulse tables of the cancelled analyses are dropped, so the analysis can be started again
+    # (see resumeAnalysis)
+    @Slot()
+    def cancelLoading(self):
+        if self.loadingTask is not None:
+            self.loadingTask.cancel()
+            self.loadingTask = None
+        for path, task in self.analysisTasks.items():
+            task.cancel()
+            dataset = self.datasets.peek(path)
+            if dataset is not None:
+                dataset.pulseTable = None
+        for task in self.reloadTasks.values():
+            task.cancel()
+        self.analysisTasks = {}
+        self.reloadTasks = {}
 
+    # Runs in a worker thread, so it does not modify the Plotter
+    def load(self, task, dataset):
+        with stage("Plotter.load") as measurement:
+            dataset.load(task.report)
+            measurement.count(samples=len(dataset.time), channels=len(dataset.channels))
+        return dataset
 
-        # self.values["time"] = self.time
-        # if "icp" in self.columnLabels:
-        #     self.values["icp"] = df.get_column("icp[mmHg]")
-        # if "abp" in self.columnLabels:
-        #     self.values["abp"] = df.get_column("abp[mmHg]")
-        # if "fvl" in self.columnLabels:
-        #     self.values["fvl"] = df.get_column("fvl[cm/s]")
-        # if "fvr" in self.columnLabels:
-        #     self.values["fvr"] = df.get_column("fvr[cm/s]")
-        # if not self.columnLabels:
-        #     print("columnLabels is empty")
-        self.valuesLen = len(self.values["time"])
+    @Slot(float, str)
+    def onLoadingProgress(self, fraction, stage):
+        if self.sender() is self.loadingTask:
+            self.loadingProgress.emit(fraction, stage)
 
-        self.vals_range = [0, self.valuesLen]
+    @Slot(object)
+    def onLoadingFinished(self, dataset):
+        if self.sender() is not self.loadingTask:
+            return
+        self.loadingTask = None
 
-    @Slot(QLineSeries, QLineSeries, QLineSeries, QLineSeries, result=None)
-    def fillSeries(self, abp, icp, fvl, fvr):
+        if not dataset.channels:
+            print("columnLabels is empty")
+        self.datasets.add(dataset)
+        self.currentPath = dataset.path
 
-        if "icp" in self.values:
-            icp_points = [QPointF(x, y) for x, y in zip(self.values["time"][self.vals_range[0]:self.vals_range[1]], self.values["icp"][self.vals_range[0]:self.vals_range[-1]])]
-            icp.append(icp_points)
+        self.loaded.emit(dataset.path)
+        self.stageTimingsChanged.emit()
+        self.startAnalysis(dataset)
 
-        if "abp" in self.values:
-            abp_points = [QPointF(x, y) for x, y in zip(self.values["time"][self.vals_range[0]:self.vals_range[1]], self.values["abp"][self.vals_range[0]:self.vals_range[-1]])]
-            abp.append(abp_points)
+    @Slot(str)
+    def onLoadingFailed(self, message):
+        if self.sender() is not self.loadingTask:
+            return
+        path = self.loadingTask.args[0].path
+        # only the failed task is dropped; the analysis of the files already open continues
+        self.loadingTask = None
+        print("Loading " + path + " failed: " + message)
+        self.loadingFailed.emit(path, message)
 
-        if "fvl" in self.values:
-            fvl_points = [QPointF(x, y) for x, y in zip(self.values["time"][self.vals_range[0]:self.vals_range[1]], self.values["fvl"][self.vals_range[0]:self.vals_range[-1]])]
-            fvl.append(fvl_points)
+    # Starts reading an evicted file again in the background, unless it does not fit in the memory budget
+    # (then it is plotted from its pyramids, see DatasetRegistry)
+    def startReload(self, dataset):
+        if dataset.path in self.reloadTasks or not self.datasets.canReload(dataset.path):
+            return
+        task = BackgroundTask(self.reload, dataset.path, dataset.columnNames)
+        task.finished.connect(self.onReloadFinished)
+        task.failed.connect(self.onReloadFailed)
+        self.reloadTasks[dataset.path] = task
+        task.start()
 
-        if "fvr" in self.values:
-            fvr_points = [QPointF(x, y) for x, y in zip(self.values["time"][self.vals_range[0]:self.vals_range[1]], self.values["fvr"][self.vals_range[0]:self.vals_range[-1]])]
-            fvr.append(fvr_points)
-        
-        # Calculate time of execution
-        start_time = time.time()
-        print("--- %s seconds ---" % (time.time() - start_time))
+    # Runs in a worker thread, so it does not modify the Plotter
+    def reload(self, task, path, columnNames):
+        with stage("Plotter.reload") as measurement:
+            dataset = Dataset(path, columnNames).load(task.report)
+            measurement.count(samples=len(dataset.time), channels=len(dataset.channels))
+        return dataset
+
+    @Slot(object)
+    def onReloadFinished(self, dataset):
+        path = self.sender().args[0]
+        if self.reloadTasks.get(path) is not self.sender():
+            return
+        del self.reloadTasks[path]
+        self.datasets.restore(dataset)
+        self.reloaded.emit(path)
+
+    @Slot(str)
+    def onReloadFailed(self, message):
+        path = self.sender().args[0]
+        if self.reloadTasks.get(path) is not self.sender():
+            return
+        del self.reloadTasks[path]
+        print("Reading " + path + " again failed: " + message)
+
+    # Starts the pulse analysis of the ICP channel of a loaded file in the background
+    # The displayed part of the file is analyzed first and the results are added to its pulse table as they come
+    # The analysis uses the float64 samples of the file, not the float32 copy used for plotting (see Dataset)
+    def startAnalysis(self, dataset):
+        if "icp" not in dataset.channels or dataset.pulseTable is not None:
+            return
+        dataset.pulseTable = PulseTable()
+        task = BackgroundTask(self.analyze, dataset.path, dataset.time, dataset.takeAnalysisSource("icp"), dataset.fs,
+                              lambda: dataset.viewport, lambda: dataset.readAnalysisSource("icp"))
+        task.progress.connect(self.onAnalysisProgress)
+        task.partialResult.connect(self.onAnalysisPartialResult)
+        task.finished.connect(self.onAnalysisFinished)
+        task.failed.connect(self.onAnalysisFailed)
+        self.analysisTasks[dataset.path] = task
+        task.start()
+
+    # Starts the analysis of an open file again if it was cancelled (the file must not be evicted)
+    @Slot(str)
+    def resumeAnalysis(self, path):
+        dataset = self.datasets.peek(path)
+        if dataset is not None and dataset.isLoaded and path not in self.analysisTasks:
+            self.startAnalysis(dataset)
+
+    # Runs in a worker thread, so it does not modify the Plotter
+    # viewport returns the displayed range of samples, which is read before each analyzed chunk
+    # readIcp reads the ICP samples from the file if they are not given (the analysis of a CSV file started again)
+    # The results of an unchanged file analyzed before with the same parameters and model are read from the result
+    # cache (shared with processing_example.py) instead, and the results of a finished analysis are stored in it
+    def analyze(self, task, path, time, icp, fs, viewport, readIcp):
+        # imported here, so that scipy is not imported before the window is shown
+        from backend.progressive_analysis import ProgressiveAnalysis
+        from backend.result_cache import ResultCache
 
+        task.report(0.0, "Analyzing pulses")
+        try:
+            classifier = models.wait_for_classifier()
+        except RuntimeError as exc:
+            print(exc)
+            classifier = None
 
+        # results without classes (the classifier could not be loaded) are not cached
+        cache = models.result_cache() if classifier is not None else None
+        if cache is not None:
+            analysisParams = ResultCache.analysis_params(self.columnNames["icp"], classifier)
+            with stage("Plotter.readCachedResults"):
+                cached = cache.get(path, analysisParams)
+            if cached is not None:
+                task.publish((0, len(time), cached))
+                task.report(1.0, "Analyzing pulses")
+                return
+
+        if icp is None:
+            icp = readIcp()
+        analysis = ProgressiveAnalysis(icp, time, fs, models.segmenter(), models.basic_analyzer(), classifier,
+                                       viewport=viewport)
+        # the final results of all chunks, stored in the cache when the whole file is analyzed
+        table = PulseTable()
+        for start, stop, results in analysis.run():
+            task.publish((start, stop, results))
+            table.replace(start, stop, results)
+            task.report(analysis.progress, "Analyzing pulses")
+        if cache is not None and not task.is_cancelled():
+            cache.put(path, analysisParams, table.to_arrays())
+
+    @Slot(float, str)
+    def onAnalysisProgress(self, fraction, stage):
+        path = self.sender().args[0]
+        if self.analysisTasks.get(path) is self.sender():
+            self.analysisProgress.emit(path, fraction)
+
+    @Slot(object)
+    def onAnalysisPartialResult(self, chunk):
+        path = self.sender().args[0]
+        if self.analysisTasks.get(path) is not self.sender():
+            return
+        dataset = self.datasets.peek(path)
+        if dataset is not None:
+            start, stop, results = chunk
+            dataset.pulseTable.replace(start, stop, results)
+            self.pulsesUpdated.emit(path)
+
+    @Slot(object)
+    def onAnalysisFinished(self, result):
+        path = self.sender().args[0]
+        if self.analysisTasks.get(path) is not self.sender():
+            return
+        del self.analysisTasks[path]
+        if path in self.datasets:
+            self.pulsesReady.emit(path)
+
+    @Slot(str)
+    def onAnalysisFailed(self, message):
+        path = self.sender().args[0]
+        if self.analysisTasks.get(path) is not self.sender():
+            return
+        del self.analysisTasks[path]
+        dataset = self.datasets.peek(path)
+        if dataset is not None:
+            dataset.pulseTable = None
+        print("Analysis of " + path + " failed: " + message)
+        self.loadingFailed.emit(path, message)
+
+    # Returns the analyzed pulse of the most recently loaded file at the time point
+    # (class, onset index, start and end time, mean, amplitude, slope) or an empty map if there is none
+    @Slot(float, result="QVariantMap")
+    def pulseAt(self, time):
+        dataset = self.datasets.peek(self.currentPath)
+        if dataset is None or dataset.pulseTable is None:
+            return {}
+        index = dataset.pulseTable.find(time)
+        return dataset.pulseTable.row(index) if index >= 0 else {}
+
+    @Slot(str, QLineSeries, QLineSeries, QLineSeries, QLineSeries, result=None)
+    def fillSeries(self, path, abp, icp, fvl, fvr):
+        if path not in self.datasets:
+            return
+        dataset = self.datasets.get(path)
+        if dataset.nSamples:
+            startTime, endTime = dataset.timeRange
+            self.updateSeries(path, abp, icp, fvl, fvr, startTime, endTime, self.defaultPlotWidth)
+
+    # Replaces the points of series of the file with the min/max envelope of the visible x range
+    # (about two points per pixel of the plot width, regardless of the length of the recording)
+    # Evicted files are never read here: they are drawn from their pyramids and, if the visible range needs their
+    # samples, read again in the background (reloaded is emitted when they can be redrawn)
+    @Slot(str, QLineSeries, QLineSeries, QLineSeries, QLineSeries, float, float, float, result=None)
+    def updateSeries(self, path, abp, icp, fvl, fvr, minX, maxX, plotWidth):
+        if path not in self.datasets:
+            return
+        dataset = self.datasets.get(path)
+        start, stop = dataset.sampleRange(minX, maxX)
+        # One more sample on each side, so the lines reach the edges of the plot
+        start = max(start - 1, 0)
+        stop = min(stop + 1, dataset.nSamples)
+        dataset.viewport = (start, stop)
+        if not dataset.isLoaded and any(pyramid.level(start, stop, plotWidth) < pyramid.base_level
+                                        for pyramid in dataset.pyramids.values()):
+            self.startReload(dataset)
+
+        with stage("Plotter.updateSeries", samples=stop - start) as measurement:
+            points = 0
+            for label, series in zip(["abp", "icp", "fvl", "fvr"], [abp, icp, fvl, fvr]):
+                if label in dataset.pyramids:
+                    x, y = dataset.pyramids[label].query(start, stop, plotWidth)
+                    series.replaceNp(x, y)
+                    points += len(x)
+            measurement.count(points=points)
+
+    # Most recent measurement of each stage (wall_s, cpu_s, peak_rss_delta_mb, counts, ...);
+    # empty unless instrumentation is enabled (see the environment variables in backend/instrumentation.py)
+    def getStageTimings(self):
+        return instrumentation.latest_records()
+
+    stageTimings = Property(list, getStageTimings, notify=stageTimingsChanged)
+
+    # Notifies the UI about timings of stages run since loading (e.g. redrawing)
+    @Slot()
+    def refreshStageTimings(self):
+        self.stageTimingsChanged.emit()
 
     # Sets axes limits
     # Objects contains current limits and compares it with new ones
+    # The limits of all channels of the plotted files are read from their pyramids (O(log n) per channel)
     @Slot(QValueAxis, QValueAxis)
     def setAxes(self, xAxis, yAxis):
-        minX = min(self.values["time"][self.vals_range[0]:self.vals_range[-1]])
-        maxX = max(self.values["time"][self.vals_range[0]:self.vals_range[-1]])
-        minY = min(self.values["icp"][self.vals_range[0]:self.vals_range[-1]])
-        maxY = max(self.values["icp"][self.vals_range[0]:self.vals_range[-1]])
+        datasets = [self.datasets.peek(path) for path in self.datasets.paths()]
+        datasets = [dataset for dataset in datasets if dataset.nSamples]
+        if not datasets:
+            return
+
+        with stage("Plotter.setAxes", channels=sum(len(dataset.pyramids) for dataset in datasets)):
+            minX = min(dataset.timeRange[0] for dataset in datasets)
+            maxX = max(dataset.timeRange[1] for dataset in datasets)
+            statistics = [pyramid.statistics(0, dataset.nSamples)
+                          for dataset in datasets for pyramid in dataset.pyramids.values()]
+            # channels without valid samples have NaN limits, which are ignored
+            minY = float(np.fmin.reduce([channel["min"] for channel in statistics], initial=np.nan))
+            maxY = float(np.fmax.reduce([channel["max"] for channel in statistics], initial=np.nan))
 
         self.minX = minX if minX < self.minX else self.minX
         self.maxX = maxX if maxX > self.maxX else self.maxX
@@ -119,21 +377,40 @@ class Plotter(QObject):
         yAxis.setProperty('min', minY)
         yAxis.setProperty('max', maxY)
 
+    # Returns the statistics of each channel of the most recently loaded file in the [startTime, endTime] range
+    # (label -> min, max, mean, count, nanCount) and the number of analyzed pulses starting in it (pulses)
+    @Slot(float, float, result="QVariantMap")
+    def selectionStatistics(self, startTime, endTime):
+        dataset = self.datasets.peek(self.currentPath)
+        if dataset is None or not dataset.nSamples:
+            return {}
+        startTime, endTime = min(startTime, endTime), max(startTime, endTime)
+        start, stop = dataset.sampleRange(startTime, endTime)
+
+        result = {}
+        for label, pyramid in dataset.pyramids.items():
+            channel = pyramid.statistics(start, stop)
+            result[label] = {"min": channel["min"], "max": channel["max"], "mean": channel["mean"],
+                             "count": channel["count"], "nanCount": channel["nan_count"]}
+        if dataset.pulseTable is not None:
+            pulses = dataset.pulseTable.find_range(startTime, endTime)
+            result["pulses"] = pulses.stop - pulses.start
+        return result
+
     # Clears current Plotter object
     @Slot()
     def clearObject(self):
+        self.cancelLoading()
+
         # Limit values
         self.minX = 0
         self.maxX = 0
         self.minY = 0
         self.maxY = 0
-        self.values = dict.fromkeys(["time", "abp", "icp", "fvl", "fvr"])
-        self.valuesLen = 0
-
-        # Names of .csv files
-        self.fileNames = []
+        self.datasets.clear()
+        self.currentPath = None
 
-    # Checks if the file was already provided
+    # Checks if the file was already provided (loaded or being loaded)
     @Slot(str, result=bool)
     def isFile(self, path):
-        return path in self.fileNames
+        return path in self.datasets or (self.loadingTask is not None and self.loadingTask.args[0].path == path)
@@ -1,4 +1,5 @@
 import QtQuick
+import QtQuick.Controls
 import QtCharts
 import Plotter 1.0
 
@@ -18,6 +19,9 @@ ChartView {
     // Holds on plot like Matlab
     property bool holdOn
 
+    // Series of each plotted file (file url -> [abp, icp, fvl, fvr])
+    property var seriesByFile: ({})
+
     Plotter {
         id: plotter
     }
@@ -25,6 +29,8 @@ ChartView {
     ValueAxis {
         id: myAxisX
         titleText: "t [s]"
+        onMinChanged: redrawTimer.start()
+        onMaxChanged: redrawTimer.start()
     }
 
     ValueAxis {
@@ -32,12 +38,36 @@ ChartView {
         titleText: "y"
     }
 
+    // Redraws series for the visible x range at most once per frame while scrolling or zooming
+    // (start has no effect if the timer is already running)
+    Timer {
+        id: redrawTimer
+        interval: 16
+        onTriggered: {
+            for (var fileUrl in root.seriesByFile) {
+                var series = root.seriesByFile[fileUrl]
+                plotter.updateSeries(fileUrl, series[0], series[1], series[2], series[3],
+                                     myAxisX.min, myAxisX.max, root.plotArea.width)
+            }
+            if (timingsLabel.visible)
+                plotter.refreshStageTimings()
+        }
+    }
+
     // Executes when program finishes creating ChartView object on startup
     // Adds a series so that the window is not empty
     Component.onCompleted: {
         var empty = root.createSeries(ChartView.SeriesTypeLine, "line", myAxisX, myAxisY)
     }
 
+    // Shows the properties of the pulse under the cursor (most recently added file) in the peak data panel
+    function showPulseAt(x, y) {
+        if (root.count === 0)
+            return
+        var value = root.mapToValue(Qt.point(x, y), root.series(0))
+        backend.showPulse(plotter.pulseAt(value.x))
+    }
+
     Connections {
         target: root
         // When new data is provided
@@ -46,32 +76,182 @@ ChartView {
             // If hold on is off clears the entire object and series
             if (!holdOn) {
                 root.removeAllSeries()
+                root.seriesByFile = {}
                 plotter.clearObject()
             }
 
             // Adds data if it does not exists yet
+            // The file is loaded in the background, series are created when plotter emits loaded
             if (!plotter.isFile(fileUrl)) {
-                // Crates series
                 plotter.initialize(fileUrl, columnLabels)
-                var abp = root.createSeries(ChartView.SeriesTypeLine, "abp", myAxisX, myAxisY)
-                var icp = root.createSeries(ChartView.SeriesTypeLine, "icp", myAxisX, myAxisY)
-                var fvl = root.createSeries(ChartView.SeriesTypeLine, "fvl", myAxisX, myAxisY);
-                var fvr = root.createSeries(ChartView.SeriesTypeLine, "fvr", myAxisX, myAxisY);
+            } else {
+                // The pulse analysis of the file may have been cancelled
+                plotter.resumeAnalysis(fileUrl)
+            }
+        }
+    }
+
+    Connections {
+        target: plotter
+
+        function onLoadingProgress(fraction, stage) {
+            loadingIndicator.visible = true
+            loadingBar.value = fraction
+            loadingLabel.text = stage
+        }
 
-                // Fill series and set axes limits
-                plotter.fillSeries(abp, icp, fvl, fvr)
-                plotter.setAxes(myAxisX, myAxisY)
+        function onLoaded(fileUrl) {
+            loadingIndicator.visible = false
 
+            // Crates series
+            var abp = root.createSeries(ChartView.SeriesTypeLine, "abp", myAxisX, myAxisY)
+            var icp = root.createSeries(ChartView.SeriesTypeLine, "icp", myAxisX, myAxisY)
+            var fvl = root.createSeries(ChartView.SeriesTypeLine, "fvl", myAxisX, myAxisY);
+            var fvr = root.createSeries(ChartView.SeriesTypeLine, "fvr", myAxisX, myAxisY);
 
-                var fileName = fileUrl.substring(0, fileUrl.length - 4).replace(/^.*[\\/]/, '')
+            // Fill series and set axes limits
+            root.seriesByFile[fileUrl] = [abp, icp, fvl, fvr]
+            plotter.fillSeries(fileUrl, abp, icp, fvl, fvr)
+            plotter.setAxes(myAxisX, myAxisY)
 
-                // Sets color and name
-                //var color = line.color
-                root.updated(fileName, color)
+
+            var fileName = fileUrl.substring(0, fileUrl.length - 4).replace(/^.*[\\/]/, '')
+
+            // Sets color and name
+            //var color = line.color
+            root.updated(fileName, color)
+        }
+
+        function onReloaded(fileUrl) {
+            // The file was evicted and is drawn from its pyramids until it is read again
+            redrawTimer.start()
+        }
+
+        function onLoadingFailed(fileUrl, message) {
+            loadingIndicator.visible = false
+            analysisLabel.visible = false
+        }
+
+        function onAnalysisProgress(fileUrl, fraction) {
+            analysisLabel.visible = true
+            analysisLabel.text = qsTr("Analyzing pulses: %1%").arg(Math.round(fraction * 100))
+        }
+
+        function onPulsesUpdated(fileUrl) {
+            // The pulse under the cursor may have been analyzed
+            if (chartMouseArea.containsMouse)
+                root.showPulseAt(chartMouseArea.mouseX, chartMouseArea.mouseY)
+        }
+
+        function onPulsesReady(fileUrl) {
+            analysisLabel.visible = false
+            plotter.refreshStageTimings()
+        }
+    }
+
+    // Progress of the pulse analysis (the displayed part of the file is analyzed first)
+    Label {
+        id: analysisLabel
+        anchors.top: parent.top
+        anchors.right: parent.right
+        anchors.margins: 10
+        visible: false
+    }
+
+    // Most recent timings of the top-level stages (only when instrumentation is enabled, see the environment
+    // variables in backend/instrumentation.py)
+    Label {
+        id: timingsLabel
+        anchors.bottom: parent.bottom
+        anchors.right: parent.right
+        anchors.margins: 10
+        visible: plotter.stageTimings.length > 0
+        font.pixelSize: 10
+        text: {
+            var lines = []
+            for (var i = 0; i < plotter.stageTimings.length; i++) {
+                var record = plotter.stageTimings[i]
+                if (!record.parent)
+                    lines.push(qsTr("%1: %2 ms").arg(record.stage).arg((record.wall_s * 1000).toFixed(1)))
+            }
+            return lines.join("\n")
+        }
+    }
+
+    // Progress of loading a file in the background
+    Column {
+        id: loadingIndicator
+        anchors.centerIn: parent
+        spacing: 5
+        visible: false
+
+        Label {
+            id: loadingLabel
+            anchors.horizontalCenter: parent.horizontalCenter
+        }
+
+        ProgressBar {
+            id: loadingBar
+            from: 0
+            to: 1
+        }
+
+        Button {
+            text: qsTr("Cancel")
+            anchors.horizontalCenter: parent.horizontalCenter
+            onClicked: {
+                plotter.cancelLoading()
+                loadingIndicator.visible = false
+                analysisLabel.visible = false
             }
         }
     }
 
+    // Region selected with the right mouse button and the statistics of its samples
+    Rectangle {
+        id: selectionRect
+        visible: false
+        y: root.plotArea.y
+        height: root.plotArea.height
+        color: "#3300a0ff"
+        border.color: "#8800a0ff"
+        property real startX: 0
+    }
+
+    Label {
+        id: selectionLabel
+        anchors.top: parent.top
+        anchors.left: parent.left
+        anchors.margins: 10
+        visible: selectionRect.visible
+    }
+
+    // Updates the selected region (from the press position to x) and its statistics
+    function updateSelection(x, y) {
+        if (root.count === 0)
+            return
+        var left = Math.min(selectionRect.startX, x)
+        var right = Math.max(selectionRect.startX, x)
+        selectionRect.x = left
+        selectionRect.width = right - left
+        selectionRect.visible = true
+
+        var start = root.mapToValue(Qt.point(left, y), root.series(0))
+        var end = root.mapToValue(Qt.point(right, y), root.series(0))
+        var statistics = plotter.selectionStatistics(start.x, end.x)
+        var lines = [qsTr("%1 - %2 s").arg(start.x.toFixed(1)).arg(end.x.toFixed(1))]
+        for (var label in statistics) {
+            var channel = statistics[label]
+            if (label === "pulses")
+                lines.push(qsTr("pulses: %1").arg(channel))
+            else
+                lines.push(qsTr("%1: mean %2, min %3, max %4, missing %5/%6").arg(label)
+                           .arg(channel.mean.toFixed(2)).arg(channel.min.toFixed(2)).arg(channel.max.toFixed(2))
+                           .arg(channel.nanCount).arg(channel.count))
+        }
+        selectionLabel.text = lines.join("\n")
+    }
+
     // Mask to scroll plot
     Rectangle {
         id: scrollMask
@@ -86,8 +266,19 @@ ChartView {
         id: chartMouseArea
         anchors.fill: parent
         hoverEnabled: true
-        acceptedButtons: Qt.LeftButton
+        acceptedButtons: Qt.LeftButton | Qt.RightButton
         onDoubleClicked: plotter.setAxes(myAxisX, myAxisY)
+        onPositionChanged: mouse => {
+                               root.showPulseAt(mouse.x, mouse.y)
+                               if ((mouse.buttons & Qt.RightButton) == Qt.RightButton)
+                                   root.updateSelection(mouse.x, mouse.y)
+                           }
+        onClicked: mouse => {
+                       root.showPulseAt(mouse.x, mouse.y)
+                       // A left click clears the selection
+                       if (mouse.button === Qt.LeftButton)
+                           selectionRect.visible = false
+                   }
 
         // Scroll horizontally
         onMouseXChanged: mouse => {
@@ -113,6 +304,9 @@ ChartView {
                        if (mouse.button === Qt.LeftButton) {
                            scrollMask.x = mouseX
                            scrollMask.y = mouseY
+                       } else if (mouse.button === Qt.RightButton) {
+                           selectionRect.startX = mouse.x
+                           root.updateSelection(mouse.x, mouse.y)
                        }
                    }
 
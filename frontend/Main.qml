@@ -150,14 +150,14 @@ ApplicationWindow {
             Layout.rightMargin: 10
         }
 
-        // PeakDataContainer {
-        //     id: peakDataContainer
-        //     Layout.fillHeight: true
-        //     Layout.fillWidth: true
-        //     Layout.topMargin: 5
-        //     Layout.bottomMargin: 10
-        //     Layout.rightMargin: 10
-        // }
+        PeakDataContainer {
+            id: peakDataContainer
+            Layout.fillHeight: true
+            Layout.fillWidth: true
+            Layout.topMargin: 5
+            Layout.bottomMargin: 10
+            Layout.rightMargin: 10
+        }
 
 
         
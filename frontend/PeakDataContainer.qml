@@ -24,7 +24,7 @@ Rectangle {
         anchors.left: parent.left
         padding: 5
 
-        text: qsTr("Mean: ") + backend.peakClass
+        text: qsTr("Mean: ") + backend.peakMean
     }
 
     Text {
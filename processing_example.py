@@ -1,45 +1,78 @@
 from pathlib import Path
 
 import numpy as np
-import pandas as pd
 
-from backend.signal_processing import convert_datetime_to_time, filter_signal
+from backend.recording_io import load_recording
+from backend.signal_processing import filter_signal
 
 from backend.pulse_segmentation import PulseSegmenter
 from backend.basic_pulse_analysis import BasicPulseAnalyzer
 from backend.pulse_classification import PulseClassifier
+from backend.pulse_table import PulseTable
+from backend.result_cache import ResultCache
+from backend.trend_summary import TrendSummary
 
 import matplotlib.pyplot as plt
 
 
-segmenter = PulseSegmenter()
-basic_analyzer = BasicPulseAnalyzer()
-classifier = PulseClassifier()
+# the main guard is required because the segmenter may start worker processes (segment.processes in params.yaml)
+if __name__ == "__main__":
+    segmenter = PulseSegmenter()
+    basic_analyzer = BasicPulseAnalyzer()
+    classifier = PulseClassifier()
 
+    # .csv file or a recording converted once with: python -m backend.recording_io <file.csv>
+    file_path = Path(r'E:\\_BrainLab\\SampleRecords\\testowy_bardzo_krotki.csv')
 
-file_path = Path(r'E:\\_BrainLab\\SampleRecords\\testowy_bardzo_krotki.csv')
-with open(file_path, 'r') as f:
-    data = pd.read_csv(f)
-datetime = data['DateTime'].to_numpy()
-icp = data['icp[mmHg]'].to_numpy()
+    # read the signal, convert timestamps to time in seconds and estimate sampling frequency
+    data, fs = load_recording(file_path, 'icp[mmHg]')
+    time = data['time']
+    icp = data['icp[mmHg]']
 
-# convert timestamps to time in seconds and estimate sampling frequency
-time, fs = convert_datetime_to_time(datetime)
+    # results of an unchanged file analyzed with the same parameters and model are read from the cache (shared with
+    # the application, which stores the results of the files it opens)
+    cache = ResultCache()
+    analysis_params = ResultCache.analysis_params("icp[mmHg]", classifier)
+    results = cache.get(file_path, analysis_params)
+    if results is None:
+        # filter the signal
+        icp = filter_signal(icp, fs)
 
-# filter the signal
-icp = filter_signal(icp, fs)
+        # segment the signal (divide the signal in individual pulses)
+        segments, times, pulse_onsets = segmenter.split_pulses(icp, time, fs)
+        # stop the worker processes, they are not needed any more
+        segmenter.close()
+        mean_times = times.means()
 
-# segment the signal (divide the signal in individual pulses)
-segments, times, _ = segmenter.split_pulses(icp, time, fs)
-mean_times = [np.mean(pulse_time) for pulse_time in times]
+        # calculate basic pulse metrics
+        pulse_means, pulse_amplitudes, pulse_slopes = basic_analyzer.batch_calculate_pulse_metrics(icp, time,
+                                                                                                   pulse_onsets)
 
-# calculate basic pulse metrics
-pulse_means = basic_analyzer.batch_calculate_pulse_mean(segments)
-pulse_amplitudes = basic_analyzer.batch_calculate_pulse_amplitude(segments)
-pulse_slopes = basic_analyzer.batch_calculate_pulse_slope(segments, times)
+        # classify the pulses using a neural network model; classes 1-4 are valid shapes and class 5 are artifacts
+        # (obviously invalid pulses and the partial segments at both ends are labeled as artifacts without the model)
+        pulse_classes, gate_counts = classifier.classify_batch(segments, fs, edge_pulses=(True, True),
+                                                               return_gate_counts=True)
+        print(f"{gate_counts['total']} of {len(pulse_classes)} pulses labeled as artifacts without the model")
 
-# classify the pulses using a neural network model; classes 1-4 are valid shapes and class 5 are artifacts
-pulse_classes = classifier.classify_batch(segments)
+        # the table of pulses also summarizes them in windows of 10 s, 1 min, 10 min and 1 h; the summaries are
+        # stored with the results
+        table = PulseTable({"onsets": pulse_onsets[:-1], "start_times": time[pulse_onsets[:-1]],
+                            "end_times": time[pulse_onsets[1:]], "means": pulse_means, "amplitudes": pulse_amplitudes,
+                            "slopes": pulse_slopes, "classes": pulse_classes})
+        results = table.to_arrays()
+        cache.put(file_path, analysis_params, results)
 
-print(type(time))
-print(type(fs))
+    print(type(time))
+    print(type(fs))
+
+    # plot the overview of the whole recording from at most a few thousand windows
+    trends = TrendSummary.from_arrays(results)
+    if trends is not None:
+        resolution, windows = trends.overview(time[0], time[-1], max_points=5000)
+        fig, (ax_icp, ax_artifacts) = plt.subplots(2, 1, sharex=True)
+        ax_icp.plot(windows["start_times"] / 3600, windows["means"])
+        ax_icp.set_ylabel("mean ICP [mmHg]")
+        ax_artifacts.plot(windows["start_times"] / 3600, windows["artifact_fractions"])
+        ax_artifacts.set_ylabel("artifacts (class 5)")
+        ax_artifacts.set_xlabel(f"time [h] ({resolution:g} s windows)")
+        plt.show()
@@ -0,0 +1,35 @@
+import pytest
+
+from backend.streaming import StreamingPulseProcessor, compare_with_offline
+from benchmarks.synthetic import generate_recording
+
+# Largest measured shift (in seconds) of a streaming onset from the nearest offline onset on clean synthetic ICP:
+# slower pulses have longer flat diastolic parts, in which the onset may be placed on the other maximum
+MAX_ONSET_SHIFT = {60: 0.4, 75: 0.2, 90: StreamingPulseProcessor.STREAMING_ONSET_TOLERANCE}
+
+
+@pytest.mark.parametrize("fs", [125, 250])
+@pytest.mark.parametrize("heart_rate", [60, 75, 90])
+def test_streaming_onsets_match_offline_onsets(fs, heart_rate):
+    # clean synthetic ICP with the default settings (settle_duration of 1 s, 0.5 s chunks)
+    recording = generate_recording(300, fs=fs, heart_rate=heart_rate, noise=0, nan_gap_fraction=0,
+                                   artifact_fraction=0)
+    agreement = compare_with_offline(recording['icp[mmHg]'], recording['time'], fs)
+
+    assert agreement["median_difference"] == 0
+    assert agreement["within_tolerance"] >= 0.96
+    # onsets outside the tolerance stay within the flat diastolic part of the pulse
+    assert agreement["max_difference"] <= MAX_ONSET_SHIFT[heart_rate] * fs
+    assert abs(agreement["streaming_onsets"] - agreement["offline_onsets"]) <= 0.01 * agreement["offline_onsets"]
+    # settle_duration + 0.5 s (detection) + chunk duration
+    assert agreement["max_latency_s"] <= 2.0
+
+
+@pytest.mark.parametrize("fs", [125, 250])
+def test_longer_settle_duration_improves_agreement(fs):
+    recording = generate_recording(300, fs=fs, heart_rate=60, noise=0, nan_gap_fraction=0, artifact_fraction=0)
+    agreement = compare_with_offline(recording['icp[mmHg]'], recording['time'], fs, settle_duration=2.0)
+
+    assert agreement["within_tolerance"] >= 0.99
+    assert StreamingPulseProcessor.STREAMING_ONSET_TOLERANCE * fs >= agreement["p99_difference"]
+    assert agreement["max_latency_s"] <= 3.0
@@ -6,6 +6,12 @@ class Utils:
 
     @staticmethod
     def read_data(file_path, *data_names):
+        from backend.recording_io import is_binary_recording, load_recording
+        if is_binary_recording(file_path):
+            # recording converted to the binary format (memory-mapped, no parsing)
+            loaded, _ = load_recording(file_path, *data_names)
+            return {name: loaded[name] for name in data_names if name in loaded}
+
         lazy_df = pl.scan_csv(file_path).select(data_names)
         df = lazy_df.collect()
         data = {}